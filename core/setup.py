@@ -15,6 +15,7 @@ setup(
         'gunicorn >= 19, < 20',
         'jinja2 >= 2.10, < 2.11',
         'mongoengine >= 0.15, < 0.16',
+        'perfectstorm-lib',
         'pymongo >= 3.6, < 3.7',
     ],
     zip_safe=False,
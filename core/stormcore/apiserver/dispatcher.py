@@ -0,0 +1,312 @@
+import logging
+import threading
+import time
+from datetime import datetime
+
+from mongoengine.connection import get_db
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+
+from stormcore.apiserver.maintenance import Lease
+from stormcore.apiserver.models import Event, Subscription
+
+
+log = logging.getLogger(__name__)
+
+
+class EventDispatcher:
+    """Consume the event log and run the subscriptions triggered by events.
+
+    Saving a document only appends an event to the log: subscriptions are
+    evaluated here, in the background, in ID order. Rendering the templates
+    of subscriptions is CPU-bound: stormd runs the dispatcher in a separate
+    process (the 'dispatch_events' management command), so that it does
+    not hold up API requests. Every API server runs a dispatcher, but only
+    the one holding the 'dispatcher' lease is active.
+
+    IDs are allocated before events are inserted, so an event can become
+    visible after events with higher IDs. When the dispatcher sees a gap in
+    IDs, it goes on with the following events, and dispatches the missing
+    ones as soon as they show up. Missing events that did not show up
+    within GAP_TIMEOUT seconds are skipped.
+
+    Progress is checkpointed in the 'checkpoints' collection after every
+    batch of events. The checkpoint never goes past a missing event. If the
+    dispatcher stops before checkpointing, the next dispatcher processes
+    the same events again: delivery is at-least-once. If the dispatcher
+    falls so far behind that the events it has to process are deleted from
+    the event log (see trim_events()), those events are counted as 'lost'.
+    """
+
+    CHECKPOINT_COLLECTION = 'checkpoints'
+    CHECKPOINT_NAME = 'subscriptions'
+
+    LEASE_NAME = 'dispatcher'
+    LEASE_DURATION = 30
+
+    # Maximum number of events processed between two checkpoints
+    BATCH_SIZE = 100
+
+    # How often the lease is renewed, including while events are being
+    # dispatched. This must be well below LEASE_DURATION.
+    LEASE_RENEW_INTERVAL = 1
+
+    # How long to wait before checking for new events when there are none
+    POLL_INTERVAL = .1
+
+    # How long to wait for the events missing from a gap in IDs
+    GAP_TIMEOUT = 10
+
+    def __init__(self, queryset=None):
+        if queryset is None:
+            queryset = Event.objects.all()
+        self.queryset = queryset
+        self.lease = Lease(self.LEASE_NAME, self.LEASE_DURATION)
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._last_renewal = None
+
+        # All the events up to the checkpoint were dispatched (or lost, or
+        # skipped). Events between the checkpoint and the last dispatched
+        # event were dispatched, except the missing ones, which are
+        # mapped to the time after which they are skipped.
+        self._checkpoint = None
+        self._last_dispatched_id = None
+        self._missing = {}
+
+    @classmethod
+    def _get_checkpoints(cls):
+        return get_db()[cls.CHECKPOINT_COLLECTION]
+
+    def _last_event_id(self):
+        last_event = self.queryset.only('id').order_by('-id').first()
+        return last_event.id if last_event is not None else 0
+
+    def _load_checkpoint(self):
+        # When starting for the first time, skip the events that are
+        # already in the log
+        checkpoint = self._get_checkpoints().find_one_and_update(
+            {'_id': self.CHECKPOINT_NAME},
+            {'$setOnInsert': {'last_event_id': self._last_event_id()}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER)
+        self._checkpoint = checkpoint['last_event_id']
+        self._last_dispatched_id = self._checkpoint
+        self._missing = {}
+
+    def _save_checkpoint(self, last_event, processed, errors, lost, skipped):
+        updates = {
+            'last_event_id': self._checkpoint,
+            'updated': datetime.now(),
+        }
+        if last_event is not None:
+            updates['last_event_date'] = last_event.date
+
+        self._get_checkpoints().update_one(
+            {'_id': self.CHECKPOINT_NAME},
+            {
+                '$set': updates,
+                '$inc': {
+                    'processed': processed,
+                    'errors': errors,
+                    'lost': lost,
+                    'skipped': skipped,
+                },
+            })
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        try:
+            self.lease.release()
+        except PyMongoError:
+            log.exception('Error while releasing the dispatcher lease')
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                if self.lease.acquire():
+                    self._last_renewal = time.monotonic()
+                    self._dispatch_while_leader()
+                    continue
+            except PyMongoError:
+                log.exception('Error while dispatching events')
+            self._stop_event.wait(self.LEASE_RENEW_INTERVAL)
+
+    def _renew_lease(self):
+        """Renew the lease if LEASE_RENEW_INTERVAL has passed since the last
+        renewal. Return False if the lease was lost or if the dispatcher is
+        stopping.
+        """
+        if self._stop_event.is_set():
+            return False
+
+        now = time.monotonic()
+        if now - self._last_renewal < self.LEASE_RENEW_INTERVAL:
+            return True
+
+        if not self.lease.acquire():
+            log.warning('Lost the dispatcher lease')
+            return False
+
+        self._last_renewal = now
+        return True
+
+    def _dispatch_while_leader(self):
+        self._load_checkpoint()
+
+        while self._renew_lease():
+            if not self._dispatch_batch():
+                self._stop_event.wait(self.POLL_INTERVAL)
+
+    def _dispatch_batch(self):
+        """Dispatch the missing events that showed up, followed by the next
+        batch of events, and save the checkpoint. Return whether any event
+        was dispatched.
+        """
+        events = []
+        if self._missing:
+            events.extend(
+                self.queryset.filter(id__in=list(self._missing))
+                .order_by('id'))
+        events.extend(
+            self.queryset.filter(id__gt=self._last_dispatched_id)
+            .order_by('id')
+            .limit(self.BATCH_SIZE))
+
+        processed = errors = lost = 0
+
+        for event in events:
+            # Dispatching can take a while: if the lease is lost, another
+            # dispatcher takes over from the last checkpoint
+            if not self._renew_lease():
+                return False
+
+            if self._missing.pop(event.id, None) is None:
+                lost += self._add_gap(event.id)
+                self._last_dispatched_id = event.id
+
+            errors += self.dispatch(event)
+            processed += 1
+
+        expired_lost, skipped = self._expire_gaps()
+        lost += expired_lost
+
+        checkpoint = self._checkpoint
+        if self._missing:
+            self._checkpoint = min(self._missing) - 1
+        else:
+            self._checkpoint = self._last_dispatched_id
+
+        if processed or lost or skipped or self._checkpoint != checkpoint:
+            self._save_checkpoint(
+                events[-1] if events else None,
+                processed, errors, lost, skipped)
+
+        return processed > 0
+
+    def _add_gap(self, event_id):
+        """Record the events missing between the last dispatched event and
+        the given one. Return the number of missing events that were
+        deleted from the log, and will never show up.
+        """
+        first_missing = self._last_dispatched_id + 1
+        if event_id <= first_missing:
+            return 0
+
+        lost = 0
+        oldest_event_id = self.queryset.oldest_event_id()
+        if oldest_event_id is not None and oldest_event_id > first_missing:
+            lost = min(oldest_event_id, event_id) - first_missing
+            first_missing += lost
+            log.warning(
+                'Dispatcher is lagging behind: %d events lost', lost)
+
+        deadline = time.monotonic() + self.GAP_TIMEOUT
+        for missing_id in range(first_missing, event_id):
+            self._missing[missing_id] = deadline
+
+        return lost
+
+    def _expire_gaps(self):
+        """Stop waiting for the missing events that did not show up within
+        GAP_TIMEOUT seconds. Return the number of those events that were
+        deleted from the log (lost), and of those that were never inserted
+        (skipped).
+        """
+        now = time.monotonic()
+        expired = [
+            event_id for event_id, deadline in self._missing.items()
+            if deadline <= now]
+        if not expired:
+            return 0, 0
+
+        for event_id in expired:
+            del self._missing[event_id]
+
+        oldest_event_id = self.queryset.oldest_event_id()
+        lost = sum(
+            1 for event_id in expired
+            if oldest_event_id is None or event_id < oldest_event_id)
+        skipped = len(expired) - lost
+
+        if skipped:
+            log.warning(
+                'Events %s are missing, skipping them',
+                ', '.join(str(event_id) for event_id in sorted(expired)))
+
+        return lost, skipped
+
+    def dispatch(self, event):
+        """Run the subscriptions triggered by the given event. Return the
+        number of subscriptions that failed.
+        """
+        errors = 0
+
+        for subscription in Subscription.objects.iter_for_event(event):
+            try:
+                subscription.exec(event)
+            except Exception:
+                log.exception(
+                    'Error while running subscription %s for event %s',
+                    subscription.id, event.id)
+                errors += 1
+
+        return errors
+
+    @classmethod
+    def get_metrics(cls):
+        """Return statistics about the progress of the dispatcher."""
+        checkpoint = cls._get_checkpoints().find_one(
+            {'_id': cls.CHECKPOINT_NAME}) or {}
+
+        last_event = Event.objects.only('id', 'date').order_by('-id').first()
+        last_event_id = last_event.id if last_event is not None else 0
+        checkpoint_id = checkpoint.get('last_event_id', last_event_id)
+
+        # The lag in seconds is the age of the oldest event that has not
+        # been processed yet
+        next_event = Event.objects.filter(id__gt=checkpoint_id).only(
+            'date').order_by('id').first()
+        if next_event is not None and next_event.date is not None:
+            lag_seconds = (datetime.now() - next_event.date).total_seconds()
+        else:
+            lag_seconds = 0
+
+        return {
+            'last_event_id': last_event_id,
+            'checkpoint': checkpoint_id,
+            'lag_events': max(last_event_id - checkpoint_id, 0),
+            'lag_seconds': max(lag_seconds, 0),
+            'processed': checkpoint.get('processed', 0),
+            'errors': checkpoint.get('errors', 0),
+            'lost': checkpoint.get('lost', 0),
+            'skipped': checkpoint.get('skipped', 0),
+            'updated': checkpoint.get('updated'),
+        }
@@ -0,0 +1,249 @@
+import collections
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+import pymongo
+from pymongo.errors import PyMongoError
+
+from stormcore.apiserver.models import Event
+from stormcore.apiserver.serializers import (
+    EventSerializer, serialize_entities)
+
+
+log = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_hub = None
+
+
+def get_hub():
+    """Return the EventHub for the current process, starting it if needed.
+
+    Gunicorn forks its workers after loading the application: the hub is
+    created lazily so that every worker gets its own poller.
+    """
+    global _hub
+
+    with _lock:
+        if _hub is None or _hub.pid != os.getpid():
+            _hub = EventHub()
+            _hub.start()
+        return _hub
+
+
+class HubItem(collections.namedtuple(
+        'BaseHubItem', 'id event data line cache')):
+    """An event, serialized once for all the clients of the hub."""
+
+    @classmethod
+    def from_event(cls, event):
+        data = EventSerializer(event).data
+        line = json.dumps(data) + '\n'
+        return cls(event.id, event, data, line, {})
+
+    def get_entity(self):
+        """Return the serialized entity of the event (see
+        serialize_entities()). The entity is retrieved at most once, when
+        the first client asks for it.
+        """
+        try:
+            return self.cache['entity']
+        except KeyError:
+            pass
+        entity = serialize_entities([self.event])[self.id]
+        self.cache['entity'] = entity
+        return entity
+
+
+class EventHubClient:
+    """A consumer of the events broadcast by an EventHub.
+
+    Events are delivered through a bounded queue. If the consumer does not
+    keep up with the rate of events, the queue fills up: when that happens
+    the client is dropped by the hub and marked as 'overflowed'. Consumers
+    are expected to drain the events left in the queue and then tell their
+    peer that it has to reconnect.
+    """
+
+    def __init__(self, hub, max_queue_size):
+        self.hub = hub
+        self.overflowed = False
+        self._queue = queue.Queue(max_queue_size)
+
+    def put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.overflowed = True
+            self.hub.unsubscribe(self)
+
+    def get(self, timeout=None):
+        """Return the next event, or None if the timeout expires or if the
+        client has overflowed and the queue has been drained.
+        """
+        if self.overflowed and self._queue.empty():
+            return None
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+
+class EventHub:
+    """Poll the event log and fan out events to all the clients.
+
+    There is one hub per process, and one poller per hub, no matter how
+    many clients are connected. The hub never blocks on clients: events
+    are delivered with non-blocking puts to bounded queues, and clients that
+    fall behind are disconnected.
+
+    Events are delivered in ID order. IDs are allocated before events are
+    inserted, so an event can become visible after events with higher IDs:
+    when the hub sees a gap in IDs, it waits up to GAP_TIMEOUT seconds for
+    the missing events before skipping them.
+
+    The event log is only polled while the hub has clients. Polling starts
+    from the last event existing when the first client subscribes.
+    """
+
+    # Maximum number of events that can be queued for a single client
+    MAX_QUEUE_SIZE = 1024
+
+    # Maximum number of events read with a single query
+    BATCH_SIZE = 1000
+
+    # How long to wait before checking for new events when there are none
+    POLL_INTERVAL = .05
+
+    # How long to wait for the events missing from a gap in IDs
+    GAP_TIMEOUT = 2
+
+    # Time to wait after a database error
+    RETRY_INTERVAL = .05
+
+    def __init__(self, queryset=None):
+        if queryset is None:
+            queryset = Event.objects.all()
+        self.queryset = queryset
+        self.pid = os.getpid()
+        self._clients = set()
+        self._clients_lock = threading.Lock()
+        # Held while polling, so that subscribe() can move the starting
+        # point of the poller
+        self._poll_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._last_event_id = None
+        self._gap_deadline = None
+
+    def _get_last_event_id(self):
+        last_event = self.queryset.only('id').order_by('-id').first()
+        return last_event.id if last_event is not None else -1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def subscribe(self, max_queue_size=None):
+        """Return a new client. Events created after this method returns
+        are guaranteed to be delivered to it.
+        """
+        if max_queue_size is None:
+            max_queue_size = self.MAX_QUEUE_SIZE
+        client = EventHubClient(self, max_queue_size)
+        with self._poll_lock, self._clients_lock:
+            idle = not self._clients
+            if idle:
+                # The hub does not poll while it has no clients: skip the
+                # events created in the meantime
+                self._last_event_id = self._get_last_event_id()
+                self._gap_deadline = None
+            self._clients.add(client)
+        if idle:
+            self._wakeup.set()
+        return client
+
+    def unsubscribe(self, client):
+        with self._clients_lock:
+            self._clients.discard(client)
+
+    def has_clients(self):
+        with self._clients_lock:
+            return bool(self._clients)
+
+    def broadcast(self, item):
+        with self._clients_lock:
+            clients = list(self._clients)
+        for client in clients:
+            client.put(item)
+
+    def _run(self):
+        while True:
+            self._wakeup.clear()
+            if not self.has_clients():
+                # Wait for the first client without polling
+                self._wakeup.wait()
+                continue
+
+            try:
+                with self._poll_lock:
+                    more = self._poll()
+                if more:
+                    continue
+                time.sleep(self.POLL_INTERVAL)
+            except PyMongoError:
+                log.exception('Error while polling events')
+                time.sleep(self.RETRY_INTERVAL)
+
+    def _poll(self):
+        """Broadcast the new events. Return whether there may be more
+        events to read right away.
+        """
+        docs = list(
+            self.queryset._collection
+            .find({'_id': {'$gt': self._last_event_id}})
+            .sort('_id', pymongo.ASCENDING)
+            .limit(self.BATCH_SIZE))
+
+        for doc in docs:
+            if not self._check_gap(doc['_id']):
+                return False
+            event = Event._from_son(doc)
+            self._last_event_id = event.id
+            self.broadcast(HubItem.from_event(event))
+
+        return len(docs) == self.BATCH_SIZE
+
+    def _check_gap(self, event_id):
+        """Return whether the event with the given ID can be broadcast: true
+        if no event is missing before it, or if the missing events did not
+        show up within GAP_TIMEOUT seconds.
+        """
+        if self._last_event_id < 0 or event_id == self._last_event_id + 1:
+            self._gap_deadline = None
+            return True
+
+        now = time.monotonic()
+        if self._gap_deadline is None:
+            self._gap_deadline = now + self.GAP_TIMEOUT
+        if now < self._gap_deadline:
+            return False
+
+        log.warning(
+            'Events %d to %d are missing, skipping them',
+            self._last_event_id + 1, event_id - 1)
+        self._gap_deadline = None
+        return True
@@ -0,0 +1,213 @@
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from mongoengine.connection import get_db
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from stormcore.apiserver.models import (
+    expire_agents, prune_job_results, restore_orphaned_jobs, retire_jobs,
+    trim_events)
+
+
+log = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_service = None
+
+
+def get_maintenance_service():
+    """Return the MaintenanceService for the current process, starting it if
+    needed.
+
+    Like the event hub, the service is created lazily so that every Gunicorn
+    worker gets its own thread.
+    """
+    global _service
+
+    with _lock:
+        if _service is None or _service.pid != os.getpid():
+            _service = MaintenanceService()
+            _service.start()
+        return _service
+
+
+def stop_maintenance_service():
+    """Stop the MaintenanceService of the current process, if running,
+    releasing its lease.
+    """
+    global _service
+
+    with _lock:
+        if _service is not None and _service.pid == os.getpid():
+            _service.stop()
+        _service = None
+
+
+class Lease:
+    """A named lease stored in the 'leases' collection.
+
+    At most one holder can own a lease at any given time. The lease expires
+    after the given duration (in seconds) unless its holder renews it, at
+    which point any other holder can acquire it. This is used to elect a
+    single leader among all the processes sharing the same database, on any
+    host. Expiration times are computed by the holders, so hosts are
+    expected to have synchronized clocks.
+    """
+
+    COLLECTION = 'leases'
+
+    def __init__(self, name, duration, holder=None):
+        if holder is None:
+            holder = '{}:{}:{}'.format(
+                socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+        self.name = name
+        self.duration = timedelta(seconds=duration)
+        self.holder = holder
+
+    def _get_collection(self):
+        return get_db()[self.COLLECTION]
+
+    def acquire(self):
+        """Acquire the lease, or renew it if already held. Return whether
+        the lease is held.
+        """
+        now = datetime.utcnow()
+
+        try:
+            self._get_collection().update_one(
+                {
+                    '_id': self.name,
+                    '$or': [
+                        {'holder': self.holder},
+                        {'expires': {'$lt': now}},
+                    ],
+                },
+                {'$set': {
+                    'holder': self.holder,
+                    'expires': now + self.duration,
+                }},
+                upsert=True)
+        except DuplicateKeyError:
+            # The lease exists and it is held by somebody else: the query
+            # did not match, and the upsert failed
+            return False
+
+        return True
+
+    def release(self):
+        self._get_collection().delete_one(
+            {'_id': self.name, 'holder': self.holder})
+
+
+class MaintenanceService:
+    """Run periodic maintenance tasks in the background.
+
+    Every API server process runs a MaintenanceService, but tasks are run
+    only by the process holding the 'maintenance' lease. If that process
+    dies, another one takes over once the lease expires.
+
+    Tasks are (name, function, interval, batched) tuples. Every task runs
+    at most once every 'interval' seconds. Errors are logged and do not
+    affect the other tasks. The lease is renewed before every task, and
+    batched tasks are called with a 'renew' function that they call between
+    batches: if the lease is lost (or the service is stopping), renew()
+    returns False and the task must stop.
+    """
+
+    LEASE_NAME = 'maintenance'
+    LEASE_DURATION = 30
+
+    # How often the lease is renewed and pending tasks are checked. This
+    # must be well below LEASE_DURATION.
+    POLL_INTERVAL = 1
+
+    TASKS = [
+        ('expire_agents', expire_agents, 5, False),
+        ('restore_orphaned_jobs', restore_orphaned_jobs, 5, False),
+        ('retire_jobs', retire_jobs, 60, True),
+        ('prune_job_results', prune_job_results, 60, False),
+        ('trim_events', trim_events, 60, False),
+    ]
+
+    def __init__(self, tasks=None):
+        if tasks is None:
+            tasks = self.TASKS
+        self.pid = os.getpid()
+        self.lease = Lease(self.LEASE_NAME, self.LEASE_DURATION)
+        self.tasks = list(tasks)
+        self._next_run = {}
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        try:
+            self.lease.release()
+        except PyMongoError:
+            log.exception('Error while releasing the maintenance lease')
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                if self.lease.acquire():
+                    self.run_pending()
+                else:
+                    # If this process becomes the leader later on, all the
+                    # tasks will run right away
+                    self._next_run.clear()
+            except PyMongoError:
+                log.exception('Error while acquiring the maintenance lease')
+            self._stop_event.wait(self.POLL_INTERVAL)
+
+    def renew(self):
+        """Renew the lease. Return False if the lease was lost or if the
+        service is stopping, in which case no task must be run.
+        """
+        if self._stop_event.is_set():
+            return False
+
+        try:
+            held = self.lease.acquire()
+        except PyMongoError:
+            log.exception('Error while renewing the maintenance lease')
+            held = False
+
+        if not held:
+            log.warning('Lost the maintenance lease')
+            self._next_run.clear()
+
+        return held
+
+    def run_pending(self):
+        """Run the tasks that are due, as long as the lease is held."""
+        for name, func, interval, batched in self.tasks:
+            now = time.monotonic()
+            if self._next_run.get(name, now) > now:
+                continue
+
+            # Tasks can take a while: make sure that the lease is still
+            # held before running each of them
+            if not self.renew():
+                return
+
+            self._next_run[name] = now + interval
+
+            try:
+                if batched:
+                    func(renew=self.renew)
+                else:
+                    func()
+            except Exception:
+                log.exception('Error while running maintenance task %r', name)
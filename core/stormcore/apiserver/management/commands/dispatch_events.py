@@ -0,0 +1,33 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from stormcore.apiserver.dispatcher import EventDispatcher
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Dispatch the events of the event log to subscriptions, until '
+        'SIGTERM or SIGINT is received.')
+
+    def handle(self, *args, **options):
+        stop_event = threading.Event()
+
+        def stop(signum, frame):
+            stop_event.set()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        dispatcher = EventDispatcher()
+        dispatcher.start()
+        try:
+            # Wait with a timeout, so that signals are handled promptly
+            while not stop_event.wait(1):
+                pass
+        finally:
+            # Releases the lease, so that another dispatcher can take over
+            # right away
+            dispatcher.stop()
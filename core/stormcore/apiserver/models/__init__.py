@@ -1,6 +1,8 @@
 from stormcore.apiserver.models.base import (
     AutoIncrementField,
     EscapedDictField,
+    LazyStormReference,
+    LazyStormReferenceField,
     NameMixin,
     StormDocument,
     StormIdField,
@@ -13,13 +15,17 @@ from stormcore.apiserver.models.base import (
     user_query_filter,
 )
 
-from stormcore.apiserver.models.agents import Agent, cleanup_expired_agents
-from stormcore.apiserver.models.events import Event
+from stormcore.apiserver.models.agents import Agent, expire_agents
+from stormcore.apiserver.models.events import Event, trim_events
 from stormcore.apiserver.models.groups import (
     Group, Service, ServiceReference, ComponentLink, Application)
 from stormcore.apiserver.models.procedures import (
-    Procedure, Subscription, Job)
+    Procedure, Subscription, Job, JobOutput, archive_jobs, delete_jobs,
+    load_archived_job, prune_job_results, restore_orphaned_jobs,
+    retire_jobs)
 from stormcore.apiserver.models.resources import Resource
+from stormcore.apiserver.models.matching import (
+    SubscriptionMatcher, subscription_matcher)
 
 
 __all__ = [
@@ -31,6 +37,9 @@ __all__ = [
     'Event',
     'Group',
     'Job',
+    'JobOutput',
+    'LazyStormReference',
+    'LazyStormReferenceField',
     'NameMixin',
     'Procedure',
     'Resource',
@@ -41,10 +50,19 @@ __all__ = [
     'StormQuerySet',
     'StormReferenceField',
     'Subscription',
+    'SubscriptionMatcher',
     'TypeMixin',
+    'archive_jobs',
     'b62uuid_encode',
     'b62uuid_new',
-    'cleanup_expired_agents',
+    'delete_jobs',
+    'expire_agents',
+    'load_archived_job',
     'prepare_user_query',
+    'prune_job_results',
+    'restore_orphaned_jobs',
+    'retire_jobs',
+    'subscription_matcher',
+    'trim_events',
     'user_query_filter',
 ]
@@ -1,4 +1,3 @@
-import time
 from datetime import datetime, timedelta
 
 from mongoengine import DateTimeField, StringField
@@ -7,17 +6,9 @@ from stormcore.apiserver.models.base import (
     StormDocument, TypeMixin, NameMixin, StormQuerySet, EscapedDictField)
 
 
-CLEANUP_INTERVAL = 1
-CLEANUP_TIMESTAMP = 0
-
-
-def cleanup_expired_agents():
-    global CLEANUP_TIMESTAMP
-    now = time.time()
-    if now - CLEANUP_TIMESTAMP < CLEANUP_INTERVAL:
-        return
-    Agent.objects.expired().update(status='offline')
-    CLEANUP_TIMESTAMP = time.time()
+def expire_agents():
+    """Mark the agents that stopped sending heartbeats as offline."""
+    Agent.objects.expired().filter(status__ne='offline').set_status('offline')
 
 
 class AgentQuerySet(StormQuerySet):
@@ -26,6 +17,36 @@ class AgentQuerySet(StormQuerySet):
         threshold = datetime.now() - Agent.HEARTBEAT_DURATION
         return self.filter(heartbeat__lt=threshold)
 
+    def set_status(self, status, **kwargs):
+        """Atomically set the status of the agents in this queryset.
+
+        Additional fields to set can be passed as keyword arguments. Unlike
+        save(), this does not send any signals: an 'updated' event is
+        recorded only for the agents whose status actually changes. Return
+        the number of agents matched.
+        """
+        from stormcore.apiserver.models.events import Event
+
+        updates = {'set__' + key: value for key, value in kwargs.items()}
+        updates['set__status'] = status
+
+        # Status transitions are rare: update the agents that are changing
+        # status one by one, so that each transition is recorded once even
+        # if concurrent requests are updating the same agents
+        for agent_id in self.filter(status__ne=status).scalar('id'):
+            agent = self.filter(id=agent_id, status__ne=status).modify(
+                new=True, **updates)
+            if agent is not None:
+                Event.objects.record_event('updated', agent)
+
+        return self.update(**updates)
+
+    def record_heartbeat(self):
+        """Refresh the heartbeat of the agents in this queryset and mark them
+        online.
+        """
+        return self.set_status('online', heartbeat=datetime.now())
+
 
 class Agent(NameMixin, TypeMixin, StormDocument):
 
@@ -47,3 +68,13 @@ class Agent(NameMixin, TypeMixin, StormDocument):
         'queryset_class': AgentQuerySet,
         'indexes': ['heartbeat'],
     }
+
+    def get_max_concurrent_jobs(self):
+        """Return how many jobs the agent can run at the same time, as
+        declared with the 'maxConcurrentJobs' option, or None if there is no
+        limit.
+        """
+        limit = self.options.get('maxConcurrentJobs')
+        if not isinstance(limit, int) or isinstance(limit, bool):
+            return None
+        return max(limit, 0)
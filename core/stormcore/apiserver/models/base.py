@@ -1,8 +1,12 @@
 import copy
 import functools
 import re
+import threading
 import uuid
 
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
 from mongoengine import Document, QuerySet, IntField, StringField, CASCADE
 from mongoengine.base import get_document
 from mongoengine.base.metaclasses import MetaDict
@@ -178,10 +182,11 @@ class StormReferenceField(BaseField):
     """
     This is a ReferenceField-like field capable of referencing objects
     with multiple lookup fields.
-    """
 
-    # TODO Consider creating a lazy version of this class, in a way
-    # TODO similar to LazyReferenceField.
+    The referenced document is looked up the first time the field is
+    accessed. See LazyStormReferenceField for a version of this field that
+    does not query the database on access.
+    """
 
     def __init__(self, document_type, reverse_delete_rule=CASCADE, **kwargs):
         self._document_type = document_type
@@ -210,7 +215,7 @@ class StormReferenceField(BaseField):
         return super().__get__(instance, owner)
 
     def to_mongo(self, value):
-        if isinstance(value, Document):
+        if isinstance(value, (Document, LazyStormReference)):
             value = value.id
         return value
 
@@ -219,39 +224,215 @@ class StormReferenceField(BaseField):
         return self.to_mongo(value)
 
 
+class LazyStormReference:
+    """A reference to a document that is not looked up until fetch() is
+    called.
+
+    The ID of the referenced document is available without any query.
+    References compare equal to other references, documents and IDs
+    pointing to the same document.
+    """
+
+    def __init__(self, document_type, value, document=None):
+        self.document_type = document_type
+        self._value = value
+        self._document = document
+
+    @property
+    def id(self):
+        return self._value
+
+    pk = id
+
+    def fetch(self, force=False):
+        """Return the referenced document, looking it up if needed.
+
+        DoesNotExist is raised if the document no longer exists.
+        """
+        if self._document is None or force:
+            self._document = self.document_type.objects.lookup(self._value)
+        return self._document
+
+    def __eq__(self, other):
+        if isinstance(other, (LazyStormReference, Document)):
+            return self.id == other.id
+        if isinstance(other, str):
+            return self.id == other
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __str__(self):
+        return str(self.id)
+
+    def __repr__(self):
+        return '<{} {}: {}>'.format(
+            type(self).__name__, self.document_type.__name__, self.id)
+
+
+class LazyStormReferenceField(StormReferenceField):
+    """
+    A StormReferenceField that returns LazyStormReference objects instead of
+    documents. Accessing the field does not query the database: the
+    referenced document is looked up only by LazyStormReference.fetch().
+    """
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        value = instance._data.get(self.name)
+
+        if isinstance(value, Document):
+            value = LazyStormReference(self.document_type, value.id, value)
+            instance._data[self.name] = value
+        elif value is not None and not isinstance(value, LazyStormReference):
+            value = LazyStormReference(self.document_type, value)
+            instance._data[self.name] = value
+
+        return value
+
+
+class IdAllocator:
+    """Allocate integer IDs from a counter stored in the 'counters' collection.
+
+    IDs are allocated with an atomic $inc, which makes them unique across
+    processes and hosts, and increasing in the order of allocation. Before
+    the first allocation, the counter is raised to the highest ID already
+    stored, so that allocation continues after documents that were
+    inserted or migrated without going through the counter.
+    """
+
+    COUNTERS_COLLECTION = 'counters'
+
+    def __init__(self, document, counter_name):
+        self.document = document
+        self.counter_name = counter_name
+        self._lock = threading.Lock()
+        self._initialized = False
+
+    def _counters(self):
+        return self.document._get_db()[self.COUNTERS_COLLECTION]
+
+    def _initialize(self):
+        last = self.document._get_collection().find_one(
+            {}, projection={'_id': True}, sort=[('_id', -1)])
+        if last is not None:
+            try:
+                self._counters().update_one(
+                    {'_id': self.counter_name},
+                    {'$max': {'count': int(last['_id'])}},
+                    upsert=True)
+            except DuplicateKeyError:
+                # Another process created the counter concurrently: the
+                # update can now match it
+                self._counters().update_one(
+                    {'_id': self.counter_name},
+                    {'$max': {'count': int(last['_id'])}})
+        self._initialized = True
+
+    def allocate(self):
+        if not self._initialized:
+            with self._lock:
+                if not self._initialized:
+                    self._initialize()
+
+        result = self._counters().find_one_and_update(
+            {'_id': self.counter_name},
+            {'$inc': {'count': 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER)
+        return int(result['count'])
+
+
 class AutoIncrementField(IntField):
 
     _auto_gen = True
 
-    COUNTER_INCREMENT = """\
-        function() {
-            db.counters.findAndModify({
-                query: { _id: options.counter_name },
-                update: {
-                    $setOnInsert: { count: 1 }
-                },
-                upsert: true
-            });
-
-            return db.counters.findAndModify({
-                query: { _id: options.counter_name },
-                update: {
-                    $inc: { count: 1 },
-                },
-                new: true
-            });
-        }
-    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._allocator = None
 
     def generate(self):
-        counter_name = self.owner_document.__name__.lower()
-        result = self.owner_document.objects.exec_js(
-            self.COUNTER_INCREMENT, counter_name=counter_name)
-        return int(result['count'])
+        if self._allocator is None:
+            self._allocator = IdAllocator(
+                self.owner_document,
+                self.owner_document.__name__.lower())
+        return self._allocator.allocate()
 
 
 class StormQuerySet(QuerySet):
 
+    # Names of the StormReferenceFields to resolve in batch, see
+    # prefetch_references()
+    _prefetch_fields = ()
+
+    def prefetch_references(self, *fields):
+        """Resolve references with a batched query.
+
+        By default, StormReferenceFields look up the referenced document
+        the first time they are accessed, which makes one query for every
+        reference of every document. With this queryset, references are
+        resolved while the results are fetched, with one query for every
+        field and every chunk of results.
+
+        If no field names are given, all the StormReferenceFields of the
+        document are resolved, except LazyStormReferenceFields (which are
+        resolved only if explicitly named). For those, only the IDs are
+        looked up: fetch() still queries the referenced document.
+        """
+        if not fields:
+            fields = tuple(
+                name for name, field in self._document._fields.items()
+                if isinstance(field, StormReferenceField) and
+                not isinstance(field, LazyStormReferenceField))
+
+        queryset = self.clone()
+        queryset._prefetch_fields = fields
+        return queryset
+
+    def _clone_into(self, new_qs):
+        new_qs = super()._clone_into(new_qs)
+        new_qs._prefetch_fields = self._prefetch_fields
+        return new_qs
+
+    def _populate_cache(self):
+        start = len(self._result_cache) if self._result_cache else 0
+        super()._populate_cache()
+        if self._prefetch_fields and self._result_cache:
+            self._prefetch(self._result_cache[start:])
+
+    def _prefetch(self, documents):
+        for name in self._prefetch_fields:
+            field = self._document._fields[name]
+
+            values = {
+                document._data.get(name) for document in documents}
+            values = {
+                value for value in values
+                if value is not None and
+                not isinstance(value, (Document, LazyStormReference))}
+
+            if not values:
+                continue
+
+            lazy = isinstance(field, LazyStormReferenceField)
+            resolved = _resolve_references(
+                field.document_type, values, only_lookup_fields=lazy)
+
+            for document in documents:
+                value = document._data.get(name)
+                if value in values:
+                    # Like StormReferenceField.__get__() does, references
+                    # that cannot be resolved are replaced with None
+                    target = resolved.get(value)
+                    if lazy and target is not None:
+                        # The document is partial: keep only its ID
+                        target = LazyStormReference(
+                            field.document_type, target.id)
+                    document._data[name] = target
+
     def lookup(self, value):
         lookup_fields = self._document._meta['lookup_fields']
 
@@ -267,6 +448,42 @@ class StormQuerySet(QuerySet):
         return self.get(query)
 
 
+def _resolve_references(document_type, values, only_lookup_fields=False):
+    """Look up the documents referenced by the given values. Return a
+    dictionary mapping values to documents. Values that do not match
+    exactly one document are left out.
+
+    If 'only_lookup_fields' is true, only the ID and the lookup fields of
+    the documents are loaded.
+    """
+    lookup_fields = document_type._meta['lookup_fields']
+
+    query = Q()
+    for key in lookup_fields:
+        query |= Q(**{key + '__in': list(values)})
+
+    queryset = document_type.objects(query)
+    if only_lookup_fields:
+        queryset = queryset.only('id', *lookup_fields)
+
+    matches = {}
+
+    for document in queryset:
+        for key in lookup_fields:
+            field_value = getattr(document, key)
+            if not isinstance(field_value, list):
+                field_value = [field_value]
+            for item in field_value:
+                if item in values:
+                    matches.setdefault(item, set()).add(document)
+
+    return {
+        value: documents.pop()
+        for value, documents in matches.items()
+        if len(documents) == 1
+    }
+
+
 class StormDocument(Document):
 
     id = StormIdField(primary_key=True, required=True, null=False)
@@ -1,17 +1,25 @@
-from datetime import datetime
+import zlib
+from datetime import datetime, timedelta
 
+from bson import BSON
+from django.conf import settings
 from mongoengine import (
-    Document, QuerySet, StringField, DateTimeField, ListField, signals)
+    BinaryField, Document, QuerySet, StringField, DateTimeField, ListField,
+    signals)
 
 from stormcore.apiserver.models.base import (
-    StormDocument, NameMixin, AutoIncrementField)
-from stormcore.apiserver.models.procedures import Subscription
+    StormDocument, NameMixin, AutoIncrementField, IdAllocator)
 from stormcore.apiserver.models.resources import Resource
 
 
 class EventQuerySet(QuerySet):
 
     def record_event(self, event_type, obj):
+        """Append an event to the event log.
+
+        Subscriptions are not evaluated here: events are dispatched to
+        subscriptions in the background, see EventDispatcher.
+        """
         if not isinstance(obj, StormDocument):
             return
 
@@ -29,15 +37,44 @@ class EventQuerySet(QuerySet):
             entity_names=names,
         )
 
+        if event_type == 'deleted':
+            # The document is gone: keep its last state, so that it can be
+            # sent to clients along with the event
+            ev.entity_state = zlib.compress(BSON.encode(obj.to_mongo()))
+
         ev.save()
-        Subscription.objects.exec_for_event(ev)
 
         return ev
 
+    def oldest_event_id(self):
+        """Return the ID of the oldest event that was retained: all the
+        events before it were deleted from the log (see trim_events()).
+        Return None if the event log is empty and was never trimmed.
+        """
+        first_event = self.only('id').order_by('id').first()
+        trimmed_event_id = last_trimmed_event_id()
+
+        if trimmed_event_id is None:
+            return first_event.id if first_event is not None else None
+        if first_event is None:
+            # Even if everything was trimmed, clients resuming from the
+            # deleted events have to know that they were lost
+            return trimmed_event_id + 1
+        return max(first_event.id, trimmed_event_id + 1)
+
+    def last_event_id(self):
+        last_event = self.only('id').order_by('-id').first()
+        return last_event.id if last_event is not None else None
+
 
 class Event(Document):
+    """An entry of the event log.
 
-    MAX_EVENTS = 10000
+    Events are retained according to the EVENT_RETENTION and
+    EVENT_MAX_COUNT settings (see trim_events()). IDs are allocated
+    sequentially, starting from 1: a gap before the oldest event means
+    that events were removed from the log.
+    """
 
     EVENT_TYPE_CHOICES = [
         'created',
@@ -53,13 +90,81 @@ class Event(Document):
     entity_id = StringField(required=True)
     entity_names = ListField(StringField())
 
+    # Last state of deleted entities, as zlib-compressed BSON
+    entity_state = BinaryField(null=True)
+
     meta = {
+        # The event log used to be the capped 'event' collection, which
+        # cannot be trimmed by date. That collection is no longer used and
+        # can be dropped (see README). IDs share the 'event' counter, so
+        # they carry on from the events of the old collection.
+        'collection': 'event_log',
         'queryset_class': EventQuerySet,
+        'indexes': ['date'],
         'ordering': ['id'],
-        'max_documents': MAX_EVENTS,
-        'max_size': 8 * 1024 * MAX_EVENTS,
     }
 
+    def get_entity_state(self):
+        """Return the last state of the deleted entity, as a dict, or None
+        if it was not recorded."""
+        if self.entity_state is None:
+            return None
+        return BSON(zlib.decompress(self.entity_state)).decode()
+
+
+TRIMMED_EVENTS_COUNTER = 'eventtrim'
+
+
+def _get_counters():
+    return Event._get_db()[IdAllocator.COUNTERS_COLLECTION]
+
+
+def last_trimmed_event_id():
+    """Return the highest ID of the events deleted by trim_events(), or None
+    if no events were ever deleted.
+    """
+    doc = _get_counters().find_one({'_id': TRIMMED_EVENTS_COUNTER})
+    return doc['count'] if doc is not None else None
+
+
+def _trim_events_up_to(event_id):
+    # Record the ID first: if deleting fails, clients may be asked to resync
+    # for nothing, but they never miss events silently
+    _get_counters().update_one(
+        {'_id': TRIMMED_EVENTS_COUNTER},
+        {'$max': {'count': event_id}},
+        upsert=True)
+    Event._get_collection().delete_many({'_id': {'$lte': event_id}})
+
+
+def trim_events():
+    """Delete the events that are older than the EVENT_RETENTION setting
+    (in seconds), and the oldest events beyond the EVENT_MAX_COUNT
+    setting.
+
+    Events are always deleted up to an ID, which is recorded: see
+    oldest_event_id().
+    """
+    collection = Event._get_collection()
+
+    if settings.EVENT_RETENTION is not None:
+        threshold = datetime.now() - timedelta(
+            seconds=settings.EVENT_RETENTION)
+        # Events are saved in about the same order as their IDs are
+        # allocated: delete up to the highest ID of the expired ones
+        newest = list(
+            collection.find({'date': {'$lt': threshold}}, {'_id': 1})
+            .sort('_id', -1)
+            .limit(1))
+        if newest:
+            _trim_events_up_to(newest[0]['_id'])
+
+    if settings.EVENT_MAX_COUNT is not None:
+        last_event_id = Event.objects.last_event_id()
+        if last_event_id is not None and \
+                last_event_id > settings.EVENT_MAX_COUNT:
+            _trim_events_up_to(last_event_id - settings.EVENT_MAX_COUNT)
+
 
 def record_save(sender, document, created=False, **kwargs):
     event_type = 'created' if created else 'updated'
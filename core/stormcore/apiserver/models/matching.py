@@ -0,0 +1,209 @@
+import collections
+import copy
+import numbers
+import threading
+
+from mongoengine import Document, signals
+from stormlib.query import (
+    UnsupportedQuery, candidates, compile_query, resolve)
+
+from stormcore.apiserver.models.base import IdAllocator, prepare_user_query
+from stormcore.apiserver.models.groups import Group
+from stormcore.apiserver.models.procedures import Subscription
+from stormcore.apiserver.models.resources import Resource
+
+
+def _hashable(value):
+    return isinstance(value, (str, numbers.Number)) or value is None
+
+
+class CompiledGroup:
+    """In-memory representation of the membership rules of a Group."""
+
+    # Fields preferred for indexing groups, in order of preference
+    PREFERRED_INDEX_FIELDS = ('type', 'owner', 'names', 'parent', 'cluster')
+
+    def __init__(self, group):
+        self.group = group
+
+        query = copy.deepcopy(group.query)
+        prepare_user_query(Resource, query)
+
+        self.query = query
+        self.include = frozenset(_reference_id(item) for item in group.include)
+        self.exclude = frozenset(_reference_id(item) for item in group.exclude)
+
+        try:
+            self._predicate = compile_query(query) if query else None
+        except UnsupportedQuery:
+            # Fall back to asking MongoDB
+            self._predicate = self._query_database
+
+        self.index_key = self._get_index_key()
+
+    @property
+    def has_query(self):
+        return self._predicate is not None
+
+    def _get_index_key(self):
+        """Return a (field, value) pair that every member matching the
+        query is guaranteed to have, or None.
+        """
+        if not self.has_query:
+            return None
+
+        fields = {
+            key: value for key, value in self.query.items()
+            if not key.startswith('$') and _hashable(value) and
+            value is not None
+        }
+
+        for key in self.PREFERRED_INDEX_FIELDS:
+            if key in fields:
+                return key, fields[key]
+        for key, value in fields.items():
+            return key, value
+
+        return None
+
+    def _query_database(self, document):
+        return bool(Resource.objects(__raw__=self.query).filter(
+            id=document['_id']).only('id'))
+
+    def matches(self, document):
+        document_id = document.get('_id')
+        if document_id in self.exclude:
+            return False
+        if document_id in self.include:
+            return True
+        if not self.has_query:
+            return False
+        return self._predicate(document)
+
+
+def _reference_id(value):
+    if isinstance(value, Document):
+        return value.id
+    return value
+
+
+class SubscriptionMatcher:
+    """Find the subscriptions triggered by a change to a resource.
+
+    Group queries are compiled into Python predicates and evaluated against
+    the changed resource in memory. Groups are indexed by one of the fields
+    their query tests for equality, so that only the groups that can
+    possibly match a resource are evaluated.
+
+    The compiled state is rebuilt whenever a Group or a Subscription is
+    changed. Changes are tracked with a counter stored in the database, so
+    that changes made by other processes are detected too.
+    """
+
+    VERSION_COUNTER = 'subscriptionmatcher'
+
+    State = collections.namedtuple(
+        'State', 'version index index_fields unindexed subscriptions')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = None
+
+    @classmethod
+    def _counters(cls):
+        return Subscription._get_db()[IdAllocator.COUNTERS_COLLECTION]
+
+    @classmethod
+    def invalidate(cls):
+        cls._counters().update_one(
+            {'_id': cls.VERSION_COUNTER},
+            {'$inc': {'count': 1}},
+            upsert=True)
+
+    def _current_version(self):
+        doc = self._counters().find_one({'_id': self.VERSION_COUNTER})
+        return doc['count'] if doc is not None else 0
+
+    def _build(self, version):
+        subscriptions = collections.defaultdict(list)
+
+        # Subscriptions are kept in their raw form: a new Subscription object
+        # is created for every match, so that no state is shared between
+        # callers
+        for son in Subscription.objects.as_pymongo():
+            subscriptions[son.get('group')].append(son)
+
+        index = collections.defaultdict(list)
+        unindexed = []
+
+        for group in Group.objects.filter(id__in=list(subscriptions)):
+            compiled_group = CompiledGroup(group)
+
+            for resource_id in compiled_group.include:
+                index['_id', resource_id].append(compiled_group)
+
+            if compiled_group.index_key is not None:
+                index[compiled_group.index_key].append(compiled_group)
+            elif compiled_group.has_query:
+                unindexed.append(compiled_group)
+
+        return self.State(
+            version=version,
+            index=dict(index),
+            index_fields={field for field, value in index},
+            unindexed=unindexed,
+            subscriptions=dict(subscriptions),
+        )
+
+    def get_state(self):
+        version = self._current_version()
+
+        with self._lock:
+            if self._state is None or self._state.version != version:
+                self._state = self._build(version)
+            return self._state
+
+    def _candidate_groups(self, state, document):
+        groups = {}
+
+        for field in state.index_fields:
+            values = resolve(document, field)
+            for value in candidates(values):
+                if not _hashable(value):
+                    continue
+                for compiled_group in state.index.get((field, value), ()):
+                    groups[compiled_group.group.id] = compiled_group
+
+        for compiled_group in state.unindexed:
+            groups[compiled_group.group.id] = compiled_group
+
+        return groups.values()
+
+    def match(self, document):
+        """Return the subscriptions whose group contains the given Resource
+        document.
+        """
+        state = self.get_state()
+        son = document.to_mongo().to_dict()
+        subscriptions = []
+
+        for compiled_group in self._candidate_groups(state, son):
+            if compiled_group.matches(son):
+                subscriptions.extend(
+                    Subscription._from_son(item)
+                    for item in state.subscriptions[compiled_group.group.id])
+
+        return subscriptions
+
+
+subscription_matcher = SubscriptionMatcher()
+
+
+def invalidate_subscription_matcher(sender, document, **kwargs):
+    SubscriptionMatcher.invalidate()
+
+
+for _sender in (Group, Subscription):
+    signals.post_save.connect(invalidate_subscription_matcher, sender=_sender)
+    signals.post_delete.connect(
+        invalidate_subscription_matcher, sender=_sender)
@@ -1,16 +1,29 @@
-import collections
-from datetime import datetime
-
-from mongoengine import StringField, DateTimeField, signals
+import json
+import zlib
+from datetime import datetime, timedelta
+
+from bson import BSON, Binary
+from django.conf import settings
+from mongoengine import (
+    BooleanField, DateTimeField, Document, IntField, QuerySet, StringField,
+    signals)
+from mongoengine.connection import get_db
+from mongoengine.queryset import Q
+from pymongo import ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError
 
 from stormcore.apiserver.models.agents import Agent
 from stormcore.apiserver.models.base import (
     StormDocument, StormQuerySet, TypeMixin, NameMixin,
-    StormReferenceField, EscapedDictField)
+    LazyStormReferenceField, EscapedDictField, IdAllocator)
 from stormcore.apiserver.models.groups import Group
 from stormcore.apiserver.models.resources import Resource
 
 
+JOB_ARCHIVE_COLLECTION = 'job_archive'
+JOB_QUEUE_COLLECTION = 'job_queues'
+
+
 class Procedure(NameMixin, TypeMixin, StormDocument):
 
     content = StringField(required=True, default='')
@@ -21,13 +34,18 @@ class Procedure(NameMixin, TypeMixin, StormDocument):
         'id_prefix': 'prc-',
     }
 
-    def exec(self, target, options=None, params=None):
+    def exec(self, target, options=None, params=None, priority=None,
+             queue=None):
         from stormcore.apiserver import templates
 
         if params is None:
             params = {}
         if options is None:
             options = {}
+        if priority is None:
+            priority = Job.DEFAULT_PRIORITY
+        if queue is None:
+            queue = 'procedure:{}'.format(self.id)
 
         merged_options = {**self.options, **options}
         merged_params = {**self.params, **params}
@@ -42,6 +60,8 @@ class Procedure(NameMixin, TypeMixin, StormDocument):
             content=rendered_content,
             options=merged_options,
             params=merged_params,
+            priority=priority,
+            queue=queue,
         )
 
         job.save()
@@ -50,39 +70,66 @@ class Procedure(NameMixin, TypeMixin, StormDocument):
 
 class SubscriptionQuerySet(StormQuerySet):
 
-    def exec_for_event(self, event):
-        for subscription in self.iter_for_event(event):
+    def exec_for_event(self, event, document=None):
+        for subscription in self.iter_for_event(event, document):
             subscription.exec(event)
 
-    def iter_for_event(self, event):
-        group_map = collections.defaultdict(list)
-
-        for subscription in self:
-            if subscription.group is None:
-                # Dangling reference
+    def iter_for_event(self, event, document=None):
+        """Return the subscriptions triggered by the given event.
+
+        If the document the event refers to is not given, it is fetched from
+        the database.
+        """
+        from stormcore.apiserver.models.matching import subscription_matcher
+
+        # Only resources can be members of groups. Deleted resources are no
+        # longer members of any group.
+        if event.entity_type != 'resource' or event.event_type == 'deleted':
+            return
+
+        if document is None:
+            document = Resource.objects.filter(id=event.entity_id).first()
+            if document is None:
+                return
+
+        for subscription in subscription_matcher.match(document):
+            # Events are dispatched asynchronously: subscriptions must not be
+            # triggered by events that happened before they were created
+            if subscription.created is not None and \
+                    event.date is not None and \
+                    event.date < subscription.created:
                 continue
-            group_map[subscription.group.id].append(subscription)
-
-        for sub_list in group_map.values():
-            group = sub_list[0].group
-            if group.members().filter(id=event.entity_id):
-                yield from sub_list
+            yield subscription
 
 
 class Subscription(StormDocument):
 
-    group = StormReferenceField(Group)
-    procedure = StormReferenceField(Procedure)
+    group = LazyStormReferenceField(Group)
+    procedure = LazyStormReferenceField(Procedure)
 
-    target = StormReferenceField(Resource)
+    target = LazyStormReferenceField(Resource)
     options = EscapedDictField()
     params = EscapedDictField()
 
+    # Scheduling of the jobs created by the subscription. By default, all
+    # the subscriptions of a group share the same queue.
+    priority = IntField(null=True)
+    queue = StringField(null=True)
+
+    # Not a default: subscriptions created before this field was introduced
+    # must not get a creation date when loaded
+    created = DateTimeField(null=True)
+
     meta = {
         'id_prefix': 'sub-',
         'queryset_class': SubscriptionQuerySet,
     }
 
+    def save(self, *args, **kwargs):
+        if self.created is None:
+            self.created = datetime.now()
+        return super().save(*args, **kwargs)
+
     def exec(self, event):
         params = self.params
         if 'event' not in params:
@@ -90,13 +137,255 @@ class Subscription(StormDocument):
             params = self.params.copy()
             params['event'] = templates.JinjaEvents()._serialize(event)
 
-        return self.procedure.exec(
-            target=self.target,
+        queue = self.queue
+        if queue is None:
+            queue = 'group:{}'.format(self.group.id)
+
+        return self.procedure.fetch().exec(
+            target=self.target.fetch(),
             options=self.options,
             params=params,
+            priority=self.priority,
+            queue=queue,
         )
 
 
+class JobQuerySet(StormQuerySet):
+
+    # How many times claim_one() looks for another job when the one it
+    # picked is claimed by somebody else first
+    CLAIM_ATTEMPTS = 5
+
+    def claim(self, owner, count=1):
+        """Atomically set up to 'count' pending jobs from this queryset to
+        'running', with the given owner. Return the claimed jobs.
+        """
+        jobs = []
+        while len(jobs) < count:
+            job = self.claim_one(owner)
+            if job is None:
+                break
+            jobs.append(job)
+        return jobs
+
+    def claim_one(self, owner):
+        """Claim the next pending job, or return None if there is none.
+
+        Jobs with the highest priority go first. Among jobs with the same
+        priority, queues are served by weighted fair queueing: every queue
+        has a virtual time, which advances by 1/weight every time one of its
+        jobs is claimed, and the queue with the lowest virtual time goes
+        first. Jobs in the same queue are claimed oldest first.
+
+        Jobs created before priorities were introduced have no priority:
+        they are claimed like jobs with the default priority.
+        """
+        pending = self.filter(status='pending')
+
+        for attempt in range(self.CLAIM_ATTEMPTS):
+            priority = self._top_priority(pending)
+            if priority is None:
+                return None
+
+            if priority == Job.DEFAULT_PRIORITY:
+                candidates = pending.filter(
+                    Q(priority=priority) | Q(priority=None))
+            else:
+                candidates = pending.filter(priority=priority)
+
+            # Jobs created before queues were introduced have no queue:
+            # filtering on None matches those jobs
+            queues = [
+                item['_id'] for item in
+                candidates.aggregate({'$group': {'_id': '$queue'}})]
+
+            ordered = JobQueues.order(queues)
+
+            for queue in [item[0] for item in ordered]:
+                # modify() is atomic: no job can be claimed twice
+                job = candidates.filter(queue=queue).order_by(
+                    'created').modify(
+                        new=True,
+                        set__status='running',
+                        set__owner=owner,
+                        set__started=datetime.now())
+                if job is not None:
+                    JobQueues.charge(queue, ordered)
+                    return job
+
+        return None
+
+    def _top_priority(self, pending):
+        """Return the highest priority among the given pending jobs, or None
+        if there are no jobs.
+        """
+        # Raw documents, so that jobs without a priority are not given the
+        # default value of the field
+        top = pending.filter(priority__ne=None).order_by('-priority').only(
+            'priority').as_pymongo().first()
+        priority = top['priority'] if top is not None else None
+
+        if priority is None or priority < Job.DEFAULT_PRIORITY:
+            if pending.filter(priority=None).only('id').first() is not None:
+                return Job.DEFAULT_PRIORITY
+
+        return priority
+
+    def get_queue_metrics(self):
+        """Return the number of pending and running jobs in every queue,
+        and how long the oldest pending job has been waiting.
+        """
+        now = datetime.now()
+        metrics = {}
+
+        results = self._collection.aggregate([
+            {'$match': {'status': {'$in': ['pending', 'running']}}},
+            {'$group': {
+                '_id': {'queue': '$queue', 'status': '$status'},
+                'count': {'$sum': 1},
+                'oldest': {'$min': '$created'},
+            }},
+        ])
+
+        for item in results:
+            queue = JobQueues.key(item['_id'].get('queue'))
+            status = item['_id']['status']
+            queue_metrics = metrics.setdefault(queue, {
+                'pending': 0,
+                'running': 0,
+                'wait_seconds': 0,
+            })
+            queue_metrics[status] = item['count']
+            if status == 'pending' and item['oldest'] is not None:
+                queue_metrics['wait_seconds'] = max(
+                    (now - item['oldest']).total_seconds(), 0)
+
+        for queue, virtual_time in JobQueues.get_virtual_times(metrics):
+            metrics[queue]['virtual_time'] = virtual_time
+
+        return metrics
+
+
+class JobQueues:
+    """Virtual times of the job queues, used for fair queueing.
+
+    Virtual times are stored in the 'job_queues' collection. Queues have a
+    weight (1 by default) configured with the JOB_QUEUE_WEIGHTS setting,
+    either for the full queue name ('group:grp-XXX') or for its kind
+    ('group').
+
+    The system virtual time, stored in the 'counters' collection, is the
+    virtual time of the last queue charged: the lowest virtual time of the
+    queues that had pending jobs at that moment. Queues that were idle are
+    brought up to it when they have jobs again, so that they do not get to
+    claim all their jobs before the queues that stayed busy.
+    """
+
+    DEFAULT_QUEUE = 'default'
+
+    CLOCK_COUNTER = 'jobqueues'
+
+    @classmethod
+    def _get_collection(cls):
+        return get_db()[JOB_QUEUE_COLLECTION]
+
+    @classmethod
+    def _counters(cls):
+        return get_db()[IdAllocator.COUNTERS_COLLECTION]
+
+    @classmethod
+    def get_system_time(cls):
+        doc = cls._counters().find_one({'_id': cls.CLOCK_COUNTER})
+        return doc['count'] if doc is not None else 0
+
+    @classmethod
+    def key(cls, queue):
+        # Jobs created before queues were introduced have no queue
+        return queue if queue is not None else cls.DEFAULT_QUEUE
+
+    @classmethod
+    def get_weight(cls, queue):
+        weights = settings.JOB_QUEUE_WEIGHTS
+        key = cls.key(queue)
+        if key in weights:
+            return weights[key]
+        return weights.get(key.split(':', 1)[0], 1)
+
+    @classmethod
+    def get_virtual_times(cls, queues):
+        keys = [cls.key(queue) for queue in queues]
+        for item in cls._get_collection().find({'_id': {'$in': keys}}):
+            yield item['_id'], item['vtime']
+
+    @classmethod
+    def order(cls, queues):
+        """Sort queues by virtual time, lowest first. Return a list of
+        (queue, virtual time, changed) tuples.
+
+        Virtual times are at least the system virtual time. Queues without
+        a virtual time (new queues) start at the lowest virtual time of the
+        other queues, if it is higher. 'changed' tells whether the virtual
+        time differs from the stored one. Nothing is stored here, see
+        charge().
+        """
+        virtual_times = dict(cls.get_virtual_times(queues))
+        system_time = cls.get_system_time()
+        start = max(min(virtual_times.values(), default=0), system_time)
+
+        items = []
+        for queue in queues:
+            stored = virtual_times.get(cls.key(queue))
+            if stored is None:
+                items.append((queue, start, True))
+            else:
+                virtual_time = max(stored, system_time)
+                items.append((queue, virtual_time, virtual_time != stored))
+        items.sort(key=lambda item: (item[1], cls.key(item[0])))
+
+        return items
+
+    @classmethod
+    def charge(cls, queue, ordered=()):
+        """Advance the virtual time of a queue after one of its jobs was
+        claimed.
+
+        'ordered' is the list returned by order() before claiming the job:
+        the virtual times that changed are stored, so that queues keep their
+        place on the next claims, and the system virtual time advances to
+        the one of the charged queue.
+        """
+        collection = cls._get_collection()
+
+        # $max: virtual times only go forward, even if another process
+        # stored a higher one concurrently
+        changed = [
+            UpdateOne(
+                {'_id': cls.key(item_queue)},
+                {'$max': {'vtime': virtual_time}},
+                upsert=True)
+            for item_queue, virtual_time, item_changed in ordered
+            if item_changed]
+        if changed:
+            try:
+                collection.bulk_write(changed, ordered=False)
+            except BulkWriteError:
+                # Some queues were stored concurrently
+                pass
+
+        for item_queue, virtual_time, item_changed in ordered:
+            if cls.key(item_queue) == cls.key(queue):
+                cls._counters().update_one(
+                    {'_id': cls.CLOCK_COUNTER},
+                    {'$max': {'count': virtual_time}},
+                    upsert=True)
+                break
+
+        collection.update_one(
+            {'_id': cls.key(queue)},
+            {'$inc': {'vtime': 1 / cls.get_weight(queue), 'claimed': 1}},
+            upsert=True)
+
+
 class Job(TypeMixin, StormDocument):
 
     STATUS_CHOICES = (
@@ -106,10 +395,12 @@ class Job(TypeMixin, StormDocument):
         ('error', 'Error'),
     )
 
-    owner = StormReferenceField(Agent, null=True, reverse_delete_rule=0)
+    DEFAULT_PRIORITY = 0
 
-    target = StormReferenceField('Resource')
-    procedure = StormReferenceField(Procedure)
+    owner = LazyStormReferenceField(Agent, null=True, reverse_delete_rule=0)
+
+    target = LazyStormReferenceField('Resource')
+    procedure = LazyStormReferenceField(Procedure)
 
     content = StringField()
     options = EscapedDictField()
@@ -119,17 +410,125 @@ class Job(TypeMixin, StormDocument):
         choices=STATUS_CHOICES, default='pending', required=True)
     result = EscapedDictField(required=True)
 
+    # Jobs with higher priority are claimed first. Jobs with the same
+    # priority are shared fairly among queues: see JobQuerySet.claim_one().
+    priority = IntField(default=DEFAULT_PRIORITY)
+    queue = StringField(null=True)
+
     created = DateTimeField(default=datetime.now, required=True)
+    started = DateTimeField(null=True)
+    completed = DateTimeField(null=True)
+
+    # Size of the JSON-encoded result, and whether the result was replaced
+    # with an empty dict because it was too large (see prune_job_results())
+    result_size = IntField(null=True)
+    result_pruned = BooleanField(null=True)
+
+    # Number of characters of output appended so far (see append_output())
+    output_size = IntField(null=True)
 
     meta = {
         'id_prefix': 'job-',
+        'queryset_class': JobQuerySet,
         'indexes': [
             'created',
             'owner',
+            ('status', 'type', 'priority', 'queue', 'created'),
+            ('status', 'completed'),
         ],
         'ordering': ['created'],
     }
 
+    def complete(self, status, result):
+        """Mark the job as complete with the given status ('done' or
+        'error') and result.
+        """
+        self.owner = None
+        self.status = status
+        self.result = result
+        self.result_size = len(json.dumps(result))
+        self.completed = datetime.now()
+        self.save()
+
+    def append_output(self, data):
+        """Append data to the output of the job, which must be running.
+
+        Return the offset of the data in the output, or None if the job is
+        not running.
+        """
+        # Allocate space in the output, then store the chunk. Readers stop
+        # at gaps, so chunks stored out of order are never skipped.
+        job = Job.objects.filter(id=self.id, status='running').modify(
+            new=True, inc__output_size=len(data))
+        if job is None:
+            return None
+
+        offset = job.output_size - len(data)
+        JobOutput(job=self.id, offset=offset, data=data).save()
+
+        self.output_size = job.output_size
+        return offset
+
+
+class JobOutputQuerySet(QuerySet):
+
+    def read(self, job_id, offset=0, skip_gaps=False):
+        """Read the output of a job, starting from the given offset.
+
+        Yield (data, end_offset) tuples. Reading stops at the first gap in
+        the output (a chunk that is being appended) unless skip_gaps is
+        true, which is what readers do once the job is complete.
+        """
+        # The first chunk may begin before the offset
+        first_chunk = self.filter(job=job_id, offset__lte=offset).order_by(
+            '-offset').only('offset').first()
+        start = first_chunk.offset if first_chunk is not None else offset
+
+        chunks = self.filter(job=job_id, offset__gte=start).order_by('offset')
+
+        for chunk in chunks:
+            end = chunk.offset + len(chunk.data)
+            if end <= offset:
+                continue
+            if chunk.offset > offset and not skip_gaps:
+                return
+
+            yield chunk.data[max(offset - chunk.offset, 0):], end
+            offset = end
+
+    def delete_for_jobs(self, job_ids):
+        # Bypass QuerySet.delete(), which sends signals for every chunk
+        self._collection.delete_many({'job': {'$in': list(job_ids)}})
+
+
+class JobOutput(Document):
+    """A chunk of the output of a job.
+
+    The output of a job is append-only and stored in chunks, so that it can
+    be read while the job is running and is not limited by the maximum
+    size of documents. Offsets count characters from the beginning of the
+    output.
+    """
+
+    MAX_CHUNK_SIZE = 256 * 1024
+
+    job = StringField(required=True)
+    offset = IntField(required=True)
+    data = StringField(required=True)
+    created = DateTimeField(default=datetime.now)
+
+    meta = {
+        'queryset_class': JobOutputQuerySet,
+        'indexes': [
+            {'fields': ['job', 'offset'], 'unique': True},
+        ],
+        'ordering': ['job', 'offset'],
+    }
+
+
+def delete_job_output(sender, document, **kwargs):
+    JobOutput.objects.delete_for_jobs([document.id])
+
 
 def restore_jobs(sender, document, **kwargs):
     orphaned_jobs = Job.objects.filter(owner=document)
@@ -141,5 +540,173 @@ def restore_jobs_if_owner_offline(sender, document, **kwargs):
         restore_jobs(sender, document, **kwargs)
 
 
+def restore_orphaned_jobs():
+    """Make running jobs pending again if their owner is offline or no
+    longer exists.
+
+    Agents going offline through atomic updates (see Agent.set_status())
+    do not send signals: their jobs are restored by this function.
+    """
+    online_agents = list(Agent.objects.filter(status='online').scalar('id'))
+    orphaned_jobs = Job.objects.filter(
+        status='running', owner__nin=online_agents)
+    orphaned_jobs.update(status='pending', owner=None)
+
+
+def retire_jobs(batch_size=500, renew=None):
+    """Delete, or archive if the JOB_ARCHIVE setting is enabled, the
+    complete jobs that are older than the TTL for their status.
+
+    Jobs are removed in batches, recording a 'deleted' event for each of
+    them. The age of jobs completed before completion dates were recorded
+    is counted from their creation.
+
+    If given, renew() is called between batches, and retiring stops if it
+    returns False (see MaintenanceService).
+    """
+    now = datetime.now()
+
+    for status, ttl in settings.JOB_TTL.items():
+        if ttl is None:
+            continue
+
+        threshold = now - timedelta(seconds=ttl)
+        jobs = Job.objects.filter(status=status).filter(
+            Q(completed__lt=threshold) |
+            Q(completed=None, created__lt=threshold))
+
+        if settings.JOB_ARCHIVE:
+            done = archive_jobs(jobs, batch_size, renew)
+        else:
+            done = delete_jobs(jobs, batch_size, renew)
+        if not done:
+            return
+
+
+def _retire_in_batches(queryset, batch_size, renew, retire):
+    """Call retire() with batches of raw documents of the jobs in the
+    given queryset, which must remove them from the queryset, until there
+    are none left.
+
+    If given, renew() is called before every batch but the first one, and
+    retiring stops if it returns False. Return whether all the jobs were
+    retired.
+    """
+    first = True
+
+    while True:
+        if not first and renew is not None and not renew():
+            return False
+        first = False
+
+        # No sorting: jobs are removed anyway, and sorting on another field
+        # than the filtered ones would not use the indexes
+        jobs = list(queryset.order_by().as_pymongo().limit(batch_size))
+        if not jobs:
+            return True
+
+        retire(jobs)
+
+
+def _remove_jobs(jobs):
+    from stormcore.apiserver.models.events import Event
+
+    job_ids = [job['_id'] for job in jobs]
+
+    # Bypass QuerySet.delete(): it would delete documents one by one to send
+    # signals. Events are recorded here instead.
+    Job._get_collection().delete_many({'_id': {'$in': job_ids}})
+    JobOutput.objects.delete_for_jobs(job_ids)
+
+    for job in jobs:
+        Event.objects.record_event('deleted', Job._from_son(job))
+
+
+def delete_jobs(queryset, batch_size=500, renew=None):
+    """Delete the jobs in the given queryset, and their output, recording a
+    'deleted' event for each of them.
+
+    If given, renew() is called before every batch but the first one, and
+    deleting stops if it returns False. Return whether all the jobs were
+    deleted.
+    """
+    return _retire_in_batches(queryset, batch_size, renew, _remove_jobs)
+
+
+def archive_jobs(queryset, batch_size=500, renew=None):
+    """Move the jobs in the given queryset to the archive collection,
+    recording a 'deleted' event for each of them.
+
+    Archived jobs are stored as zlib-compressed BSON in the 'data' field,
+    and their output as zlib-compressed UTF-8 in the 'output' field. A few
+    fields are kept uncompressed so that archived jobs can be looked up.
+    Archiving is idempotent: if it is interrupted, jobs that were archived
+    but not deleted are archived again on the next run.
+
+    If given, renew() is called before every batch but the first one, and
+    archiving stops if it returns False. Return whether all the jobs were
+    archived.
+    """
+    archive = get_db()[JOB_ARCHIVE_COLLECTION]
+    now = datetime.now()
+
+    def archive_batch(jobs):
+        archive.bulk_write([
+            ReplaceOne({'_id': job['_id']}, {
+                'type': job.get('type'),
+                'status': job.get('status'),
+                'target': job.get('target'),
+                'procedure': job.get('procedure'),
+                'created': job.get('created'),
+                'completed': job.get('completed'),
+                'archived': now,
+                'data': Binary(zlib.compress(BSON.encode(job))),
+                'output': _compress_output(job['_id']),
+            }, upsert=True)
+            for job in jobs
+        ], ordered=False)
+
+        _remove_jobs(jobs)
+
+    return _retire_in_batches(queryset, batch_size, renew, archive_batch)
+
+
+def _compress_output(job_id):
+    output = ''.join(
+        data for data, end in JobOutput.objects.read(job_id, skip_gaps=True))
+    if not output:
+        return None
+    return Binary(zlib.compress(output.encode()))
+
+
+def load_archived_job(job_id):
+    """Return the raw document of an archived job, or None if the job is
+    not archived.
+    """
+    archived = get_db()[JOB_ARCHIVE_COLLECTION].find_one({'_id': job_id})
+    if archived is None:
+        return None
+    return BSON(zlib.decompress(archived['data'])).decode()
+
+
+def prune_job_results():
+    """Replace the results larger than the JOB_RESULT_MAX_SIZE setting
+    with an empty dict, once JOB_RESULT_PRUNE_DELAY seconds have passed
+    since the jobs completed.
+    """
+    if settings.JOB_RESULT_MAX_SIZE is None:
+        return
+
+    threshold = datetime.now() - timedelta(
+        seconds=settings.JOB_RESULT_PRUNE_DELAY or 0)
+
+    Job.objects.filter(
+        result_size__gt=settings.JOB_RESULT_MAX_SIZE,
+        result_pruned__ne=True,
+        completed__lt=threshold,
+    ).update(set__result={}, set__result_pruned=True)
+
+
 signals.pre_delete.connect(restore_jobs, sender=Agent)
 signals.pre_save.connect(restore_jobs_if_owner_offline, sender=Agent)
+signals.post_delete.connect(delete_job_output, sender=Job)
@@ -1,7 +1,7 @@
 from mongoengine import StringField, ListField
 
 from stormcore.apiserver.models.base import (
-    StormDocument, TypeMixin, StormReferenceField, EscapedDictField)
+    StormDocument, TypeMixin, LazyStormReferenceField, EscapedDictField)
 
 
 class Resource(TypeMixin, StormDocument):
@@ -27,11 +27,11 @@ class Resource(TypeMixin, StormDocument):
     )
 
     names = ListField(StringField(min_length=1))
-    owner = StormReferenceField('Agent', required=True)
+    owner = LazyStormReferenceField('Agent', required=True)
 
-    parent = StormReferenceField('Resource', null=True)
-    cluster = StormReferenceField('Resource', null=True)
-    host = StormReferenceField('Resource', null=True)
+    parent = LazyStormReferenceField('Resource', null=True)
+    cluster = LazyStormReferenceField('Resource', null=True)
+    host = LazyStormReferenceField('Resource', null=True)
     image = StringField(min_length=1, null=True)
 
     status = StringField(
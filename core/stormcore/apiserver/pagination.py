@@ -0,0 +1,136 @@
+import functools
+import operator
+
+from mongoengine.queryset import Q
+
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Pagination based on document IDs.
+
+    Pagination is enabled when the 'limit' parameter is provided. Results are
+    sorted by the 'keyset_ordering' fields of the view, followed by the ID
+    (by default, just by ID), and the next page is requested by passing the
+    ID of the last document received as the 'after' parameter (example:
+    'GET /v1/resources?limit=100&after=res-XXX'). Unlike offsets, this does
+    not require the database to scan all the documents preceding the page.
+    Offsets are still supported with the 'offset' parameter, mainly for
+    random access.
+
+    The response body is a plain list, like for non-paginated responses. If
+    there are more results, the response has a 'Link' header with a
+    'rel="next"' URL. The 'count' parameter adds an 'X-Total-Count' header
+    with the total number of results.
+    """
+
+    limit_query_param = 'limit'
+    after_query_param = 'after'
+    offset_query_param = 'offset'
+    count_query_param = 'count'
+
+    max_limit = 1000
+
+    def _get_int_param(self, request, name):
+        value = request.GET.get(name)
+        if value is None:
+            return None
+        try:
+            value = int(value)
+        except ValueError:
+            value = -1
+        if value < 0:
+            raise ValidationError(
+                {name: ['Expected a non-negative integer']})
+        return value
+
+    def _get_ordering(self, view):
+        ordering = tuple(getattr(view, 'keyset_ordering', ()))
+        if 'id' not in ordering:
+            ordering += ('id',)
+        return ordering
+
+    def _filter_after(self, queryset, ordering, after):
+        if ordering == ('id',):
+            return queryset.filter(id__gt=after)
+
+        # Compare (field1, field2, ..., id) tuples: documents come after
+        # the given one if they are greater on a field, and equal on all
+        # the fields before it
+        last = queryset._document.objects.filter(id=after).only(
+            *ordering).first()
+        if last is None:
+            raise ValidationError(
+                {self.after_query_param: [
+                    'Object {!r} does not exist'.format(after)]})
+
+        conditions = []
+        for i, field in enumerate(ordering):
+            equal = {name: last[name] for name in ordering[:i]}
+            conditions.append(Q(**equal) & Q(**{field + '__gt': last[field]}))
+
+        return queryset.filter(functools.reduce(operator.or_, conditions))
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+
+        self.limit = self._get_int_param(request, self.limit_query_param)
+        self.offset = self._get_int_param(request, self.offset_query_param)
+        self.after = request.GET.get(self.after_query_param)
+        self.count = None
+
+        if request.GET.get(self.count_query_param) in ('1', 'true'):
+            self.count = queryset.count()
+        elif self.limit is None and self.after is None and \
+                self.offset is None:
+            return None
+
+        ordering = self._get_ordering(view)
+        queryset = queryset.order_by(*ordering)
+
+        if self.after is not None:
+            queryset = self._filter_after(queryset, ordering, self.after)
+        if self.offset:
+            queryset = queryset.skip(self.offset)
+
+        if self.limit is None:
+            self.has_next = False
+            return list(queryset)
+
+        self.limit = min(self.limit, self.max_limit)
+
+        # Fetch one more document to know if there is a next page
+        page = list(queryset.limit(self.limit + 1))
+        self.has_next = len(page) > self.limit
+        page = page[:self.limit]
+
+        self.last_id = page[-1].id if page else None
+
+        return page
+
+    def get_next_link(self):
+        if not self.has_next or self.last_id is None:
+            return None
+
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.offset_query_param)
+        url = remove_query_param(url, self.count_query_param)
+        url = replace_query_param(url, self.after_query_param, self.last_id)
+
+        return url
+
+    def get_paginated_response(self, data):
+        headers = {}
+
+        next_link = self.get_next_link()
+        if next_link is not None:
+            headers['Link'] = '<{}>; rel="next"'.format(next_link)
+
+        if self.count is not None:
+            headers['X-Total-Count'] = str(self.count)
+
+        return Response(data, headers=headers)
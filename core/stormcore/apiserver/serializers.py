@@ -1,11 +1,19 @@
+import collections
+
+from jinja2 import TemplateSyntaxError
 from mongoengine import Document
 
 from rest_framework.serializers import (
+    BooleanField,
     CharField,
+    ChoiceField,
     Field,
+    FloatField,
+    IntegerField,
     ListField,
     Serializer,
     SlugField,
+    ValidationError,
 )
 
 from rest_framework_mongoengine.fields import ReferenceField
@@ -20,6 +28,8 @@ from stormcore.apiserver.models import (
     Event,
     Group,
     Job,
+    JobOutput,
+    LazyStormReference,
     Procedure,
     Resource,
     Service,
@@ -36,15 +46,28 @@ class StormReferenceField(ReferenceField):
         value = self.parse_id(value)
         queryset = self.get_queryset()
 
-        try:
-            document = queryset.only('id').lookup(value)
-        except Exception:
+        # Serializers can share a cache of lookups through their context,
+        # to avoid looking up the same references over and over
+        cache = self.context.get('lookup_cache')
+        cache_key = (queryset._document, value)
+
+        if cache is not None and cache_key in cache:
+            document = cache[cache_key]
+        else:
+            try:
+                document = queryset.only('id').lookup(value)
+            except Exception:
+                document = None
+            if cache is not None:
+                cache[cache_key] = document
+
+        if document is None:
             self.fail('not_found', pk_value=value)
 
         return document
 
     def to_representation(self, value):
-        if isinstance(value, Document):
+        if isinstance(value, (Document, LazyStormReference)):
             return value.id
         return value
 
@@ -81,6 +104,11 @@ class AgentSerializer(DocumentSerializer):
         fields = ('id', 'type', 'name', 'heartbeat', 'status', 'options')
 
 
+class AgentHeartbeatsSerializer(Serializer):
+
+    agents = ListField(child=CharField())
+
+
 class ResourceSerializer(DocumentSerializer):
 
     owner = StormReferenceField(Agent)
@@ -96,6 +124,20 @@ class ResourceSerializer(DocumentSerializer):
             'image', 'status', 'health', 'snapshot')
 
 
+class ResourceBulkItemSerializer(Serializer):
+
+    OP_CHOICES = ('upsert', 'delete')
+
+    op = ChoiceField(choices=OP_CHOICES)
+    id = CharField(allow_null=True, required=False)
+    data = EscapedDictField(required=False)
+
+    def validate(self, data):
+        if data['op'] == 'delete' and not data.get('id'):
+            raise ValidationError({'id': ['This field is required.']})
+        return data
+
+
 class GroupSerializer(DocumentSerializer):
 
     name = CharField(
@@ -245,6 +287,17 @@ class ProcedureSerializer(DocumentSerializer):
             'content': {'required': False, 'allow_blank': True, 'default': ''},
         }
 
+    def validate_content(self, value):
+        # Compiling the template also stores it in the template cache, ready
+        # for the first execution
+        from stormcore.apiserver import templates
+        try:
+            templates.get_template(value)
+        except TemplateSyntaxError as exc:
+            raise ValidationError(
+                'Line {}: {}'.format(exc.lineno, exc.message))
+        return value
+
 
 class ProcedureExecSerializer(Serializer):
 
@@ -252,6 +305,9 @@ class ProcedureExecSerializer(Serializer):
     options = EscapedDictField()
     params = EscapedDictField()
 
+    priority = IntegerField(required=False)
+    queue = CharField(required=False)
+
 
 class ProcedureAttachSerializer(DocumentSerializer):
 
@@ -263,7 +319,8 @@ class ProcedureAttachSerializer(DocumentSerializer):
 
     class Meta:
         model = Subscription
-        fields = ('group', 'target', 'options', 'params')
+        fields = (
+            'group', 'target', 'options', 'params', 'priority', 'queue')
 
 
 class SubscriptionSerializer(DocumentSerializer):
@@ -277,11 +334,15 @@ class SubscriptionSerializer(DocumentSerializer):
 
     class Meta:
         model = Subscription
-        fields = ('id', 'group', 'procedure', 'target', 'options', 'params')
+        fields = (
+            'id', 'group', 'procedure', 'target', 'options', 'params',
+            'priority', 'queue',
+        )
 
 
 class JobSerializer(DocumentSerializer):
 
+    owner = StormReferenceField(Agent, read_only=True)
     target = StormReferenceField(Resource)
     procedure = StormReferenceField(Procedure)
 
@@ -294,8 +355,12 @@ class JobSerializer(DocumentSerializer):
         fields = (
             'id', 'type', 'owner', 'target', 'procedure',
             'content', 'options', 'params',
-            'status', 'result', 'created',
+            'priority', 'queue',
+            'status', 'result', 'result_pruned', 'output_size',
+            'created', 'started', 'completed',
         )
+        read_only_fields = (
+            'result_pruned', 'output_size', 'started', 'completed')
 
 
 class JobHandleSerializer(Serializer):
@@ -314,11 +379,49 @@ class JobHandleSerializer(Serializer):
         return data
 
 
+class JobClaimSerializer(JobHandleSerializer):
+
+    MAX_COUNT = 100
+    MAX_TIMEOUT = 60
+
+    type = CharField(required=False)
+    target = EscapedDictField(required=False)
+    count = IntegerField(min_value=1, max_value=MAX_COUNT, default=1)
+    timeout = FloatField(min_value=0, max_value=MAX_TIMEOUT, default=0)
+
+
+class JobWaitSerializer(Serializer):
+
+    MAX_TIMEOUT = 60
+
+    timeout = FloatField(min_value=0, max_value=MAX_TIMEOUT, default=30)
+
+
+class JobsWaitSerializer(JobWaitSerializer):
+
+    MODE_CHOICES = ('all', 'any')
+
+    jobs = ListField(child=CharField())
+    mode = ChoiceField(choices=MODE_CHOICES, default='all')
+
+
 class JobCompleteSerializer(Serializer):
 
     result = EscapedDictField()
 
 
+class JobOutputSerializer(Serializer):
+
+    offset = IntegerField(min_value=0, default=0)
+    follow = BooleanField(default=False)
+
+
+class JobOutputAppendSerializer(Serializer):
+
+    data = CharField(
+        trim_whitespace=False, max_length=JobOutput.MAX_CHUNK_SIZE)
+
+
 class EventSerializer(DocumentSerializer):
 
     class Meta:
@@ -326,3 +429,56 @@ class EventSerializer(DocumentSerializer):
         fields = (
             'id', 'event_type', 'entity_type', 'entity_id', 'entity_names',
         )
+
+
+# Serializers of the entities that events refer to, by entity type
+ENTITY_SERIALIZERS = {
+    'agent': AgentSerializer,
+    'application': ApplicationSerializer,
+    'group': GroupSerializer,
+    'job': JobSerializer,
+    'procedure': ProcedureSerializer,
+    'resource': ResourceSerializer,
+    'subscription': SubscriptionSerializer,
+}
+
+
+def serialize_entities(events):
+    """Return a dict mapping the IDs of the given events to the serialized
+    data of their entities.
+
+    Deleted entities are serialized from their last state, recorded with
+    the event. For the other events, the current state of the entity is
+    returned, which may be more recent than the event. Entities that no
+    longer exist are mapped to None.
+    """
+    entities = {}
+    pending = collections.defaultdict(list)
+
+    for event in events:
+        serializer_class = ENTITY_SERIALIZERS.get(event.entity_type)
+        if serializer_class is None:
+            entities[event.id] = None
+        elif event.event_type == 'deleted':
+            state = event.get_entity_state()
+            if state is None:
+                entities[event.id] = None
+            else:
+                document = serializer_class.Meta.model._from_son(state)
+                entities[event.id] = serializer_class(document).data
+        else:
+            pending[event.entity_type].append(event)
+
+    # One query per entity type
+    for entity_type, type_events in pending.items():
+        serializer_class = ENTITY_SERIALIZERS[entity_type]
+        documents = serializer_class.Meta.model.objects.in_bulk(
+            list({event.entity_id for event in type_events}))
+        for event in type_events:
+            document = documents.get(event.entity_id)
+            if document is None:
+                entities[event.id] = None
+            else:
+                entities[event.id] = serializer_class(document).data
+
+    return entities
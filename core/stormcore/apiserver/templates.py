@@ -1,15 +1,42 @@
+import copy
+import functools
 import json
 import shlex
 
 import jinja2.sandbox
+from stormlib.query import UnsupportedQuery, compile_query
 
 from stormcore.apiserver.models import (
-    Resource, Group, Event, user_query_filter)
+    Resource, Group, Event, prepare_user_query, user_query_filter)
 from stormcore.apiserver.serializers import (
     ResourceSerializer, GroupSerializer, EventSerializer)
 
 
+# Maximum number of compiled templates kept in memory by every process
+TEMPLATE_CACHE_SIZE = 512
+
+# Maximum number of database queries that a single render can make
+QUERY_BUDGET = 200
+
+# Fields of resources that are loaded only if templates access them. These
+# are usually much bigger than the other fields.
+RESOURCE_DEFERRED_FIELDS = ('snapshot',)
+
+
+def _load_deferred(value):
+    # Make sure that deferred fields are included in the JSON output
+    if isinstance(value, JinjaDocumentData):
+        value._load()
+    if isinstance(value, dict):
+        for item in value.values():
+            _load_deferred(item)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            _load_deferred(item)
+
+
 def tojson_filter(value):
+    _load_deferred(value)
     return json.dumps(value)
 
 
@@ -17,7 +44,7 @@ def shquote_filter(value):
     return shlex.quote(str(value))
 
 
-def render(template, target, params):
+def create_environment():
     env = jinja2.sandbox.SandboxedEnvironment(
         autoescape=False,
         extensions=['jinja2.ext.do'],
@@ -30,75 +57,322 @@ def render(template, target, params):
     env.filters['tojson'] = tojson_filter
     env.filters['shquote'] = shquote_filter
 
+    return env
+
+
+# Environments are thread-safe once configured: the same environment is
+# shared by all the renders of the process
+environment = create_environment()
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def get_template(content):
+    """Return the compiled template for the given content.
+
+    Compiled templates are cached, so that procedures executed over and
+    over are parsed and compiled only once. jinja2.TemplateSyntaxError is
+    raised if the content is not a valid template.
+    """
+    return environment.from_string(content)
+
+
+def render(template, target, params, query_budget=None):
+    context = RenderContext(query_budget)
+
     template_params = {
-        'groups': JinjaGroups(),
-        'resources': JinjaResources(),
-        'target': JinjaResources()._serialize(target),
+        'groups': JinjaGroups(context),
+        'resources': JinjaResources(context),
+        'target': JinjaResources(context)._serialize(target),
         **params,
     }
 
-    renderer = env.from_string(template)
+    renderer = get_template(template)
     return renderer.render(template_params)
 
 
+class QueryBudgetExceeded(jinja2.TemplateRuntimeError):
+    """Raised when a template makes too many database queries."""
+
+
+class RenderContext:
+    """State shared by all the objects exposed to a template while it is
+    rendered.
+
+    The results of lookups and queries are memoized, so that templates
+    accessing the same data more than once (for example, looping twice over
+    the members of a group) query the database only once. The number of
+    queries is bounded by the query budget.
+    """
+
+    def __init__(self, query_budget=None):
+        if query_budget is None:
+            query_budget = QUERY_BUDGET
+        self.query_budget = query_budget
+        self.queries = 0
+        self._memo = {}
+
+    def query(self, func, *args, **kwargs):
+        """Call a function that queries the database, enforcing the query
+        budget.
+        """
+        if self.queries >= self.query_budget:
+            raise QueryBudgetExceeded(
+                'Template exceeded the query budget ({} queries)'.format(
+                    self.query_budget))
+        self.queries += 1
+        return func(*args, **kwargs)
+
+    def memoize(self, key, func):
+        try:
+            return self._memo[key]
+        except KeyError:
+            value = self._memo[key] = func()
+            return value
+
+
+class DeferredFieldsLoader:
+    """Load the deferred fields of a set of documents with a single query,
+    the first time the fields of any of them are accessed.
+    """
+
+    def __init__(self, context, document_type, serializer_class, fields, ids):
+        self.context = context
+        self.document_type = document_type
+        self.serializer_class = serializer_class
+        self.fields = fields
+        self.ids = ids
+        self._data = None
+
+    def load(self, document_id):
+        if self._data is None:
+            queryset = self.document_type.objects.filter(
+                id__in=self.ids).only('id', *self.fields)
+            documents = self.context.query(list, queryset)
+            self._data = {}
+            for obj in documents:
+                data = self.serializer_class(obj).data
+                self._data[obj.pk] = {
+                    name: data[name] for name in self.fields}
+        return self._data.get(document_id, {})
+
+
+class JinjaDocumentData(dict):
+    """The serialized data of a document, possibly missing some deferred
+    fields. Deferred fields are loaded when they are accessed, or when the
+    data is used as a whole.
+    """
+
+    def __init__(self, data, loader=None):
+        super().__init__(data)
+        self._loader = loader
+
+    def _load(self):
+        if self._loader is not None:
+            loader, self._loader = self._loader, None
+            self.update(loader.load(self['id']))
+
+    def __missing__(self, key):
+        if self._loader is not None and key in self._loader.fields:
+            self._load()
+            return self[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        if self._loader is not None and key in self._loader.fields:
+            self._load()
+        return super().get(key, default)
+
+    def __contains__(self, key):
+        self._load()
+        return super().__contains__(key)
+
+    def __iter__(self):
+        self._load()
+        return super().__iter__()
+
+    def __len__(self):
+        self._load()
+        return super().__len__()
+
+    def __repr__(self):
+        self._load()
+        return super().__repr__()
+
+    def keys(self):
+        self._load()
+        return super().keys()
+
+    def values(self):
+        self._load()
+        return super().values()
+
+    def items(self):
+        self._load()
+        return super().items()
+
+    def copy(self):
+        self._load()
+        return dict(self)
+
+
 class JinjaQuerySet:
 
-    def __init__(self, queryset, serializer_class):
+    def __init__(self, queryset, serializer_class, documents=None,
+                 context=None, deferred_fields=()):
+        if context is None:
+            context = RenderContext()
         self._queryset = queryset
         self._serializer_class = serializer_class
-
-    def _serialize(self, obj):
-        serializer = self._serializer_class(obj)
-        return serializer.data
+        # Documents already retrieved from the database, if any
+        self._documents = documents
+        self._context = context
+        # Fields that are not retrieved when iterating over the queryset
+        self._deferred_fields = deferred_fields
+        # Results of __call__(), by query
+        self._filtered = {}
+
+    def _clone(self, queryset, documents=None):
+        return JinjaQuerySet(
+            queryset, self._serializer_class, documents,
+            self._context, self._deferred_fields)
+
+    def _serialize(self, obj, loader=None):
+        def serialize():
+            serializer = self._serializer_class(
+                obj, context={'render_context': self._context})
+            data = serializer.data
+            if loader is None:
+                return JinjaDocumentData(data)
+            for name in loader.fields:
+                data.pop(name, None)
+            return JinjaDocumentData(data, loader)
+
+        key = ('serialize', self._serializer_class, obj.pk)
+        return self._context.memoize(key, serialize)
+
+    def _fetch(self):
+        if self._documents is None:
+            queryset = self._queryset
+            if self._deferred_fields:
+                queryset = queryset.exclude(*self._deferred_fields)
+            self._documents = self._context.query(list, queryset)
+        return self._documents
+
+    def _loader(self, documents):
+        if not self._deferred_fields:
+            return None
+        return DeferredFieldsLoader(
+            self._context, self._queryset._document, self._serializer_class,
+            self._deferred_fields, [obj.pk for obj in documents])
 
     def __len__(self):
-        return len(self._queryset)
+        if self._documents is not None:
+            return len(self._documents)
+        return self._context.query(
+            self._queryset.count, with_limit_and_skip=True)
 
     def __iter__(self):
-        return (self._serialize(obj) for obj in self._queryset)
+        documents = self._fetch()
+        loader = self._loader(documents)
+        return (self._serialize(obj, loader) for obj in documents)
 
     def __getitem__(self, index):
         if isinstance(index, slice):
-            return JinjaQuerySet(
-                self._queryset[index],
-                self._serializer_class)
-        return self._serialize(self._queryset[index])
+            documents = None
+            if self._documents is not None:
+                documents = self._documents[index]
+            return self._clone(self._queryset[index], documents)
+
+        if self._documents is not None:
+            obj = self._documents[index]
+            return self._serialize(obj, self._loader(self._documents))
+
+        return self._serialize(
+            self._context.query(self._queryset.__getitem__, index))
 
     def __call__(self, query):
-        return JinjaQuerySet(
-            user_query_filter(query, self._queryset),
-            self._serializer_class)
+        try:
+            # Key order is relevant for the semantics of queries
+            key = json.dumps(query)
+        except (TypeError, ValueError):
+            return self._filter(query)
+
+        if key not in self._filtered:
+            self._filtered[key] = self._filter(query)
+        return self._filtered[key]
+
+    def _filter(self, query):
+        queryset = user_query_filter(query, self._queryset)
+        documents = None if query else self._documents
+
+        if query and self._documents is not None and \
+                not self._uses_deferred_fields(query):
+            # Filter the documents already retrieved in memory, instead of
+            # querying the database again
+            query = copy.deepcopy(query)
+            prepare_user_query(self._queryset._document, query)
+            try:
+                predicate = compile_query(query)
+            except UnsupportedQuery:
+                pass
+            else:
+                documents = [
+                    obj for obj in self._documents
+                    if predicate(obj.to_mongo().to_dict())]
+
+        return self._clone(queryset, documents)
+
+    def _uses_deferred_fields(self, query):
+        # Documents in memory do not have their deferred fields: queries
+        # on those fields must be evaluated by the database
+        for key, value in query.items():
+            if key in ('$and', '$or', '$nor') and isinstance(value, list):
+                if any(self._uses_deferred_fields(item) for item in value
+                       if isinstance(item, dict)):
+                    return True
+            elif key.split('.', 1)[0] in self._deferred_fields:
+                return True
+        return False
 
 
 class JinjaDocumentClass(JinjaQuerySet):
 
     def __getitem__(self, key):
         if isinstance(key, str):
-            return self._serialize(self._queryset.lookup(key))
+            def lookup():
+                obj = self._context.query(self._queryset.lookup, key)
+                return self._serialize(obj)
+            memo_key = ('lookup', self._queryset._document, key)
+            return self._context.memoize(memo_key, lookup)
         return super().__getitem__(key)
 
 
 class JinjaResources(JinjaDocumentClass):
 
-    def __init__(self):
-        super().__init__(Resource.objects.all(), ResourceSerializer)
+    def __init__(self, context=None):
+        super().__init__(
+            Resource.objects.all(), ResourceSerializer, context=context,
+            deferred_fields=RESOURCE_DEFERRED_FIELDS)
 
 
 class JinjaGroupSerializer:
 
-    def __init__(self, obj):
+    def __init__(self, obj, context):
         self.data = GroupSerializer(obj).data
         self.data['members'] = JinjaQuerySet(
-            obj.members(), ResourceSerializer)
+            obj.members(), ResourceSerializer,
+            context=context['render_context'],
+            deferred_fields=RESOURCE_DEFERRED_FIELDS)
 
 
 class JinjaGroups(JinjaDocumentClass):
 
-    def __init__(self):
-        super().__init__(Group.objects.all(), JinjaGroupSerializer)
+    def __init__(self, context=None):
+        super().__init__(
+            Group.objects.all(), JinjaGroupSerializer, context=context)
 
 
 class JinjaEvents(JinjaDocumentClass):
 
-    def __init__(self):
-        super().__init__(Event.objects.all(), EventSerializer)
+    def __init__(self, context=None):
+        super().__init__(Event.objects.all(), EventSerializer, context=context)
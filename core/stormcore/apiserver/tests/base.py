@@ -0,0 +1,40 @@
+import unittest
+
+import mongoengine
+from mongoengine.connection import disconnect, get_db
+from pymongo.uri_parser import parse_uri
+
+from django.conf import settings
+
+
+class MongoTestCase(unittest.TestCase):
+    """Base class for tests that need the database.
+
+    Tests run against a scratch database named after the configured one
+    (for example 'perfectstorm_test'), whose collections are emptied
+    before each test.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        uri = parse_uri(settings.MONGODB_URI)
+        host, port = uri['nodelist'][0]
+        name = '{}_test'.format(uri['database'] or 'perfectstorm')
+        disconnect()
+        mongoengine.connect(name, host=host, port=port)
+
+    @classmethod
+    def tearDownClass(cls):
+        disconnect()
+        mongoengine.connect(host=settings.MONGODB_URI, connect=False)
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        self.db = get_db()
+        # Empty the collections instead of dropping them, so that the
+        # indexes created by mongoengine are kept
+        for name in self.db.list_collection_names():
+            if not name.startswith('system.'):
+                self.db[name].delete_many({})
@@ -0,0 +1,149 @@
+import time
+
+from stormcore.apiserver.dispatcher import EventDispatcher
+from stormcore.apiserver.models import Event
+
+from .base import MongoTestCase
+
+
+class RecordingDispatcher(EventDispatcher):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dispatched = []
+
+    def dispatch(self, event):
+        self.dispatched.append(event.id)
+        return 0
+
+
+class EventDispatcherTest(MongoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.dispatcher = RecordingDispatcher()
+        self.assertTrue(self.dispatcher.lease.acquire())
+        self.dispatcher._last_renewal = time.monotonic()
+
+    def tearDown(self):
+        self.dispatcher.lease.release()
+        super().tearDown()
+
+    def insert_events(self, *event_ids):
+        Event._get_collection().insert_many([
+            {'_id': event_id, 'event_type': 'created',
+             'entity_type': 'resource',
+             'entity_id': 'res-{}'.format(event_id)}
+            for event_id in event_ids])
+
+    def set_checkpoint(self, last_event_id):
+        self.db[EventDispatcher.CHECKPOINT_COLLECTION].insert_one(
+            {'_id': EventDispatcher.CHECKPOINT_NAME,
+             'last_event_id': last_event_id})
+
+    def get_checkpoint(self):
+        return self.db[EventDispatcher.CHECKPOINT_COLLECTION].find_one(
+            {'_id': EventDispatcher.CHECKPOINT_NAME})
+
+    def test_in_order(self):
+        self.set_checkpoint(0)
+        self.insert_events(1, 2, 3)
+
+        self.dispatcher._load_checkpoint()
+        self.assertTrue(self.dispatcher._dispatch_batch())
+        self.assertFalse(self.dispatcher._dispatch_batch())
+
+        self.assertEqual(self.dispatcher.dispatched, [1, 2, 3])
+        checkpoint = self.get_checkpoint()
+        self.assertEqual(checkpoint['last_event_id'], 3)
+        self.assertEqual(checkpoint['processed'], 3)
+        self.assertEqual(checkpoint['lost'], 0)
+
+    def test_late_event(self):
+        self.set_checkpoint(0)
+        # Event 3 was allocated before event 4, but is inserted after it
+        self.insert_events(1, 2, 4)
+
+        self.dispatcher._load_checkpoint()
+        self.dispatcher._dispatch_batch()
+
+        self.assertEqual(self.dispatcher.dispatched, [1, 2, 4])
+        # The checkpoint stays below the gap, so that event 3 is not lost
+        # if the dispatcher restarts
+        self.assertEqual(self.get_checkpoint()['last_event_id'], 2)
+
+        self.insert_events(3, 5)
+        self.dispatcher._dispatch_batch()
+
+        self.assertEqual(self.dispatcher.dispatched, [1, 2, 4, 3, 5])
+        checkpoint = self.get_checkpoint()
+        self.assertEqual(checkpoint['last_event_id'], 5)
+        self.assertEqual(checkpoint['processed'], 5)
+        self.assertEqual(checkpoint['lost'], 0)
+        self.assertEqual(checkpoint['skipped'], 0)
+
+    def test_restart_below_gap(self):
+        self.set_checkpoint(0)
+        self.insert_events(1, 2, 4)
+
+        self.dispatcher._load_checkpoint()
+        self.dispatcher._dispatch_batch()
+
+        # Another dispatcher takes over before event 3 shows up: it
+        # dispatches event 4 again, and does not miss event 3
+        self.insert_events(3)
+        dispatcher = RecordingDispatcher()
+        dispatcher._last_renewal = time.monotonic()
+        dispatcher.lease = self.dispatcher.lease
+        dispatcher._load_checkpoint()
+        dispatcher._dispatch_batch()
+
+        self.assertEqual(dispatcher.dispatched, [3, 4])
+        self.assertEqual(self.get_checkpoint()['last_event_id'], 4)
+
+    def test_gap_timeout(self):
+        self.dispatcher.GAP_TIMEOUT = 0
+        self.set_checkpoint(0)
+        # Event 2 was allocated, but never inserted
+        self.insert_events(1, 3)
+
+        self.dispatcher._load_checkpoint()
+        self.dispatcher._dispatch_batch()
+
+        self.assertEqual(self.dispatcher.dispatched, [1, 3])
+        checkpoint = self.get_checkpoint()
+        self.assertEqual(checkpoint['last_event_id'], 3)
+        self.assertEqual(checkpoint['skipped'], 1)
+        self.assertEqual(checkpoint['lost'], 0)
+
+    def test_trimmed_events(self):
+        self.set_checkpoint(0)
+        # Events 1 to 4 were deleted from the log before being dispatched
+        self.insert_events(5, 6, 7)
+
+        self.dispatcher._load_checkpoint()
+        self.dispatcher._dispatch_batch()
+
+        self.assertEqual(self.dispatcher.dispatched, [5, 6, 7])
+        checkpoint = self.get_checkpoint()
+        self.assertEqual(checkpoint['last_event_id'], 7)
+        self.assertEqual(checkpoint['lost'], 4)
+        self.assertEqual(checkpoint['skipped'], 0)
+
+    def test_lease_lost(self):
+        self.set_checkpoint(0)
+        self.insert_events(1, 2, 3)
+
+        self.dispatcher._load_checkpoint()
+        self.dispatcher.lease.release()
+        self.dispatcher._last_renewal -= EventDispatcher.LEASE_RENEW_INTERVAL
+
+        # Another dispatcher acquires the lease
+        other = RecordingDispatcher()
+        self.assertTrue(other.lease.acquire())
+
+        self.assertFalse(self.dispatcher._dispatch_batch())
+        self.assertEqual(self.dispatcher.dispatched, [])
+        self.assertEqual(self.get_checkpoint()['last_event_id'], 0)
+
+        other.lease.release()
@@ -0,0 +1,89 @@
+import time
+from unittest import mock
+
+from stormcore.apiserver.hub import EventHub
+from stormcore.apiserver.models import Event
+
+from .base import MongoTestCase
+
+
+class EventHubTest(MongoTestCase):
+
+    def insert_events(self, *event_ids):
+        Event._get_collection().insert_many([
+            {'_id': event_id, 'event_type': 'created',
+             'entity_type': 'resource',
+             'entity_id': 'res-{}'.format(event_id)}
+            for event_id in event_ids])
+
+    def received_ids(self, client):
+        ids = []
+        while True:
+            item = client.get(timeout=0)
+            if item is None:
+                return ids
+            ids.append(item.id)
+
+    def test_broadcast(self):
+        hub = EventHub()
+        one = hub.subscribe()
+        two = hub.subscribe()
+
+        self.insert_events(1, 2)
+        hub._poll()
+
+        self.assertEqual(self.received_ids(one), [1, 2])
+        self.assertEqual(self.received_ids(two), [1, 2])
+
+    def test_events_before_subscription(self):
+        hub = EventHub()
+        self.insert_events(1, 2)
+
+        # The hub was idle: events created before the first client
+        # subscribed are not delivered
+        client = hub.subscribe()
+        self.insert_events(3)
+        hub._poll()
+
+        self.assertEqual(self.received_ids(client), [3])
+
+        # Events created while the hub has no clients are skipped too
+        client.close()
+        self.insert_events(4)
+        client = hub.subscribe()
+        self.insert_events(5)
+        hub._poll()
+
+        self.assertEqual(self.received_ids(client), [5])
+
+    def test_no_polling_without_clients(self):
+        hub = EventHub()
+        hub.POLL_INTERVAL = .01
+        hub._poll = mock.Mock(return_value=False)
+        hub.start()
+
+        time.sleep(.1)
+        self.assertFalse(hub._poll.called)
+
+        with hub.subscribe():
+            time.sleep(.1)
+            self.assertTrue(hub._poll.called)
+
+        time.sleep(.1)
+        hub._poll.reset_mock()
+        time.sleep(.1)
+        self.assertFalse(hub._poll.called)
+
+    def test_gap(self):
+        hub = EventHub()
+        hub.GAP_TIMEOUT = 60
+        client = hub.subscribe()
+
+        self.insert_events(1, 2, 4)
+        hub._poll()
+        self.assertEqual(self.received_ids(client), [1, 2])
+
+        # Event 3 shows up late
+        self.insert_events(3)
+        hub._poll()
+        self.assertEqual(self.received_ids(client), [3, 4])
@@ -0,0 +1,120 @@
+from datetime import datetime, timedelta
+
+from stormcore.apiserver.models import Job
+from stormcore.apiserver.models.procedures import JobQueues
+
+from .base import MongoTestCase
+
+
+class ClaimTest(MongoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.created = datetime.now() - timedelta(minutes=1)
+
+    def insert_job(self, job_id, **kwargs):
+        # Jobs are inserted raw, so that legacy jobs can lack fields
+        self.created += timedelta(seconds=1)
+        doc = {
+            '_id': job_id,
+            'type': 'test',
+            'status': 'pending',
+            'created': self.created,
+        }
+        doc.update(kwargs)
+        Job._get_collection().insert_one(doc)
+
+    def claim_ids(self, count):
+        return [job.id for job in Job.objects.claim('agt-test', count)]
+
+    def get_virtual_times(self):
+        return {
+            item['_id']: item['vtime']
+            for item in self.db['job_queues'].find()}
+
+    def test_priority(self):
+        self.insert_job('job-low', priority=-1)
+        self.insert_job('job-default', priority=0)
+        self.insert_job('job-high', priority=10)
+
+        self.assertEqual(
+            self.claim_ids(3), ['job-high', 'job-default', 'job-low'])
+
+    def test_missing_priority(self):
+        # Jobs created before priorities were introduced have the default
+        # priority: they go before jobs with a lower priority, and after
+        # jobs with a higher one
+        self.insert_job('job-low', priority=-1)
+        self.insert_job('job-legacy')
+        self.insert_job('job-high', priority=1)
+        self.insert_job('job-default', priority=0)
+
+        self.assertEqual(
+            self.claim_ids(4),
+            ['job-high', 'job-legacy', 'job-default', 'job-low'])
+
+    def test_fair_queueing(self):
+        for i in range(4):
+            self.insert_job('job-busy-{}'.format(i), priority=0, queue='busy')
+        for i in range(2):
+            self.insert_job(
+                'job-quiet-{}'.format(i), priority=0, queue='quiet')
+
+        claimed = self.claim_ids(4)
+
+        self.assertEqual(
+            sorted(claimed),
+            ['job-busy-0', 'job-busy-1', 'job-quiet-0', 'job-quiet-1'])
+        self.assertEqual(
+            self.get_virtual_times(), {'busy': 2, 'quiet': 2})
+
+    def test_virtual_time_of_new_queue(self):
+        self.db['job_queues'].insert_one({'_id': 'old', 'vtime': 10})
+        self.insert_job('job-old', priority=0, queue='old')
+        self.insert_job('job-new', priority=0, queue='new')
+
+        self.assertEqual(self.claim_ids(1), ['job-new'])
+        # The new queue starts at the virtual time of the other queue
+        self.assertEqual(self.get_virtual_times(), {'old': 10, 'new': 11})
+
+    def test_idle_queue(self):
+        self.insert_job('job-idle-0', priority=0, queue='idle')
+        self.insert_job('job-busy-0', priority=0, queue='busy')
+        self.assertEqual(len(self.claim_ids(2)), 2)
+
+        # While the idle queue has no jobs, the busy one goes on
+        for i in range(1, 6):
+            self.insert_job('job-busy-{}'.format(i), priority=0, queue='busy')
+        self.assertEqual(len(self.claim_ids(5)), 5)
+
+        # The idle queue comes back: it does not get to claim all its jobs
+        # ahead of the busy queue, as its virtual time is far behind
+        for i in range(1, 4):
+            self.insert_job('job-idle-{}'.format(i), priority=0, queue='idle')
+        for i in range(6, 9):
+            self.insert_job('job-busy-{}'.format(i), priority=0, queue='busy')
+
+        self.assertEqual(
+            self.claim_ids(4),
+            ['job-idle-1', 'job-busy-6', 'job-idle-2', 'job-busy-7'])
+
+    def test_no_writes_without_claims(self):
+        self.insert_job('job-1', priority=0, queue='busy')
+        Job._get_collection().update_one(
+            {'_id': 'job-1'}, {'$set': {'status': 'running'}})
+
+        self.assertEqual(self.claim_ids(1), [])
+        self.assertEqual(self.get_virtual_times(), {})
+
+    def test_order(self):
+        self.db['job_queues'].insert_many([
+            {'_id': 'a', 'vtime': 3},
+            {'_id': 'b', 'vtime': 1},
+        ])
+
+        self.assertEqual(
+            JobQueues.order(['a', 'b', 'c', None]),
+            [('b', 1, False), ('c', 1, True), (None, 1, True),
+             ('a', 3, False)])
+        # Ordering does not store anything
+        self.assertEqual(self.get_virtual_times(), {'a': 3, 'b': 1})
@@ -0,0 +1,153 @@
+from datetime import datetime, timedelta
+
+from stormcore.apiserver.maintenance import Lease, MaintenanceService
+
+from .base import MongoTestCase
+
+
+class LeaseTest(MongoTestCase):
+
+    def expire(self, lease):
+        self.db[Lease.COLLECTION].update_one(
+            {'_id': lease.name},
+            {'$set': {'expires': datetime.utcnow() - timedelta(seconds=1)}})
+
+    def test_acquire_and_renew(self):
+        lease = Lease('test', 30, holder='one')
+
+        self.assertTrue(lease.acquire())
+        expires = self.db[Lease.COLLECTION].find_one({'_id': 'test'})[
+            'expires']
+
+        self.assertTrue(lease.acquire())
+        renewed = self.db[Lease.COLLECTION].find_one({'_id': 'test'})
+        self.assertEqual(renewed['holder'], 'one')
+        self.assertGreaterEqual(renewed['expires'], expires)
+
+    def test_competing_holders(self):
+        one = Lease('test', 30, holder='one')
+        two = Lease('test', 30, holder='two')
+
+        self.assertTrue(one.acquire())
+        self.assertFalse(two.acquire())
+        # Renewing does not steal the lease
+        self.assertTrue(one.acquire())
+        self.assertFalse(two.acquire())
+
+    def test_expiry(self):
+        one = Lease('test', 30, holder='one')
+        two = Lease('test', 30, holder='two')
+
+        self.assertTrue(one.acquire())
+        self.expire(one)
+
+        self.assertTrue(two.acquire())
+        self.assertFalse(one.acquire())
+
+    def test_release(self):
+        one = Lease('test', 30, holder='one')
+        two = Lease('test', 30, holder='two')
+
+        self.assertTrue(one.acquire())
+        # Only the holder can release the lease
+        two.release()
+        self.assertFalse(two.acquire())
+
+        one.release()
+        self.assertTrue(two.acquire())
+
+    def test_independent_names(self):
+        self.assertTrue(Lease('test-1', 30, holder='one').acquire())
+        self.assertTrue(Lease('test-2', 30, holder='two').acquire())
+
+
+class MaintenanceServiceTest(MongoTestCase):
+
+    def make_service(self, tasks, holder):
+        service = MaintenanceService(tasks)
+        service.lease = Lease(service.LEASE_NAME, 30, holder=holder)
+        return service
+
+    def test_run_pending(self):
+        calls = []
+        service = self.make_service([
+            ('often', lambda: calls.append('often'), 0, False),
+            ('rarely', lambda: calls.append('rarely'), 3600, False),
+        ], 'one')
+
+        service.run_pending()
+        service.run_pending()
+
+        self.assertEqual(calls, ['often', 'rarely', 'often'])
+
+    def test_errors(self):
+        calls = []
+
+        def fail():
+            raise RuntimeError('Something went wrong')
+
+        service = self.make_service([
+            ('fail', fail, 0, False),
+            ('succeed', lambda: calls.append('succeed'), 0, False),
+        ], 'one')
+
+        service.run_pending()
+
+        self.assertEqual(calls, ['succeed'])
+
+    def test_competing_services(self):
+        calls = []
+        tasks = [('task', lambda: calls.append('task'), 0, False)]
+        one = self.make_service(tasks, 'one')
+        two = self.make_service(tasks, 'two')
+
+        one.run_pending()
+        two.run_pending()
+
+        self.assertEqual(calls, ['task'])
+
+    def test_lease_lost_between_tasks(self):
+        calls = []
+        other = Lease(MaintenanceService.LEASE_NAME, 30, holder='two')
+
+        def steal():
+            calls.append('steal')
+            self.db[Lease.COLLECTION].delete_many({})
+            other.acquire()
+
+        service = self.make_service([
+            ('steal', steal, 0, False),
+            ('task', lambda: calls.append('task'), 0, False),
+        ], 'one')
+
+        service.run_pending()
+
+        self.assertEqual(calls, ['steal'])
+
+    def test_lease_lost_during_batches(self):
+        batches = []
+        other = Lease(MaintenanceService.LEASE_NAME, 30, holder='two')
+
+        def batched(renew):
+            for i in range(10):
+                if i and not renew():
+                    return
+                batches.append(i)
+                if i == 2:
+                    self.db[Lease.COLLECTION].delete_many({})
+                    other.acquire()
+
+        service = self.make_service([('batched', batched, 0, True)], 'one')
+        service.run_pending()
+
+        self.assertEqual(batches, [0, 1, 2])
+
+    def test_stop(self):
+        service = self.make_service([], 'one')
+        service.start()
+        service.stop()
+
+        # The lease is released
+        self.assertTrue(
+            Lease(MaintenanceService.LEASE_NAME, 30, holder='two').acquire())
+        self.assertFalse(service.renew())
@@ -0,0 +1,141 @@
+import threading
+
+from stormcore.apiserver.models import Agent, Event, Resource
+from stormcore.apiserver.models.base import IdAllocator, LazyStormReference
+
+from .base import MongoTestCase
+
+
+class IdAllocatorTest(MongoTestCase):
+
+    def allocator(self):
+        return IdAllocator(Event, 'event')
+
+    def test_monotonic(self):
+        allocator = self.allocator()
+        ids = [allocator.allocate() for i in range(100)]
+        self.assertEqual(ids, list(range(1, 101)))
+
+    def test_concurrent(self):
+        allocators = [self.allocator() for i in range(4)]
+        results = [[] for allocator in allocators]
+
+        def allocate(allocator, result):
+            for i in range(50):
+                result.append(allocator.allocate())
+
+        threads = [
+            threading.Thread(target=allocate, args=args)
+            for args in zip(allocators, results)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Every allocator sees increasing IDs, and no ID is handed out twice
+        for result in results:
+            self.assertEqual(result, sorted(result))
+        all_ids = sorted(sum(results, []))
+        self.assertEqual(all_ids, list(range(1, 201)))
+
+    def test_continue_after_existing_documents(self):
+        # Events migrated from another collection, with no counter
+        Event._get_collection().insert_many([
+            {'_id': i, 'event_type': 'created', 'entity_type': 'resource',
+             'entity_id': 'res-{}'.format(i)}
+            for i in range(1, 43)])
+
+        self.assertEqual(self.allocator().allocate(), 43)
+        self.assertEqual(self.allocator().allocate(), 44)
+
+    def test_counter_ahead_of_documents(self):
+        # IDs are never reused, even if the newest documents were deleted
+        self.db[IdAllocator.COUNTERS_COLLECTION].insert_one(
+            {'_id': 'event', 'count': 100})
+        Event._get_collection().insert_one(
+            {'_id': 10, 'event_type': 'created', 'entity_type': 'resource',
+             'entity_id': 'res-10'})
+
+        self.assertEqual(self.allocator().allocate(), 101)
+
+    def test_auto_increment_field(self):
+        first = Event(
+            event_type='created', entity_type='resource', entity_id='res-1')
+        first.save()
+        second = Event(
+            event_type='created', entity_type='resource', entity_id='res-2')
+        second.save()
+
+        self.assertGreater(second.id, first.id)
+
+
+class LazyStormReferenceTest(MongoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.agent = Agent(type='test', name='test-agent')
+        self.agent.save()
+
+    def test_equality(self):
+        ref = LazyStormReference(Agent, self.agent.id)
+
+        self.assertEqual(ref, self.agent.id)
+        self.assertEqual(ref, self.agent)
+        self.assertEqual(ref, LazyStormReference(Agent, self.agent.id))
+        self.assertNotEqual(ref, 'agt-other')
+        self.assertNotEqual(ref, Agent(id='agt-other'))
+        self.assertNotEqual(ref, LazyStormReference(Agent, 'agt-other'))
+        self.assertNotEqual(ref, 42)
+
+    def test_hash(self):
+        ref = LazyStormReference(Agent, self.agent.id)
+
+        self.assertEqual(hash(ref), hash(self.agent.id))
+        self.assertIn(self.agent.id, {ref})
+        self.assertIn(ref, {self.agent.id})
+
+    def test_fetch(self):
+        ref = LazyStormReference(Agent, 'test-agent')
+
+        document = ref.fetch()
+        self.assertEqual(document.id, self.agent.id)
+
+        # The document is kept, and not looked up again unless forced
+        Agent._get_collection().delete_one({'_id': self.agent.id})
+        self.assertIs(ref.fetch(), document)
+        with self.assertRaises(Agent.DoesNotExist):
+            ref.fetch(force=True)
+
+    def test_field(self):
+        resource = Resource(type='test', names=['res'], owner=self.agent)
+        resource.save()
+        resource = Resource.objects.get(id=resource.id)
+
+        self.assertIsInstance(resource.owner, LazyStormReference)
+        self.assertEqual(resource.owner, self.agent)
+
+    def test_prefetch(self):
+        for i in range(3):
+            Resource(type='test', names=['res'], owner=self.agent).save()
+
+        # Lazy references are not resolved by default
+        resources = list(Resource.objects.prefetch_references())
+
+        for resource in resources:
+            self.assertEqual(resource.owner.id, self.agent.id)
+            self.assertIsNone(resource.owner._document)
+
+    def test_prefetch_named(self):
+        for i in range(3):
+            Resource(type='test', names=['res'], owner=self.agent).save()
+        # References stored by name are resolved to canonical IDs
+        Resource._get_collection().update_many(
+            {}, {'$set': {'owner': 'test-agent'}})
+
+        resources = list(Resource.objects.prefetch_references('owner'))
+
+        for resource in resources:
+            self.assertEqual(resource.owner.id, self.agent.id)
+            # Only the ID was looked up: the partial document is not kept
+            self.assertIsNone(resource.owner._document)
+            self.assertEqual(resource.owner.fetch().type, 'test')
@@ -0,0 +1,205 @@
+from datetime import datetime, timedelta
+
+from django.test import override_settings
+
+from stormcore.apiserver.models import (
+    Event, Job, JobOutput, load_archived_job, prune_job_results,
+    retire_jobs, trim_events)
+from stormcore.apiserver.views import EventView
+
+from .base import MongoTestCase
+
+
+HOUR = 3600
+
+
+class RetentionTestCase(MongoTestCase):
+
+    def insert_job(self, job_id, status='done', age=None, **kwargs):
+        """Insert a job completed 'age' seconds ago."""
+        now = datetime.now()
+        doc = {
+            '_id': job_id,
+            'type': 'test',
+            'status': status,
+            'result': {},
+            'created': now - timedelta(seconds=age or 0),
+        }
+        if age is not None and status in ('done', 'error'):
+            doc['completed'] = now - timedelta(seconds=age)
+        doc.update(kwargs)
+        Job._get_collection().insert_one(doc)
+
+    def job_ids(self):
+        return sorted(Job.objects.scalar('id'))
+
+    def deleted_ids(self):
+        return sorted(
+            Event.objects.filter(event_type='deleted', entity_type='job')
+            .scalar('entity_id'))
+
+
+class RetireJobsTest(RetentionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.insert_job('job-old-done', 'done', 2 * HOUR)
+        self.insert_job('job-new-done', 'done', 0)
+        self.insert_job('job-old-error', 'error', 2 * HOUR)
+        self.insert_job('job-old-running', 'running', 2 * HOUR)
+        # Completed before completion dates were recorded
+        self.insert_job(
+            'job-legacy-done', 'done',
+            created=datetime.now() - timedelta(hours=2))
+
+    @override_settings(JOB_TTL={'done': None, 'error': None})
+    def test_disabled(self):
+        retire_jobs()
+
+        self.assertEqual(len(self.job_ids()), 5)
+        self.assertEqual(self.deleted_ids(), [])
+
+    @override_settings(JOB_TTL={'done': HOUR, 'error': None})
+    def test_delete(self):
+        JobOutput(job='job-old-done', offset=0, data='hello').save()
+        JobOutput(job='job-new-done', offset=0, data='hello').save()
+
+        retire_jobs()
+
+        self.assertEqual(
+            self.job_ids(),
+            ['job-new-done', 'job-old-error', 'job-old-running'])
+        self.assertEqual(
+            self.deleted_ids(), ['job-legacy-done', 'job-old-done'])
+        self.assertEqual(
+            list(JobOutput.objects.scalar('job')), ['job-new-done'])
+
+        # Events keep the last state of the jobs
+        event = Event.objects.get(entity_id='job-old-done')
+        self.assertEqual(event.get_entity_state()['status'], 'done')
+
+    @override_settings(
+        JOB_TTL={'done': HOUR, 'error': HOUR}, JOB_ARCHIVE=True)
+    def test_archive(self):
+        JobOutput(job='job-old-error', offset=0, data='hello ').save()
+        JobOutput(job='job-old-error', offset=6, data='world').save()
+
+        retire_jobs()
+
+        self.assertEqual(
+            self.job_ids(), ['job-new-done', 'job-old-running'])
+        self.assertEqual(
+            self.deleted_ids(),
+            ['job-legacy-done', 'job-old-done', 'job-old-error'])
+
+        archived = load_archived_job('job-old-error')
+        self.assertEqual(archived['status'], 'error')
+        self.assertIsNone(load_archived_job('job-new-done'))
+
+        archive = self.db['job_archive'].find_one({'_id': 'job-old-error'})
+        self.assertEqual(archive['status'], 'error')
+        self.assertIsNotNone(archive['output'])
+        self.assertEqual(JobOutput.objects.count(), 0)
+
+    @override_settings(JOB_TTL={'done': HOUR, 'error': HOUR})
+    def test_batches(self):
+        renewals = []
+
+        def renew():
+            renewals.append(True)
+            # The lease is lost after the first two batches
+            return len(renewals) < 2
+
+        retire_jobs(batch_size=1, renew=renew)
+
+        self.assertEqual(len(self.deleted_ids()), 2)
+        self.assertEqual(len(self.job_ids()), 3)
+
+
+class PruneJobResultsTest(RetentionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.insert_job(
+            'job-large-old', age=2 * HOUR, result={'x': 'y' * 100},
+            result_size=110)
+        self.insert_job(
+            'job-large-new', age=0, result={'x': 'y' * 100},
+            result_size=110)
+        self.insert_job(
+            'job-small-old', age=2 * HOUR, result={'x': 'y'},
+            result_size=10)
+
+    def pruned_ids(self):
+        return sorted(Job.objects.filter(result_pruned=True).scalar('id'))
+
+    @override_settings(JOB_RESULT_MAX_SIZE=None)
+    def test_disabled(self):
+        prune_job_results()
+
+        self.assertEqual(self.pruned_ids(), [])
+
+    @override_settings(JOB_RESULT_MAX_SIZE=50, JOB_RESULT_PRUNE_DELAY=HOUR)
+    def test_prune(self):
+        prune_job_results()
+
+        self.assertEqual(self.pruned_ids(), ['job-large-old'])
+        self.assertEqual(Job.objects.get(id='job-large-old').result, {})
+        self.assertEqual(
+            Job.objects.get(id='job-large-new').result, {'x': 'y' * 100})
+
+
+class TrimEventsTest(RetentionTestCase):
+
+    def insert_events(self, *event_ids, age=0):
+        date = datetime.now() - timedelta(seconds=age)
+        Event._get_collection().insert_many([
+            {'_id': event_id, 'date': date, 'event_type': 'created',
+             'entity_type': 'resource',
+             'entity_id': 'res-{}'.format(event_id)}
+            for event_id in event_ids])
+
+    def test_nothing_trimmed(self):
+        view = EventView()
+        self.assertIsNone(Event.objects.oldest_event_id())
+        self.assertIsNone(view._events_lost(0))
+
+        self.insert_events(1, 2, 3)
+
+        self.assertEqual(Event.objects.oldest_event_id(), 1)
+        self.assertIsNone(view._events_lost(1))
+
+    @override_settings(EVENT_RETENTION=HOUR, EVENT_MAX_COUNT=2)
+    def test_trim(self):
+        self.insert_events(1, 2, age=2 * HOUR)
+        self.insert_events(3, 4, 5, 6)
+
+        trim_events()
+
+        self.assertEqual(list(Event.objects.scalar('id')), [5, 6])
+        self.assertEqual(Event.objects.oldest_event_id(), 5)
+
+        view = EventView()
+        self.assertEqual(view._events_lost(1), 5)
+        self.assertEqual(view._events_lost(4), 5)
+        self.assertIsNone(view._events_lost(5))
+
+    @override_settings(EVENT_RETENTION=HOUR, EVENT_MAX_COUNT=None)
+    def test_trim_to_empty(self):
+        self.insert_events(1, 2, 3, age=2 * HOUR)
+
+        trim_events()
+
+        # The log is empty, but clients resuming from the deleted events
+        # still have to resync
+        self.assertEqual(Event.objects.count(), 0)
+        self.assertEqual(Event.objects.oldest_event_id(), 4)
+
+        view = EventView()
+        self.assertEqual(view._events_lost(2), 4)
+        self.assertIsNone(view._events_lost(4))
+
+        # Events created afterwards do not hide the deleted ones
+        self.insert_events(6)
+        self.assertEqual(Event.objects.oldest_event_id(), 6)
+        self.assertEqual(view._events_lost(3), 6)
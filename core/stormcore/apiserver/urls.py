@@ -18,4 +18,5 @@ router.register(r'jobs', views.JobViewSet)
 urlpatterns = [
     path('', include(router.urls)),
     path('events', views.EventView.as_view()),
+    path('metrics', views.MetricsView.as_view()),
 ]
@@ -2,50 +2,63 @@ import json
 import time
 from datetime import datetime
 
-import pymongo.cursor
-from pymongo.errors import OperationFailure
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError, OperationFailure
 
 from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.views.generic import View
 
 from rest_framework import status, mixins
-from rest_framework.decorators import detail_route
+from rest_framework.decorators import detail_route, list_route
 from rest_framework.exceptions import APIException
 from rest_framework.response import Response
+from rest_framework.views import APIView
 
-from mongoengine import DoesNotExist, MultipleObjectsReturned
+from mongoengine import DoesNotExist, MultipleObjectsReturned, ValidationError
 
 from rest_framework_mongoengine.viewsets import (
     ModelViewSet, ReadOnlyModelViewSet)
 
+from stormcore.apiserver.dispatcher import EventDispatcher
+from stormcore.apiserver.hub import HubItem, get_hub
 from stormcore.apiserver.models import (
     Agent,
     Application,
     Event,
     Group,
     Job,
+    JobOutput,
     Procedure,
     Resource,
     Subscription,
-    cleanup_expired_agents,
     user_query_filter,
 )
+from stormcore.apiserver.pagination import KeysetPagination
 
 from stormcore.apiserver.serializers import (
+    AgentHeartbeatsSerializer,
     AgentSerializer,
     ApplicationSerializer,
     EventSerializer,
     GroupAddRemoveMembersSerializer,
     GroupSerializer,
+    JobClaimSerializer,
     JobCompleteSerializer,
     JobHandleSerializer,
+    JobOutputAppendSerializer,
+    JobOutputSerializer,
     JobSerializer,
+    JobWaitSerializer,
+    JobsWaitSerializer,
     ProcedureAttachSerializer,
     ProcedureExecSerializer,
     ProcedureSerializer,
+    ResourceBulkItemSerializer,
     ResourceSerializer,
     SubscriptionSerializer,
+    serialize_entities,
 )
+from stormcore.apiserver.templates import QueryBudgetExceeded
 
 
 def request_query_filter(request, queryset):
@@ -77,6 +90,59 @@ def request_query_filter(request, queryset):
     return queryset
 
 
+def request_projection(request, serializer_class):
+    """Return the names of the fields selected with the 'fields' and
+    'exclude' parameters, or None if no fields were selected.
+    """
+    fields = request.GET.get('fields')
+    exclude = request.GET.get('exclude')
+
+    if not fields and not exclude:
+        return None
+
+    available_fields = serializer_class.Meta.fields
+    projection = set(available_fields)
+
+    for param, value in (('fields', fields), ('exclude', exclude)):
+        if not value:
+            continue
+
+        names = set(value.split(','))
+        unknown_names = names.difference(available_fields)
+        if unknown_names:
+            detail = {param: ['Unknown fields: {}'.format(
+                ', '.join(sorted(unknown_names)))]}
+            raise MalformedQueryError(detail=detail)
+
+        if param == 'fields':
+            projection &= names
+        else:
+            projection -= names
+
+    # The ID is always returned
+    projection.add('id')
+
+    return projection
+
+
+def projection_queryset(queryset, projection):
+    """Load only the fields in the projection, if any."""
+    if projection is not None:
+        queryset = queryset.only(*projection)
+    return queryset
+
+
+def projection_serializer(serializer, projection):
+    """Return only the fields in the projection, if any."""
+    if projection is not None:
+        # Serializers for lists have a 'child' serializer
+        fields = getattr(serializer, 'child', serializer).fields
+        for name in list(fields):
+            if name not in projection:
+                del fields[name]
+    return serializer
+
+
 class MalformedQueryError(APIException):
 
     status_code = 400
@@ -98,6 +164,73 @@ class QueryFilterMixin:
         return queryset
 
 
+class ProjectionMixin:
+    """
+    This mixin allows selecting the fields to return with the 'fields' and
+    'exclude' parameters (example: 'GET /v1/resources?exclude=snapshot').
+    Fields that are not selected are not loaded from the database. This has
+    effect only when listing the collection or retrieving a single object.
+    """
+
+    def get_projection(self):
+        if self.request.method != 'GET' or \
+                self.action not in ('list', 'retrieve'):
+            return None
+        if not hasattr(self, '_projection'):
+            self._projection = request_projection(
+                self.request, self.get_serializer_class())
+        return self._projection
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        return projection_queryset(queryset, self.get_projection())
+
+    def get_serializer(self, *args, **kwargs):
+        serializer = super().get_serializer(*args, **kwargs)
+        return projection_serializer(serializer, self.get_projection())
+
+
+class PrefetchReferencesMixin:
+    """
+    This mixin resolves the references of the documents in a list with
+    batched queries, instead of one query for every reference.
+    """
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action == 'list':
+            queryset = queryset.prefetch_references()
+        return queryset
+
+
+def set_event_cursor(response, last_event_id):
+    """Add the 'X-Last-Event-Id' header to a response."""
+    response['X-Last-Event-Id'] = str(
+        last_event_id if last_event_id is not None else 0)
+    return response
+
+
+class EventCursorMixin:
+    """
+    This mixin adds the 'X-Last-Event-Id' header to lists: the ID of the
+    last event recorded before the collection was read (0 if there is
+    none). Documents are saved before their events are recorded, so every
+    change with an event up to that ID is reflected in the list, and every
+    later change has an event with a higher ID. Clients can list a
+    collection once, then stream events starting from the next ID to keep
+    up to date. Some of those events may describe changes that were
+    already reflected in the list: applying them again must be harmless.
+
+    When paginating, the header of the first page must be used.
+    """
+
+    def list(self, request, *args, **kwargs):
+        # The event ID must be read before the documents
+        last_event_id = Event.objects.last_event_id()
+        response = super().list(request, *args, **kwargs)
+        return set_event_cursor(response, last_event_id)
+
+
 class LookupMixin:
     """Mixin that allows looking up objects using more than one field."""
 
@@ -114,15 +247,18 @@ class LookupMixin:
             raise Http404
 
 
-class StormViewSet(LookupMixin, QueryFilterMixin, ModelViewSet):
+class StormViewSet(
+        LookupMixin, EventCursorMixin, ProjectionMixin,
+        PrefetchReferencesMixin, QueryFilterMixin, ModelViewSet):
 
-    pass
+    pagination_class = KeysetPagination
 
 
 class StormReadOnlyViewSet(
-        LookupMixin, QueryFilterMixin, ReadOnlyModelViewSet):
+        LookupMixin, EventCursorMixin, ProjectionMixin,
+        PrefetchReferencesMixin, QueryFilterMixin, ReadOnlyModelViewSet):
 
-    pass
+    pagination_class = KeysetPagination
 
 
 class AgentViewSet(StormViewSet):
@@ -130,24 +266,279 @@ class AgentViewSet(StormViewSet):
     queryset = Agent.objects.all()
     serializer_class = AgentSerializer
 
-    def dispatch(self, *args, **kwargs):
-        cleanup_expired_agents()
-        return super().dispatch(*args, **kwargs)
+    # Maximum number of agents accepted by a single heartbeats request
+    MAX_HEARTBEAT_AGENTS = 1000
 
     @detail_route(methods=['POST'])
     def heartbeat(self, request, **kwargs):
         agent = self.get_object()
-        agent.status = 'online'
-        agent.heartbeat = datetime.now()
-        agent.save()
+        Agent.objects.filter(id=agent.id).record_heartbeat()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @list_route(methods=['POST'])
+    def heartbeats(self, request):
+        """
+        Send the heartbeats of many agents with a single request.
+
+        The request body lists the IDs or names of the agents:
+
+            {"agents": ["agt-XXX", "my-agent", ...]}
+
+        The response lists the agents that were not found:
+
+            {"not_found": ["my-agent"]}
+        """
+        serializer = AgentHeartbeatsSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(
+                serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        keys = serializer.validated_data['agents']
+        if len(keys) > self.MAX_HEARTBEAT_AGENTS:
+            return Response(
+                {'agents': ['Too many agents (maximum is {})'.format(
+                    self.MAX_HEARTBEAT_AGENTS)]},
+                status=status.HTTP_400_BAD_REQUEST)
+
+        queryset = Agent.objects(__raw__={'$or': [
+            {'_id': {'$in': keys}},
+            {'name': {'$in': keys}},
+        ]})
+
+        found = set()
+        for agent_id, name in queryset.scalar('id', 'name'):
+            found.update((agent_id, name))
+
+        if found:
+            queryset.record_heartbeat()
+
+        return Response({
+            'not_found': [key for key in keys if key not in found],
+        })
+
 
 class ResourceViewSet(StormViewSet):
 
     queryset = Resource.objects.all()
     serializer_class = ResourceSerializer
 
+    # Maximum number of items accepted by a single bulk request
+    MAX_BULK_ITEMS = 1000
+
+    @list_route(methods=['POST'])
+    def bulk(self, request):
+        """
+        Create, update and delete many resources with a single request.
+
+        The request body is a list of items, applied in order:
+
+            [
+                {"op": "upsert", "id": "res-XXX", "data": {...}},
+                {"op": "upsert", "data": {...}},
+                {"op": "delete", "id": "res-YYY"},
+                ...
+            ]
+
+        Like for single resources, "id" can be an ID or a name. Upserts
+        update the resource if it exists, or create it otherwise. Created
+        resources get a new ID. If "id" is a name, it is kept among the
+        names of the resource, so that repeating the upsert updates the
+        same resource. Upserting an ID that does not exist fails. Writes
+        are sent to the database in batches.
+
+        The response is a list with the result of every item, in the same
+        order: {"status": <HTTP status code>, "id": ..., "errors": ...}.
+        """
+        if not isinstance(request.data, list):
+            return Response(
+                {'non_field_errors': ['Expected a list of items']},
+                status=status.HTTP_400_BAD_REQUEST)
+
+        if len(request.data) > self.MAX_BULK_ITEMS:
+            return Response(
+                {'non_field_errors': [
+                    'Too many items (maximum: {})'.format(
+                        self.MAX_BULK_ITEMS)]},
+                status=status.HTTP_400_BAD_REQUEST)
+
+        serializer = ResourceBulkItemSerializer(data=request.data, many=True)
+        if not serializer.is_valid():
+            return Response(
+                serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        items = serializer.validated_data
+
+        documents = self._bulk_lookup(
+            item['id'] for item in items if item.get('id'))
+        context = {'request': request, 'lookup_cache': {}}
+
+        results = [None] * len(items)
+        pending = []
+
+        for index, item in enumerate(items):
+            key = item.get('id')
+            matches = documents.get(key, []) if key else []
+
+            if len(matches) > 1:
+                results[index] = {
+                    'status': status.HTTP_404_NOT_FOUND,
+                    'id': key,
+                    'errors': {'id': ['Multiple resources match']},
+                }
+                continue
+
+            document = matches[0] if matches else None
+
+            if item['op'] == 'delete':
+                # Apply pending writes first, so that items are applied in
+                # order
+                self._bulk_write(pending, results)
+                pending = []
+
+                if document is None:
+                    results[index] = {
+                        'status': status.HTTP_404_NOT_FOUND, 'id': key}
+                    continue
+
+                # Deletions go through the document, so that reverse
+                # delete rules are applied
+                document.delete()
+                self._bulk_unindex(documents, document)
+                results[index] = {
+                    'status': status.HTTP_204_NO_CONTENT, 'id': document.id}
+                continue
+
+            serializer = ResourceSerializer(
+                document, data=item.get('data', {}), context=context)
+            if not serializer.is_valid():
+                results[index] = {
+                    'status': status.HTTP_400_BAD_REQUEST,
+                    'id': key,
+                    'errors': serializer.errors,
+                }
+                continue
+
+            created = document is None
+            if created and key and key.startswith(
+                    Resource._meta['id_prefix']):
+                # IDs are allocated by the server: this resource is gone
+                results[index] = {
+                    'status': status.HTTP_404_NOT_FOUND, 'id': key}
+                continue
+
+            if created:
+                document = Resource()
+            else:
+                self._bulk_unindex(documents, document)
+            for name, value in serializer.validated_data.items():
+                setattr(document, name, value)
+            if key and key != document.id and \
+                    key not in (document.names or ()):
+                # Keep the key as a name, so that repeating the upsert
+                # updates this resource instead of creating another one
+                document.names = list(document.names or ()) + [key]
+
+            try:
+                document.validate()
+            except ValidationError as exc:
+                results[index] = {
+                    'status': status.HTTP_400_BAD_REQUEST,
+                    'id': key,
+                    'errors': exc.to_dict(),
+                }
+                continue
+
+            # Further items with the same key, or another ID or name of
+            # this document, refer to it
+            if key:
+                documents[key] = [document]
+            self._bulk_index(documents, document)
+
+            pending.append((index, document, created))
+
+        self._bulk_write(pending, results)
+
+        return Response(results)
+
+    def _bulk_lookup(self, keys):
+        """Return a dictionary mapping every key to the list of resources
+        having that ID or name.
+        """
+        keys = list(set(keys))
+        documents = {key: [] for key in keys}
+
+        if not keys:
+            return documents
+
+        queryset = Resource.objects(__raw__={'$or': [
+            {'_id': {'$in': keys}},
+            {'names': {'$in': keys}},
+        ]})
+
+        for document in queryset:
+            for key in {document.id, *document.names}:
+                if key in documents:
+                    documents[key].append(document)
+
+        return documents
+
+    def _bulk_index(self, documents, document):
+        """Add the document to the entries of its ID and names in the
+        dictionary returned by _bulk_lookup().
+        """
+        for key in {document.id, *(document.names or ())}:
+            matches = documents.get(key)
+            if matches is not None and \
+                    not any(match is document for match in matches):
+                matches.append(document)
+
+    def _bulk_unindex(self, documents, document):
+        """Remove the document from all the entries of the dictionary
+        returned by _bulk_lookup().
+        """
+        for key, matches in documents.items():
+            documents[key] = [
+                match for match in matches if match is not document]
+
+    def _bulk_write(self, pending, results):
+        if not pending:
+            return
+
+        requests = []
+
+        for index, document, created in pending:
+            # to_mongo() generates the IDs of new documents
+            son = document.to_mongo()
+            requests.append(ReplaceOne({'_id': son['_id']}, son, upsert=True))
+
+        failed = {}
+
+        try:
+            Resource._get_collection().bulk_write(requests, ordered=False)
+        except BulkWriteError as exc:
+            for error in exc.details['writeErrors']:
+                failed[error['index']] = error['errmsg']
+
+        for position, (index, document, created) in enumerate(pending):
+            if position in failed:
+                results[index] = {
+                    'status': status.HTTP_400_BAD_REQUEST,
+                    'id': document.id,
+                    'errors': {'non_field_errors': [failed[position]]},
+                }
+                continue
+
+            # Documents were written bypassing save(), so the post_save
+            # signal was not sent: record the events here
+            Event.objects.record_event(
+                'created' if created else 'updated', document)
+
+            if created:
+                result_status = status.HTTP_201_CREATED
+            else:
+                result_status = status.HTTP_200_OK
+
+            results[index] = {'status': result_status, 'id': document.id}
+
 
 class GroupViewSet(StormViewSet):
 
@@ -156,15 +547,30 @@ class GroupViewSet(StormViewSet):
 
     @detail_route(methods=['GET', 'POST'])
     def members(self, request, id=None):
-        cleanup_expired_agents()
+        if request.method == 'GET':
+            # Read before the group: see EventCursorMixin
+            last_event_id = Event.objects.last_event_id()
 
         group = self.get_object()
 
         if request.method == 'GET':
-            queryset = group.members()
+            projection = request_projection(request, ResourceSerializer)
+
+            queryset = group.members().prefetch_references()
             queryset = request_query_filter(self.request, queryset)
+            queryset = projection_queryset(queryset, projection)
+
+            page = self.paginate_queryset(queryset)
+            if page is not None:
+                serializer = ResourceSerializer(page, many=True)
+                serializer = projection_serializer(serializer, projection)
+                return set_event_cursor(
+                    self.get_paginated_response(serializer.data),
+                    last_event_id)
+
             serializer = ResourceSerializer(queryset, many=True)
-            return Response(serializer.data)
+            serializer = projection_serializer(serializer, projection)
+            return set_event_cursor(Response(serializer.data), last_event_id)
 
         if request.method == 'POST':
             serializer = GroupAddRemoveMembersSerializer(data=request.data)
@@ -208,11 +614,17 @@ class ProcedureViewSet(StormViewSet):
             return Response(
                 serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-        job = procedure.exec(
-            target=serializer.validated_data['target'],
-            options=serializer.validated_data['options'],
-            params=serializer.validated_data['params'],
-        )
+        try:
+            job = procedure.exec(
+                target=serializer.validated_data['target'],
+                options=serializer.validated_data['options'],
+                params=serializer.validated_data['params'],
+                priority=serializer.validated_data.get('priority'),
+                queue=serializer.validated_data.get('queue'),
+            )
+        except QueryBudgetExceeded as exc:
+            return Response(
+                {'content': [str(exc)]}, status=status.HTTP_400_BAD_REQUEST)
 
         serializer = JobSerializer(job)
         return Response(serializer.data)
@@ -237,6 +649,195 @@ class JobViewSet(mixins.DestroyModelMixin, StormReadOnlyViewSet):
     queryset = Job.objects.all()
     serializer_class = JobSerializer
 
+    # Keep the order of creation when paginating (see KeysetPagination)
+    keyset_ordering = ('created', 'id')
+
+    # While waiting for jobs, their status is checked at least this often
+    # (in seconds), even if no job event is received
+    WAIT_RETRY_INTERVAL = 5
+
+    # When following the output of a job, how often to check for new output
+    OUTPUT_POLL_INTERVAL = .5
+
+    @list_route(methods=['POST'])
+    def claim(self, request):
+        """
+        Atomically assign pending jobs to an agent.
+
+        The request body specifies the agent and which jobs it can handle:
+
+            {
+                "owner": "agt-XXX",
+                "type": "swarm",
+                "target": {"owner": "agt-XXX"},
+                "count": 10,
+                "timeout": 30
+            }
+
+        'type' and 'target' (a query on the targets of jobs) are optional.
+        Up to 'count' pending jobs are set to 'running' and returned. Every
+        job is handed out to a single agent. If no job is pending, the
+        request waits up to 'timeout' seconds for new jobs; the response is
+        an empty list if none arrives. The targets matching 'target' are
+        looked up once, when the request is received.
+        """
+        serializer = JobClaimSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(
+                serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        data = serializer.validated_data
+        owner = data['owner']
+
+        deadline = time.monotonic() + data['timeout']
+
+        # Subscribe before looking for jobs, so that jobs created in the
+        # meantime (or jobs of the agent completing, if it is running as
+        # many jobs as it can) are not missed
+        with get_hub().subscribe() as client:
+            queryset = self._get_claimable_jobs(data)
+
+            while True:
+                count = min(data['count'], self._get_job_slots(owner))
+                if count:
+                    jobs = queryset.claim(owner.id, count)
+                    # Only new jobs can be claimed now
+                    running_ids = ()
+                else:
+                    jobs = []
+                    # The agent is running as many jobs as it can: more
+                    # jobs can be claimed once one of them completes
+                    running_ids = set(Job.objects.filter(
+                        owner=owner.id, status='running').scalar('id'))
+
+                # Jobs made pending again by restore_orphaned_jobs() do not
+                # have events: they are found by the periodic checks
+                if jobs or not self._wait_job_event(
+                        client, deadline, running_ids, created=True):
+                    break
+
+        serializer = JobSerializer(jobs, many=True)
+        return Response(serializer.data)
+
+    @detail_route(methods=['GET'])
+    def wait(self, request, **kwargs):
+        """
+        Wait for a job to complete.
+
+        Return the job once it is complete, or once 'timeout' seconds have
+        passed (example: 'GET /v1/jobs/job-XXX/wait?timeout=30'). Clients
+        must check the status of the job to know which one happened.
+        """
+        job = self.get_object()
+
+        serializer = JobWaitSerializer(data=request.GET)
+        if not serializer.is_valid():
+            return Response(
+                serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        jobs = self._wait_jobs(
+            [job.id], 'all', serializer.validated_data['timeout'])
+        if not jobs:
+            raise Http404
+
+        serializer = JobSerializer(jobs[0])
+        return Response(serializer.data)
+
+    @list_route(methods=['POST'], url_path='wait')
+    def wait_many(self, request):
+        """
+        Wait for many jobs to complete.
+
+        The request body lists the jobs to wait for:
+
+            {"jobs": ["job-XXX", "job-YYY"], "mode": "all", "timeout": 30}
+
+        With mode 'all' (the default), the request returns when all the
+        jobs are complete; with mode 'any', as soon as one of them is.
+        Either way, it returns after 'timeout' seconds. The response is the
+        list of the jobs, in their current state. Jobs that do not exist
+        (or were deleted while waiting) are left out and count as complete.
+        """
+        serializer = JobsWaitSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(
+                serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        data = serializer.validated_data
+
+        jobs = self._wait_jobs(data['jobs'], data['mode'], data['timeout'])
+
+        serializer = JobSerializer(jobs, many=True)
+        return Response(serializer.data)
+
+    def _wait_jobs(self, job_ids, mode, timeout):
+        deadline = time.monotonic() + timeout
+        job_ids = set(job_ids)
+        check = all if mode == 'all' else any
+
+        with get_hub().subscribe() as client:
+            while True:
+                jobs = list(Job.objects.filter(id__in=list(job_ids)))
+
+                complete_ids = job_ids - {job.id for job in jobs}
+                complete_ids.update(
+                    job.id for job in jobs if job.status in ('done', 'error'))
+
+                if check(job_id in complete_ids for job_id in job_ids):
+                    return jobs
+                if not self._wait_job_event(client, deadline, job_ids):
+                    return jobs
+
+    def _wait_job_event(self, client, deadline, job_ids, created=False):
+        """Wait for an event about the given jobs, or, if 'created' is true,
+        for a job to be created.
+
+        Return False if the deadline expires first. Return True when an
+        event is received, or after WAIT_RETRY_INTERVAL seconds.
+        """
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+
+            timeout = min(remaining, self.WAIT_RETRY_INTERVAL)
+            item = client.get(timeout=timeout)
+
+            if item is None:
+                if client.overflowed:
+                    time.sleep(timeout)
+                return True
+
+            event = item.event
+            if event.entity_type != 'job':
+                continue
+            if event.entity_id in job_ids or (
+                    created and event.event_type == 'created'):
+                return True
+
+    def _get_claimable_jobs(self, data):
+        queryset = Job.objects.filter(status='pending')
+
+        if data.get('type'):
+            queryset = queryset.filter(type=data['type'])
+
+        if data.get('target'):
+            targets = user_query_filter(data['target'], Resource.objects)
+            queryset = queryset.filter(target__in=list(targets.scalar('id')))
+
+        return queryset
+
+    def _get_job_slots(self, agent):
+        """Return how many more jobs the given agent can run.
+
+        The limit is not enforced atomically: concurrent requests for the
+        same agent may exceed it.
+        """
+        limit = agent.get_max_concurrent_jobs()
+        if limit is None:
+            return JobClaimSerializer.MAX_COUNT
+
+        running = Job.objects.filter(owner=agent.id, status='running').count()
+        return max(limit - running, 0)
+
     @detail_route(methods=['POST'])
     def handle(self, request, **kwargs):
         job = self.get_object()
@@ -247,10 +848,17 @@ class JobViewSet(mixins.DestroyModelMixin, StormReadOnlyViewSet):
                 serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         owner = serializer.validated_data['owner']
 
+        if not self._get_job_slots(owner):
+            return Response(
+                {'owner': ['Agent is running too many jobs']},
+                status=status.HTTP_409_CONFLICT)
+
         # Atomically transition the status from 'pending' to 'running', setting
         # the owner at the same time
         qs = Job.objects.filter(id=job.id, status='pending')
-        qs.update(set__status='running', set__owner=owner.id)
+        qs.update(
+            set__status='running', set__owner=owner.id,
+            set__started=datetime.now())
 
         # Check the status of the job. Because we used an atomic operation,
         # the scenarios are three:
@@ -298,13 +906,88 @@ class JobViewSet(mixins.DestroyModelMixin, StormReadOnlyViewSet):
                 {'status': ["Job is not in 'running' state"]},
                 status=status.HTTP_409_CONFLICT)
 
-        job.owner = None
-        job.status = final_status
-        job.result = result
-        job.save()
+        job.complete(final_status, result)
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @detail_route(methods=['GET', 'POST'])
+    def output(self, request, **kwargs):
+        """
+        Read or append to the output of a job.
+
+        'GET' returns the output as plain text, starting from the character
+        offset given with the 'offset' parameter (0 by default). The
+        'X-Output-Offset' header is the offset to pass to read the rest of
+        the output later. With 'follow=true', the response is streamed
+        until the job is complete (example:
+        'GET /v1/jobs/job-XXX/output?offset=0&follow=true').
+
+        'POST' appends to the output of a running job:
+
+            {"data": "..."}
+
+        The response is the offset of the data in the output.
+        """
+        job = self.get_object()
+
+        if request.method == 'POST':
+            return self._append_output(request, job)
+
+        serializer = JobOutputSerializer(data=request.GET)
+        if not serializer.is_valid():
+            return Response(
+                serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        data = serializer.validated_data
+
+        content_type = 'text/plain; charset=utf-8'
+
+        if data['follow']:
+            return StreamingHttpResponse(
+                self._iter_output(job.id, data['offset']),
+                content_type=content_type)
+
+        output = []
+        offset = data['offset']
+        skip_gaps = job.status in ('done', 'error')
+
+        for chunk, offset in JobOutput.objects.read(
+                job.id, offset, skip_gaps=skip_gaps):
+            output.append(chunk)
+
+        response = HttpResponse(''.join(output), content_type=content_type)
+        response['X-Output-Offset'] = str(offset)
+        return response
+
+    def _append_output(self, request, job):
+        serializer = JobOutputAppendSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(
+                serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        offset = job.append_output(serializer.validated_data['data'])
+        if offset is None:
+            return Response(
+                {'status': ["Job is not in 'running' state"]},
+                status=status.HTTP_409_CONFLICT)
+
+        return Response({'offset': offset})
+
+    def _iter_output(self, job_id, offset):
+        while True:
+            # Check the status before reading: all the output appended
+            # before the job completed is read below
+            job = Job.objects.filter(id=job_id).only('status').first()
+            complete = job is None or job.status in ('done', 'error')
+
+            for chunk, offset in JobOutput.objects.read(
+                    job_id, offset, skip_gaps=complete):
+                yield chunk
+
+            if complete:
+                return
+
+            time.sleep(self.OUTPUT_POLL_INTERVAL)
+
 
 class SubscriptionViewSet(mixins.DestroyModelMixin, StormReadOnlyViewSet):
 
@@ -329,10 +1012,34 @@ class EventView(View):
         last_event = self.queryset.only('id').order_by('-id').first()
         return last_event.id if last_event is not None else -1
 
+    # Values accepted by the 'include' parameter
+    INCLUDE_CHOICES = ('entity',)
+
     def get(self, request):
         streaming = self.request.GET.get('stream', False)
         from_id = count = None
 
+        # With 'include=entity', the serialized entity is sent along with
+        # every event, optionally restricted to the fields listed in
+        # 'entity_fields'
+        include = self.request.GET.get('include')
+        if include and include not in self.INCLUDE_CHOICES:
+            return self.bad_request({'include': [
+                'Expected one of: {}'.format(
+                    ', '.join(self.INCLUDE_CHOICES))]})
+        self.include_entity = include == 'entity'
+
+        entity_fields = self.request.GET.get('entity_fields')
+        if entity_fields:
+            # The ID is always returned
+            self.entity_fields = set(entity_fields.split(',')) | {'id'}
+        else:
+            self.entity_fields = None
+
+        # With 'entity_type', only the events about entities of that type
+        # are returned (example: 'entity_type=resource')
+        self.entity_type = self.request.GET.get('entity_type') or None
+
         try:
             from_id = int(self.request.GET['start'])
         except (KeyError, TypeError, ValueError):
@@ -355,55 +1062,148 @@ class EventView(View):
             last_event_id = self._last_event_id()
             from_id = last_event_id - count + 1
 
-        qs = self.queryset.filter(
+        qs = self._filter_events(self.queryset.filter(
             id__gte=from_id,
-            id__lt=from_id + count)
+            id__lt=from_id + count))
+
+        events = list(qs)
+        data = EventSerializer(events, many=True).data
 
-        serializer = EventSerializer(qs, many=True)
+        if self.include_entity:
+            entities = serialize_entities(events)
+            for event, item in zip(events, data):
+                item['entity'] = self._project_entity(entities[event.id])
 
         response = HttpResponse(content_type='application/json')
-        json.dump(serializer.data, response)
+        json.dump(data, response)
+
+        # Lets clients know if the events they asked for were deleted
+        oldest_event_id = self.queryset.oldest_event_id()
+        if oldest_event_id is not None:
+            response['X-Oldest-Event-Id'] = str(oldest_event_id)
 
         return response
 
+    def bad_request(self, detail):
+        return HttpResponse(
+            json.dumps(detail), status=400, content_type='application/json')
+
+    def _filter_events(self, queryset):
+        if self.entity_type is None:
+            return queryset
+        return queryset.filter(entity_type=self.entity_type)
+
+    def _project_entity(self, entity):
+        if entity is None or self.entity_fields is None:
+            return entity
+        return {
+            key: value for key, value in entity.items()
+            if key in self.entity_fields
+        }
+
+    def _item_line(self, item):
+        if not self.include_entity:
+            return item.line
+        data = dict(item.data, entity=self._project_entity(item.get_entity()))
+        return json.dumps(data) + '\n'
+
+    def _events_lost(self, from_id):
+        """Return the ID of the oldest event retained if events starting
+        from 'from_id' were deleted from the log, None otherwise.
+        """
+        oldest_event_id = self.queryset.oldest_event_id()
+        # IDs start from 1: if the oldest event is the first one, nothing
+        # was ever deleted
+        if oldest_event_id is not None and oldest_event_id > 1 and \
+                from_id < oldest_event_id:
+            return oldest_event_id
+        return None
+
     def streaming_response(self, from_id=None):
         return StreamingHttpResponse(
             self.iter_realtime_events(from_id),
             content_type='application/json')
 
     def iter_realtime_events(self, from_id=None):
-        if from_id is None:
-            last_event_id = self._last_event_id()
-        else:
-            last_event_id = from_id - 1
+        # Subscribe to the hub before reading past events from the database:
+        # this way no event can be missed between the two. Events that are
+        # both read from the database and received from the hub are sent
+        # only once.
+        with get_hub().subscribe() as client:
+            # Begin by sending an empty line: this ensures that the response
+            # headers are sent by Gunicorn. If we didn't do that, clients
+            # would hang in case no events are delivered.
+            yield '\n'
+
+            sent_ids = set()
+            next_start = from_id
+
+            if from_id is not None:
+                oldest_event_id = self._events_lost(from_id)
+                if oldest_event_id is not None:
+                    # Some of the events the client asked for are gone: it
+                    # has to rebuild its state, then it can resume from the
+                    # oldest event available
+                    yield json.dumps({
+                        'resync': 'lost',
+                        'start': oldest_event_id,
+                    }) + '\n'
+                    return
+
+                for ev in self._filter_events(
+                        self.queryset.filter(id__gte=from_id)):
+                    item = HubItem.from_event(ev)
+                    yield self._item_line(item)
+                    sent_ids.add(item.id)
+                    next_start = max(next_start, item.id + 1)
+
+            while True:
+                item = client.get(timeout=self.KEEP_ALIVE_TIME)
+
+                if item is None:
+                    if client.overflowed:
+                        # The client could not keep up with the events and
+                        # has been dropped by the hub: tell it where to
+                        # resume from and close the connection.
+                        yield json.dumps({
+                            'resync': 'overflow',
+                            'start': next_start,
+                        }) + '\n'
+                        return
 
-        last_line_timestamp = time.time()
-
-        new_events_qs = self.queryset.filter(id__gt=last_event_id)
-
-        # Begin by sending an empty line: this ensures that the response
-        # headers are sent by Gunicorn. If we didn't do that, clients would
-        # hang in case no events are delivered.
-        yield '\n'
-
-        while True:
-            cursor = new_events_qs._collection.find(
-                new_events_qs._query,
-                cursor_type=pymongo.cursor.CursorType.TAILABLE_AWAIT)
-
-            while cursor.alive:
-                for doc in cursor:
-                    ev = Event._from_son(doc)
-                    serializer = EventSerializer(ev)
-                    yield json.dumps(serializer.data) + '\n'
-                    last_event_id = ev.id
-
-                if time.time() - last_line_timestamp >= self.KEEP_ALIVE_TIME:
                     # If no events are to be sent, send a blank line every
                     # KEEP_ALIVE_TIME seconds to ensure that the connection
                     # is kept alive and does not time out.
                     yield '\n'
+                    continue
+
+                if from_id is not None and item.id < from_id:
+                    continue
+                if item.id in sent_ids:
+                    continue
 
-                last_line_timestamp = time.time()
+                if next_start is not None and item.id > next_start:
+                    # The hub skipped events that took too long to show
+                    # up: look for them in the database
+                    for ev in self._filter_events(self.queryset.filter(
+                            id__gte=next_start, id__lt=item.id)):
+                        if ev.id not in sent_ids:
+                            yield self._item_line(HubItem.from_event(ev))
+                            sent_ids.add(ev.id)
 
-                time.sleep(1)
+                # Events about other types of entities are skipped, but
+                # still move the starting point forward
+                if self.entity_type in (None, item.event.entity_type):
+                    yield self._item_line(item)
+
+                if next_start is None or item.id >= next_start:
+                    next_start = item.id + 1
+
+
+class MetricsView(APIView):
+
+    def get(self, request):
+        return Response({
+            'dispatcher': EventDispatcher.get_metrics(),
+            'job_queues': Job.objects.get_queue_metrics(),
+        })
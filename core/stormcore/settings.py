@@ -122,3 +122,70 @@ DEFAULT_MONGODB_URI = 'mongodb://127.0.0.1/perfectstorm'
 MONGODB_URI = os.environ.get('STORM_MONGO') or DEFAULT_MONGODB_URI
 
 mongoengine.connect(host=MONGODB_URI, connect=False)
+
+
+# Job retention
+#
+# Complete jobs are removed once they are older than the TTL for their
+# status (STORM_JOB_TTL_DONE, STORM_JOB_TTL_ERROR), in seconds, recording
+# a 'deleted' event for each of them. If STORM_JOB_ARCHIVE is set, jobs
+# are moved to the 'job_archive' collection (compressed) instead of being
+# deleted.
+#
+# Results larger than STORM_JOB_RESULT_MAX_SIZE bytes (JSON-encoded) are
+# pruned STORM_JOB_RESULT_PRUNE_DELAY seconds after completion.
+#
+# Retention is disabled by default: jobs and their results are kept
+# forever unless these settings are given.
+
+def _get_int_env(name, default=None):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return int(value) if value else None
+
+
+JOB_TTL = {
+    'done': _get_int_env('STORM_JOB_TTL_DONE'),
+    'error': _get_int_env('STORM_JOB_TTL_ERROR'),
+}
+
+JOB_ARCHIVE = bool(os.environ.get('STORM_JOB_ARCHIVE'))
+
+JOB_RESULT_MAX_SIZE = _get_int_env('STORM_JOB_RESULT_MAX_SIZE')
+JOB_RESULT_PRUNE_DELAY = _get_int_env('STORM_JOB_RESULT_PRUNE_DELAY', 3600)
+
+
+# Job scheduling
+#
+# Weights of the job queues, for fair queueing. STORM_JOB_QUEUE_WEIGHTS is
+# a comma-separated list of 'queue=weight' items, where 'queue' is either a
+# full queue name ('group:grp-XXX') or a kind of queue ('procedure',
+# 'group'). Queues get 1 by default.
+
+def _get_weights_env(name):
+    weights = {}
+    for item in (os.environ.get(name) or '').split(','):
+        if not item.strip():
+            continue
+        queue, weight = item.rsplit('=', 1)
+        weight = float(weight)
+        if weight <= 0:
+            raise ValueError(
+                '{}: weights must be positive, got {!r}'.format(name, item))
+        weights[queue.strip()] = weight
+    return weights
+
+
+JOB_QUEUE_WEIGHTS = _get_weights_env('STORM_JOB_QUEUE_WEIGHTS')
+
+
+# Event retention
+#
+# Events are deleted once they are older than STORM_EVENT_RETENTION
+# seconds, and when there are more than STORM_EVENT_MAX_COUNT of them. An
+# empty value disables the limit. Clients resuming a stream from an event
+# that was deleted are asked to resync.
+
+EVENT_RETENTION = _get_int_env('STORM_EVENT_RETENTION', 7 * 24 * 3600)
+EVENT_MAX_COUNT = _get_int_env('STORM_EVENT_MAX_COUNT', 1000000)
@@ -9,5 +9,6 @@ setup(
     ],
     extras_require={
         'gevent': ['gevent >= 1.2, < 1.3'],
+        'asyncio': ['aiohttp >= 3.3, < 4'],
     },
 )
@@ -9,6 +9,7 @@ from .models import (
     Procedure,
     Resource,
     Subscription,
+    wait_all,
 )
 from .session import connect
 
@@ -23,6 +24,7 @@ __all__ = [
     'Resource',
     'Subscription',
     'connect',
+    'wait_all',
 ]
 
 version_info = (0, 1)
@@ -0,0 +1,573 @@
+"""
+asyncio support, using aiohttp.
+
+An AsyncSession is the asyncio counterpart of Session. Collections, models
+and event streams bound to it are used with 'await' and 'async for':
+
+    async with AsyncSession(host, port) as session:
+        resources = session.objects(Resource).filter(owner=agent.id)
+        async for res in resources:
+            res.image = 'scrambled_egg'
+            await res.async_save()
+
+        async with stream(session, ['created:resource']) as events:
+            async for event in events:
+                ...
+
+Model objects bound to an AsyncSession are regular Model instances: use
+async_reload(), async_save(), async_delete() and Job.async_wait() instead of
+their blocking versions.
+"""
+
+import asyncio
+import errno
+import json
+import logging
+import time
+import urllib.parse
+from collections import namedtuple
+
+import aiohttp
+
+from .base import Collection
+from .events import EventFilter, EventReader
+from .exceptions import (
+    StormAPIError,
+    StormBadRequestError,
+    StormConflictError,
+    StormConnectionError,
+    StormMultipleObjectsReturned,
+    StormNotFoundError,
+    StormObjectNotFound,
+    StormOSError,
+    StormResyncRequired,
+)
+from .session import (
+    DEFAULT_HOST,
+    DEFAULT_PORT,
+    RETRY_METHODS,
+    RETRY_STATUSES,
+    UrlPath,
+)
+
+
+__all__ = [
+    'AsyncCollection',
+    'AsyncEventsStream',
+    'AsyncManager',
+    'AsyncResponse',
+    'AsyncSession',
+    'stream',
+]
+
+log = logging.getLogger(__name__)
+
+
+RequestInfo = namedtuple('RequestInfo', 'method url')
+
+
+class AsyncResponse:
+    """The response to a request made with an AsyncSession.
+
+    The interface mirrors the subset of requests.Response used by stormlib,
+    so that StormAPIError and friends work with both. The body has already
+    been read, except for streams, which are read from 'content' (an
+    aiohttp.StreamReader) and must be closed.
+    """
+
+    def __init__(self, request, response, body=None):
+        self.request = request
+        self.status_code = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        self.content = body if body is not None else response.content
+        self._response = response
+
+    @property
+    def links(self):
+        return {
+            key: {'url': str(link['url'])}
+            for key, link in self._response.links.items()
+        }
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.text)
+
+    def close(self):
+        self._response.close()
+
+
+class AsyncSession:
+    """A connection to the API server for asyncio applications.
+
+    The options are the same as for Session: connections are pooled and
+    kept alive, and failed requests are retried with an exponential backoff
+    (connection failures always, other failures only for idempotent
+    requests). The pool is larger by default, as a single event loop can
+    make many requests concurrently.
+
+    The underlying aiohttp session is created on the first request: use
+    close() (or 'async with') to release it.
+    """
+
+    POOL_SIZE = 100
+
+    CONNECT_TIMEOUT = 10
+    READ_TIMEOUT = None
+
+    MAX_RETRIES = 3
+    RETRY_BACKOFF = .2
+
+    def __init__(self, host=None, port=None, pool_size=None,
+                 connect_timeout=None, read_timeout=None, max_retries=None,
+                 retry_backoff=None, keep_alive=True):
+        if host is None:
+            host = DEFAULT_HOST
+        if port is None:
+            port = DEFAULT_PORT
+        if pool_size is None:
+            pool_size = self.POOL_SIZE
+        if connect_timeout is None:
+            connect_timeout = self.CONNECT_TIMEOUT
+        if read_timeout is None:
+            read_timeout = self.READ_TIMEOUT
+        if max_retries is None:
+            max_retries = self.MAX_RETRIES
+        if retry_backoff is None:
+            retry_backoff = self.RETRY_BACKOFF
+        self.api_root = UrlPath('http://{}:{}/'.format(
+            urllib.parse.quote(host), int(port)))
+        self.pool_size = pool_size
+        self.timeout = aiohttp.ClientTimeout(
+            sock_connect=connect_timeout, sock_read=read_timeout)
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.keep_alive = keep_alive
+
+        self._http = None
+        self._stats = {
+            'requests': 0,
+            'errors': 0,
+            'connections': 0,
+            'reused': 0,
+            'total_time': 0.,
+            'max_time': 0.,
+        }
+
+    def _get_http(self):
+        if self._http is None:
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_connection_create_end.append(
+                self._on_connection_create)
+            trace_config.on_connection_reuseconn.append(
+                self._on_connection_reuse)
+
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size, force_close=not self.keep_alive)
+            self._http = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                trace_configs=[trace_config])
+        return self._http
+
+    async def _on_connection_create(self, http, context, params):
+        self._stats['connections'] += 1
+
+    async def _on_connection_reuse(self, http, context, params):
+        self._stats['reused'] += 1
+
+    async def close(self):
+        """Close the connections of the pool."""
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+
+    def objects(self, model):
+        """Return an AsyncManager for the given model, bound to this
+        session.
+        """
+        return AsyncManager(model, session=self)
+
+    def get_stats(self):
+        """Return counters about the requests made with this session. See
+        Session.get_stats().
+        """
+        stats = dict(self._stats)
+        if stats['requests']:
+            stats['avg_time'] = stats['total_time'] / stats['requests']
+        else:
+            stats['avg_time'] = 0.
+        return stats
+
+    def _record(self, elapsed, error):
+        stats = self._stats
+        stats['requests'] += 1
+        stats['total_time'] += elapsed
+        if elapsed > stats['max_time']:
+            stats['max_time'] = elapsed
+        if error:
+            stats['errors'] += 1
+
+    def _check_url(self, url):
+        root = str(self.api_root) + '/'
+        if not str(url).startswith(root):
+            raise RuntimeError('URL has been mangled: %r' % url)
+
+    async def request(self, method, path, decode_json=True, params=None,
+                      stream=False, **kwargs):
+        method = method.upper()
+        url = self.api_root / path
+        if params:
+            url = url.params(params)
+        self._check_url(url)
+        request = RequestInfo(method, str(url))
+
+        start_time = time.monotonic()
+        try:
+            response = await self._send(request, stream, kwargs)
+            if response.status_code >= 400:
+                raise self.wrap_status(response)
+        except Exception as exc:
+            self._record(time.monotonic() - start_time, error=True)
+            log.debug('%s %s -> %s', method, url, type(exc).__name__)
+            raise
+        self._record(time.monotonic() - start_time, error=False)
+
+        log.debug(
+            '%s %s -> %s %s',
+            method, url, response.status_code, response.reason)
+
+        if decode_json:
+            return response.json() if response.status_code != 204 else None
+        else:
+            return response
+
+    async def _send(self, request, stream, kwargs):
+        http = self._get_http()
+        retryable = request.method in RETRY_METHODS
+        attempt = 0
+
+        while True:
+            connected = False
+            try:
+                response = await http.request(
+                    request.method, request.url, **kwargs)
+                connected = True
+                if stream and response.status < 400:
+                    return AsyncResponse(request, response)
+                try:
+                    body = await response.read()
+                finally:
+                    response.release()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                # Requests that did not reach the API server can always be
+                # sent again
+                can_retry = retryable or (
+                    not connected and
+                    isinstance(exc, aiohttp.ClientConnectorError))
+                if not can_retry or attempt >= self.max_retries:
+                    raise self.wrap_exception(exc, request)
+            else:
+                if (not retryable or attempt >= self.max_retries or
+                        response.status not in RETRY_STATUSES):
+                    return AsyncResponse(request, response, body)
+
+            await asyncio.sleep(self.retry_backoff * (2 ** attempt))
+            attempt += 1
+
+    def wrap_status(self, response):
+        exc_type = StormAPIError
+        if response.status_code == 400:
+            exc_type = StormBadRequestError
+        elif response.status_code == 404:
+            exc_type = StormNotFoundError
+        elif response.status_code == 409:
+            exc_type = StormConflictError
+        return exc_type(request=response.request, response=response)
+
+    def wrap_exception(self, exc, request):
+        os_error = getattr(exc, 'os_error', exc)
+
+        if isinstance(os_error, OSError):
+            if isinstance(os_error, ConnectionError):
+                exc_type = StormConnectionError
+            else:
+                exc_type = StormOSError
+            exc_args = (os_error.errno, os_error.strerror)
+        elif isinstance(exc, asyncio.TimeoutError):
+            exc_type = StormOSError
+            exc_args = (errno.ETIMEDOUT, 'Request timed out')
+        elif isinstance(exc, aiohttp.ServerDisconnectedError):
+            exc_type = StormConnectionError
+            exc_args = (errno.ECONNRESET, 'Server disconnected')
+        else:
+            exc_type = StormAPIError
+            exc_args = (str(exc),)
+
+        wrapped = exc_type(*exc_args, request=request)
+        wrapped.__cause__ = exc
+        return wrapped
+
+    async def get(self, url, **kwargs):
+        return await self.request('get', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('post', url, **kwargs)
+
+    async def put(self, url, **kwargs):
+        return await self.request('put', url, **kwargs)
+
+    async def patch(self, url, **kwargs):
+        return await self.request('patch', url, **kwargs)
+
+    async def delete(self, url, **kwargs):
+        return await self.request('delete', url, **kwargs)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_tb):
+        await self.close()
+
+    def __repr__(self):
+        return '<{}: {}>'.format(self.__class__.__name__, str(self.api_root))
+
+
+class AsyncCollection(Collection):
+    """A Collection bound to an AsyncSession.
+
+    Queries are built with filter() and only(), like with Collection.
+    Objects are retrieved one page at a time with 'async for', or with the
+    get(), count() and snapshot() coroutines.
+    """
+
+    def __aiter__(self):
+        return self._aiter_pages()
+
+    def __iter__(self):
+        raise TypeError('Use "async for" to iterate over an AsyncCollection')
+
+    def __len__(self):
+        raise TypeError('Use "await count()" to count an AsyncCollection')
+
+    def __getitem__(self, index):
+        raise TypeError('AsyncCollection does not support indexing')
+
+    async def get(self, **kwargs):
+        if kwargs:
+            collection = self.filter(**kwargs)
+        else:
+            collection = self
+
+        # Two objects are enough to know whether there are duplicates
+        objs, has_next, response = await collection._async_get_page(limit=2)
+
+        if not objs:
+            raise StormObjectNotFound(
+                '{} matching query does not exist'.format(self.model.__name__))
+
+        if len(objs) > 1:
+            raise StormMultipleObjectsReturned(
+                'Multiple {} objects returned instead of 1'.format(
+                    self.model.__name__))
+
+        return objs[0]
+
+    async def count(self):
+        response = await self._session.get(
+            self.url.params(limit=0, count='true'), decode_json=False)
+        return int(response.headers['X-Total-Count'])
+
+    async def snapshot(self):
+        """Coroutine version of Collection.snapshot()."""
+        objs, has_next, response = await self._async_get_page(
+            limit=self.PAGE_SIZE)
+        last_event_id = int(response.headers.get('X-Last-Event-Id', 0))
+
+        page = objs
+        while has_next and page:
+            page, has_next, response = await self._async_get_page(
+                after=page[-1].id, limit=self.PAGE_SIZE)
+            objs.extend(page)
+
+        return objs, last_event_id
+
+    async def _async_get_page(self, after=None, offset=None, limit=None):
+        params = {}
+        if after is not None:
+            params['after'] = after
+        if offset:
+            params['offset'] = offset
+        if limit is not None:
+            params['limit'] = limit
+
+        response = await self._session.get(
+            self.url.params(params), decode_json=False)
+        objs = [self._make_object(doc) for doc in response.json()]
+
+        return objs, 'next' in response.links, response
+
+    async def _aiter_pages(self):
+        objs, has_next, response = await self._async_get_page(
+            limit=self.PAGE_SIZE)
+
+        while True:
+            for obj in objs:
+                yield obj
+
+            if not has_next or not objs:
+                return
+
+            objs, has_next, response = await self._async_get_page(
+                after=objs[-1].id, limit=self.PAGE_SIZE)
+
+
+class AsyncManager:
+
+    def __init__(self, model, session):
+        self.model = model
+        self._session = session
+
+    @property
+    def url(self):
+        return self._session.api_root / self.model._path
+
+    def all(self):
+        return AsyncCollection(model=self.model, session=self._session)
+
+    def filter(self, **kwargs):
+        return AsyncCollection(
+            model=self.model, query=kwargs, session=self._session)
+
+    def only(self, *fields):
+        return self.all().only(*fields)
+
+    async def get(self, *args, **kwargs):
+        """
+        get(identifier)
+        Retrieve an object with the given identifier
+
+        get(key1='value', key2='value', ...)
+        Retrieve an object matching the given query
+        """
+        if args:
+            if len(args) > 1 or kwargs:
+                raise TypeError(
+                    'get() takes either one identifier or keyword arguments')
+
+            identifier, = args
+            obj = self.model(id=identifier, session=self._session)
+            await obj.async_reload()
+
+            return obj
+
+        return await self.filter(**kwargs).get()
+
+
+class AsyncEventsStream:
+    """Iterate with 'async for' over the events sent by the API server.
+
+    Like EventsConnection, the connection is transparently reopened if the
+    server drops it because events were not read fast enough, and
+    StormResyncRequired is raised if events were lost.
+    """
+
+    def __init__(self, session, event_filter=None, start=None,
+                 include_entity=False, entity_fields=None, entity_type=None):
+        # EventReader builds the request parameters and the events: it is
+        # not used to make requests
+        self._reader = EventReader(
+            session, include_entity=include_entity,
+            entity_fields=entity_fields, entity_type=entity_type)
+        self._session = session
+        self._filter = event_filter
+        self._start = start
+        self._response = None
+        self._lines = None
+        self._closed = False
+
+    @property
+    def url(self):
+        return self._reader.url
+
+    async def connect(self):
+        """Open the connection. This is done by 'async with', or on the
+        first iteration: events that occur before are not delivered.
+        """
+        params = self._reader._get_params()
+        params['stream'] = 'true'
+        if self._start is not None:
+            params['start'] = self._start
+
+        self._response = await self._session.get(
+            self.url, params=params, stream=True, decode_json=False)
+        self._lines = self._response.content.__aiter__()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            event = await self._next_event()
+            if self._filter is None or self._filter.match(event):
+                return event
+
+    async def _next_event(self):
+        while not self._closed:
+            if self._response is None:
+                await self.connect()
+
+            try:
+                line = await self._lines.__anext__()
+            except StopAsyncIteration:
+                # Connection closed by the server
+                self.close()
+                break
+
+            line = line.strip()
+            if not line:
+                continue
+            data = json.loads(line.decode('utf-8'))
+
+            if 'resync' not in data:
+                event = self._reader._make_event(data)
+                self._start = event.index + 1
+                return event
+
+            self._response.close()
+            self._response = None
+            if data['resync'] != 'overflow':
+                self._closed = True
+                raise StormResyncRequired(
+                    reason=data['resync'], start=data.get('start'))
+            self._start = data['start']
+
+        raise StopAsyncIteration
+
+    def close(self):
+        self._closed = True
+        if self._response is not None:
+            self._response.close()
+            self._response = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+
+def stream(session, filters=None, start=None, include_entity=False,
+           entity_fields=None, entity_type=None):
+    """Return an AsyncEventsStream. See stormlib.events.stream()."""
+    event_filter = None
+    if filters is not None:
+        event_filter = EventFilter(filters)
+    return AsyncEventsStream(
+        session, event_filter, start, include_entity=include_entity,
+        entity_fields=entity_fields, entity_type=entity_type)
@@ -4,7 +4,8 @@ import threading
 
 from .exceptions import (
     StormNotFoundError, StormObjectNotFound, StormMultipleObjectsReturned)
-from .fields import StringField
+from .fields import ReferenceField, StringField
+from .query import UnsupportedQuery, compile_query
 from .session import current_session
 
 
@@ -65,6 +66,10 @@ class AbstractCollection(metaclass=abc.ABCMeta):
     def filter(self, **kwargs):
         raise NotImplementedError
 
+    @abc.abstractmethod
+    def only(self, *fields):
+        raise NotImplementedError
+
     @abc.abstractmethod
     def get(self, **kwargs):
         raise NotImplementedError
@@ -81,17 +86,25 @@ class AbstractCollection(metaclass=abc.ABCMeta):
     def __getitem__(self, index):
         raise NotImplementedError
 
+    @abc.abstractmethod
+    def snapshot(self):
+        raise NotImplementedError
+
     def __repr__(self):
         return '<{}: {!r}>'.format(self.__class__.__name__, list(self))
 
 
 class Collection(AbstractCollection):
 
-    def __init__(self, model, query=None, session=None):
+    # Number of objects retrieved with each request when iterating
+    PAGE_SIZE = 500
+
+    def __init__(self, model, query=None, fields=None, session=None):
         super().__init__(model=model)
         if query is None:
             query = {}
         self._query = query
+        self._fields = fields
         if session is None:
             session = current_session()
         self._session = session
@@ -101,6 +114,7 @@ class Collection(AbstractCollection):
     def _replace(self, **kwargs):
         kwargs.setdefault('model', self.model)
         kwargs.setdefault('query', self._query)
+        kwargs.setdefault('fields', self._fields)
         kwargs.setdefault('session', self._session)
         return self.__class__(**kwargs)
 
@@ -110,50 +124,185 @@ class Collection(AbstractCollection):
 
     @property
     def url(self):
+        params = {}
         if self._query:
-            params = {'q': json_compact(self._query)}
-        else:
-            params = {}
+            params['q'] = json_compact(self._query)
+        if self._fields is not None:
+            params['fields'] = ','.join(self._fields)
         return self.base_url.params(params)
 
     def all(self):
         return self._replace()
 
+    def only(self, *fields):
+        """Retrieve only the given fields of the objects.
+
+        Objects retrieved this way are partial: they cannot be saved, unless
+        they are reloaded first.
+        """
+        return self._replace(fields=fields)
+
     def filter(self, **kwargs):
         query = combine_queries(self._query, kwargs)
-        return self._replace(query=query)
+        collection = self._replace(query=query)
+
+        if self._elems is not None and self._fields is None:
+            # The objects have already been retrieved: if possible, filter
+            # them locally instead of asking the API server again
+            try:
+                predicate = self.model.query_predicate(kwargs)
+            except UnsupportedQuery:
+                pass
+            else:
+                collection._elems = [
+                    obj for obj in self._elems if predicate(obj)]
+
+        return collection
 
     def get(self, **kwargs):
         if kwargs:
-            it = iter(self.filter(kwargs))
+            collection = self.filter(**kwargs)
         else:
-            it = iter(self)
+            collection = self
 
-        try:
-            obj = next(it)
-        except StopIteration:
+        if collection._elems is not None:
+            objs = collection._elems[:2]
+        else:
+            # Two objects are enough to know whether there are duplicates
+            objs, has_next = collection._fetch_page(limit=2)
+
+        if not objs:
             raise StormObjectNotFound(
                 '{} matching query does not exist'.format(self.model.__name__))
 
-        try:
-            next(it)
-        except StopIteration:
-            pass
-        else:
+        if len(objs) > 1:
             raise StormMultipleObjectsReturned(
                 'Multiple {} objects returned instead of 1'.format(
                     self.model.__name__))
 
-        return obj
+        return objs[0]
 
     def __iter__(self):
-        return iter(self._retrieve())
+        if self._elems is not None:
+            return iter(self._elems)
+        return self._iter_pages()
 
     def __len__(self):
-        return len(self._retrieve())
+        if self._elems is not None:
+            return len(self._elems)
+
+        response = self._session.get(
+            self.url.params(limit=0, count='true'), decode_json=False)
+
+        try:
+            return int(response.headers['X-Total-Count'])
+        except (KeyError, ValueError):
+            # The API server does not support pagination
+            return len(self._retrieve())
 
     def __getitem__(self, index):
-        return self._retrieve()[index]
+        if self._elems is not None:
+            return self._elems[index]
+
+        if isinstance(index, slice):
+            start, stop, step = index.start, index.stop, index.step
+            if (start is not None and start < 0) or \
+                    (stop is not None and stop < 0):
+                return self._retrieve()[index]
+            if start is None:
+                start = 0
+            if stop is not None and stop <= start:
+                return []
+            limit = stop - start if stop is not None else None
+            objs = list(self._iter_pages(offset=start, limit=limit))
+            return objs[::step]
+
+        if index < 0:
+            index += len(self)
+            if index < 0:
+                raise IndexError(index)
+
+        objs, has_next = self._fetch_page(offset=index, limit=1)
+        if not objs:
+            raise IndexError(index)
+        return objs[0]
+
+    def snapshot(self):
+        """Retrieve all the objects. Return the list of objects and the ID
+        of the last event reflected in them.
+
+        Streaming events from the next ID (see stormlib.events.stream())
+        gives all the changes made after the objects were retrieved,
+        possibly along with changes that were already reflected in them.
+        This way, the objects need to be retrieved only once.
+        """
+        objs, has_next, response = self._get_page(limit=self.PAGE_SIZE)
+        last_event_id = int(response.headers.get('X-Last-Event-Id', 0))
+
+        page = objs
+        while has_next and page:
+            page, has_next, response = self._get_page(
+                after=page[-1].id, limit=self.PAGE_SIZE)
+            objs.extend(page)
+
+        return objs, last_event_id
+
+    def _fetch_page(self, after=None, offset=None, limit=None):
+        """Retrieve a page of objects. Return the list of objects and a
+        boolean telling whether there are more pages.
+        """
+        objs, has_next, response = self._get_page(after, offset, limit)
+        return objs, has_next
+
+    def _get_page(self, after=None, offset=None, limit=None):
+        params = {}
+        if after is not None:
+            params['after'] = after
+        if offset:
+            params['offset'] = offset
+        if limit is not None:
+            params['limit'] = limit
+
+        response = self._session.get(
+            self.url.params(params), decode_json=False)
+        objs = [self._make_object(doc) for doc in response.json()]
+
+        return objs, 'next' in response.links, response
+
+    def _iter_pages(self, offset=None, limit=None):
+        """Iterate over the objects, retrieving them one page at a time.
+
+        If everything fits into the first page, the objects are kept, so
+        that small collections are retrieved only once.
+        """
+        page_size = self.PAGE_SIZE
+        if limit is not None:
+            page_size = min(page_size, limit)
+
+        objs, has_next = self._fetch_page(offset=offset, limit=page_size)
+
+        if not has_next and not offset and limit is None:
+            with self._lock:
+                if self._elems is None:
+                    self._elems = objs
+
+        while True:
+            for obj in objs:
+                if limit is not None:
+                    if limit <= 0:
+                        return
+                    limit -= 1
+                yield obj
+
+            if not has_next or not objs or limit == 0:
+                return
+
+            page_size = self.PAGE_SIZE
+            if limit is not None:
+                page_size = min(page_size, limit)
+
+            objs, has_next = self._fetch_page(
+                after=objs[-1].id, limit=page_size)
 
     def _retrieve(self):
         if self._elems is not None:
@@ -164,17 +313,24 @@ class Collection(AbstractCollection):
                 return self._elems
 
             documents = self._session.get(self.url)
-            self._elems = [
-                self.model(doc, session=self._session) for doc in documents]
+            self._elems = [self._make_object(doc) for doc in documents]
 
         return self._elems
 
+    def _make_object(self, doc):
+        obj = self.model(doc, session=self._session)
+        obj._partial = self._fields is not None
+        return obj
+
 
 class EmptyCollection(AbstractCollection):
 
     def all(self):
         return self
 
+    def only(self, *fields):
+        return self
+
     def filter(self, **kwargs):
         return self
 
@@ -192,6 +348,9 @@ class EmptyCollection(AbstractCollection):
             return []
         raise IndexError(index)
 
+    def snapshot(self):
+        return [], None
+
 
 class Manager:
 
@@ -217,6 +376,9 @@ class Manager:
             query=kwargs,
             session=self._session)
 
+    def only(self, *fields):
+        return self.all().only(*fields)
+
     def get(self, *args, **kwargs):
         """
         get(identifier)
@@ -266,6 +428,10 @@ class Model(metaclass=ModelMeta):
 
     id = StringField(null=True)
 
+    # True if only some of the fields have been retrieved (see
+    # Collection.only())
+    _partial = False
+
     def __init__(self, data=None, session=None, **kwargs):
         super().__init__()
 
@@ -294,7 +460,7 @@ class Model(metaclass=ModelMeta):
     def url(self):
         if self.id is None:
             raise AttributeError('No ID has been set')
-        return self.objects.url / self.id
+        return self._session.api_root / self._path / self.id
 
     def reload(self, session=None):
         """Fetch the data from the API server for this object."""
@@ -305,6 +471,7 @@ class Model(metaclass=ModelMeta):
         except StormNotFoundError as exc:
             raise StormObjectNotFound(self.id)
         self._data = response_data
+        self._partial = False
 
     def save(self, validate=True, session=None):
         """
@@ -312,8 +479,7 @@ class Model(metaclass=ModelMeta):
         entity or update an existing one, depending on whether this object has
         an ID or not.
         """
-        if validate:
-            self.validate()
+        self._check_save(validate)
 
         if session is None:
             session = self._session
@@ -330,8 +496,17 @@ class Model(metaclass=ModelMeta):
         # Either an ID is not defined, or the update returned 404
         self._create(session)
 
+    def _check_save(self, validate):
+        if self._partial:
+            raise RuntimeError(
+                'Cannot save an object with missing fields: reload() it '
+                'first')
+        if validate:
+            self.validate()
+
     def _create(self, session):
-        response_data = session.post(self.objects.url, json=self._data)
+        response_data = session.post(
+            session.api_root / self._path, json=self._data)
         self._data = response_data
 
     def _update(self, session):
@@ -351,6 +526,84 @@ class Model(metaclass=ModelMeta):
         except StormNotFoundError as exc:
             raise StormObjectNotFound(self.id)
 
+    # Coroutine versions of reload(), save() and delete(), for objects
+    # bound to a stormlib.aio.AsyncSession
+
+    async def async_reload(self, session=None):
+        if session is None:
+            session = self._session
+        try:
+            response_data = await session.get(self.url)
+        except StormNotFoundError:
+            raise StormObjectNotFound(self.id)
+        self._data = response_data
+        self._partial = False
+
+    async def async_save(self, validate=True, session=None):
+        self._check_save(validate)
+
+        if session is None:
+            session = self._session
+
+        if self.id is not None:
+            try:
+                response_data = await session.put(self.url, json=self._data)
+            except StormNotFoundError:
+                pass
+            else:
+                self._data = response_data
+                return
+
+        self._data = await session.post(
+            session.api_root / self._path, json=self._data)
+
+    async def async_delete(self, session=None):
+        if session is None:
+            session = self._session
+
+        try:
+            await session.delete(self.url)
+        except StormNotFoundError:
+            raise StormObjectNotFound(self.id)
+
+    @classmethod
+    def query_predicate(cls, query):
+        """Return a function that evaluates the query against objects of
+        this model locally, without asking the API server.
+
+        UnsupportedQuery is raised if the query cannot be evaluated locally.
+        This happens if the query uses unsupported operators, or if it tests
+        reference fields, which the API server resolves by name.
+        """
+        cls._check_local_query(query)
+        predicate = compile_query(query)
+        return lambda obj: predicate(obj._data)
+
+    @classmethod
+    def _check_local_query(cls, query):
+        for key, value in query.items():
+            if key in ('$and', '$or', '$nor'):
+                for item in value:
+                    if isinstance(item, dict):
+                        cls._check_local_query(item)
+            elif key.startswith('$'):
+                continue
+            elif '\0' in key or '$' in key:
+                # Ignored by the API server
+                raise UnsupportedQuery(
+                    'Invalid field name: {!r}'.format(key))
+            else:
+                field = getattr(cls, key.split('.')[0], None)
+                if isinstance(field, ReferenceField):
+                    raise UnsupportedQuery(
+                        'Reference fields cannot be evaluated locally: '
+                        '{}'.format(key))
+
+    def matches(self, query):
+        """Return whether the query matches this object, evaluating it
+        locally."""
+        return self.query_predicate(query)(self)
+
     def validate(self, skip_fields=None):
         cls = self.__class__
         for name in self._fields:
@@ -2,34 +2,62 @@ import json
 from collections import namedtuple
 
 from . import models
-from .exceptions import StormObjectNotFound
+from .exceptions import StormObjectNotFound, StormResyncRequired
 from .session import current_session
 
 
 class Entity(namedtuple('BaseEntity', 'type id names')):
 
     def retrieve(self):
-        """Return the Model object referenced by this Entity."""
+        """Return the Model object referenced by this Entity.
+
+        If the object was sent along with the event (see the
+        'include_entity' option of stream() and latest()), no request is
+        made.
+        """
         try:
-            return self._obj
+            obj = self._obj
         except AttributeError:
             # Object has not been fetched yet
-            pass
+            model_class = self._get_model()
+            if model_class is None:
+                raise StormObjectNotFound(self.id)
+            obj = self._obj = model_class.objects.get(self.id)
+
+        if obj is None:
+            # The entity no longer exists
+            raise StormObjectNotFound(self.id)
+        return obj
+
+    @property
+    def retrieved(self):
+        """Whether the object has been retrieved, or was sent along with
+        the event.
+        """
+        return hasattr(self, '_obj')
 
+    def _get_model(self):
         model_name = self.type.capitalize()
         if model_name not in models.__all__:
-            raise StormObjectNotFound(self.id)
+            return None
+        return getattr(models, model_name)
 
-        model_class = getattr(models, model_name)
-        self._obj = model_class.objects.get(self.id)
-        return self._obj
+    def _set_data(self, data, session=None, partial=False):
+        if data is None:
+            self._obj = None
+            return
+        model_class = self._get_model()
+        if model_class is None:
+            return
+        self._obj = model_class(data, session=session)
+        self._obj._partial = partial
 
 
 class Event(namedtuple('BaseEvent', 'index type entity')):
 
     @classmethod
-    def _from_json(cls, data):
-        return cls(
+    def _from_json(cls, data, session=None, partial=False):
+        event = cls(
             index=data['id'],
             type=data['event_type'],
             entity=Entity(
@@ -38,6 +66,9 @@ class Event(namedtuple('BaseEvent', 'index type entity')):
                 names=data['entity_names'],
             ),
         )
+        if 'entity' in data:
+            event.entity._set_data(data['entity'], session, partial)
+        return event
 
 
 class EventMask(namedtuple(
@@ -119,42 +150,114 @@ class EventMask(namedtuple(
 
 
 class EventReader:
+    """Read events from the API server.
+
+    With include_entity=True, the API server sends the entities along with
+    the events, restricted to 'entity_fields' if given: Entity.retrieve()
+    does not make any request. Entities are sent in their current state,
+    or in their last state if they were deleted.
+
+    With 'entity_type', the API server only sends the events about entities
+    of that type (example: 'resource').
+    """
 
-    def __init__(self, session=None):
+    def __init__(self, session=None, include_entity=False,
+                 entity_fields=None, entity_type=None):
         if session is None:
             session = current_session()
         self._session = session
+        self.include_entity = include_entity
+        self.entity_fields = entity_fields
+        self.entity_type = entity_type
 
     @property
     def url(self):
         return self._session.api_root / 'v1/events'
 
-    def latest(self, start=None, count=None):
+    def _get_params(self):
         params = {}
+        if self.include_entity:
+            params['include'] = 'entity'
+            if self.entity_fields is not None:
+                params['entity_fields'] = ','.join(self.entity_fields)
+        if self.entity_type is not None:
+            params['entity_type'] = self.entity_type
+        return params
+
+    def _make_event(self, data):
+        return Event._from_json(
+            data, session=self._session,
+            partial=self.entity_fields is not None)
+
+    def latest(self, start=None, count=None):
+        params = self._get_params()
         if start is not None:
             params['start'] = start
         if count is not None:
             params['count'] = count
 
         data = self._session.get(self.url, params=params)
-        return [Event._from_json(item) for item in data]
+        return [self._make_event(item) for item in data]
 
     def stream(self, start=None):
-        params = {'stream': 'true'}
+        connection = EventsConnection(self, start)
+        return EventsStream(connection, iter(connection))
+
+    def _connect(self, start=None):
+        params = self._get_params()
+        params['stream'] = 'true'
         if start is not None:
             params['start'] = start
 
-        response = self._session.get(
+        return self._session.get(
             self.url, params=params,
             stream=True, decode_json=False)
 
-        it = (
-            Event._from_json(json.loads(line))
-            for line in response.iter_lines()
-            if line
-        )
 
-        return EventsStream(response, it)
+class EventsConnection:
+    """
+    Iterate over the events sent by the API server on a streaming connection.
+
+    If the server drops the connection because we were not reading events fast
+    enough, the connection is transparently reopened from the first event
+    that was not delivered. If events were lost, StormResyncRequired is
+    raised.
+    """
+
+    def __init__(self, reader, start=None):
+        self._reader = reader
+        # Connect immediately: callers expect to receive all the events that
+        # occur after stream() returns
+        self._response = reader._connect(start)
+        self._closed = False
+
+    def __iter__(self):
+        while not self._closed:
+            resync = None
+
+            for line in self._response.iter_lines():
+                if not line:
+                    continue
+                data = json.loads(line)
+                if 'resync' in data:
+                    resync = data
+                    break
+                yield self._reader._make_event(data)
+
+            self._response.close()
+
+            if resync is None:
+                # Connection closed by the server
+                return
+            if resync['resync'] != 'overflow':
+                raise StormResyncRequired(
+                    reason=resync['resync'], start=resync.get('start'))
+
+            self._response = self._reader._connect(resync['start'])
+
+    def close(self):
+        self._closed = True
+        self._response.close()
 
 
 class EventsStream:
@@ -217,16 +320,24 @@ class EventFilter:
             return it
 
 
-def latest(filters=None, start=None, count=None, session=None):
-    events = EventReader(session=session).latest(start, count)
+def latest(filters=None, start=None, count=None, session=None,
+           include_entity=False, entity_fields=None, entity_type=None):
+    reader = EventReader(
+        session=session, include_entity=include_entity,
+        entity_fields=entity_fields, entity_type=entity_type)
+    events = reader.latest(start, count)
     if filters is not None:
         event_filter = EventFilter(filters)
         events = event_filter(events)
     return events
 
 
-def stream(filters=None, start=None, session=None):
-    event_stream = EventReader(session=session).stream(start)
+def stream(filters=None, start=None, session=None, include_entity=False,
+           entity_fields=None, entity_type=None):
+    reader = EventReader(
+        session=session, include_entity=include_entity,
+        entity_fields=entity_fields, entity_type=entity_type)
+    event_stream = reader.stream(start)
     if filters is not None:
         event_filter = EventFilter(filters)
         event_stream = event_filter(event_stream)
@@ -115,6 +115,26 @@ class StormMultipleObjectsReturned(StormException):
     """
 
 
+class StormResyncRequired(StormException):
+    """
+    Exception raised by event streams when the API Server reports that some
+    events cannot be delivered. Consumers are expected to retrieve the current
+    state of the entities they are interested in again, and then resume
+    streaming from `start`.
+    """
+
+    def __init__(self, *args, reason=None, start=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reason = reason
+        self.start = start
+
+    def __str__(self):
+        s = super().__str__()
+        if not s:
+            s = 'Events lost ({}), resync required'.format(self.reason)
+        return s
+
+
 class StormJobError(StormException):
     """Exception raised when the execution of a job fails."""
 
@@ -6,6 +6,9 @@ from .base import (
     AsyncJobsExecutor,
     AsyncPipelineExecutor,
     AsyncPollingExecutor,
+    AsyncioJobsExecutor,
+    AsyncioPipelineExecutor,
+    AsyncioPollingExecutor,
     AgentExecutorMixin,
 )
 from .discovery import DiscoveryExecutor, DiscoveryProbe
@@ -24,6 +27,9 @@ __all__ = [
     'AsyncJobsExecutor',
     'AsyncPipelineExecutor',
     'AsyncPollingExecutor',
+    'AsyncioJobsExecutor',
+    'AsyncioPipelineExecutor',
+    'AsyncioPollingExecutor',
     'AgentExecutorMixin',
 ]
 
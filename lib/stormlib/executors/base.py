@@ -1,4 +1,5 @@
 import abc
+import asyncio
 import logging
 import time
 
@@ -199,6 +200,102 @@ if gevent:
         pass
 
 
+class AsyncioJobsExecutor(AsyncJobsExecutor):
+    """Run jobs as tasks of an asyncio event loop.
+
+    Jobs are coroutine functions. They are taken from iter_jobs_async(),
+    which by default iterates over iter_jobs().
+
+    Unless a loop is given, every call to run() creates a new event loop,
+    sets it as the current one while it runs, and closes it afterwards.
+    """
+
+    def __init__(self, *args, loop=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._loop = loop
+        self.loop = loop
+        self._tasks = set()
+
+    def run(self):
+        if self._loop is not None:
+            self._run_in_loop()
+            return
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self._run_in_loop()
+        finally:
+            asyncio.set_event_loop(None)
+            self.loop.close()
+            self.loop = None
+
+    def _run_in_loop(self):
+        try:
+            self.loop.run_until_complete(self.run_async())
+        except KeyboardInterrupt:
+            self.stop_jobs()
+
+    async def run_async(self):
+        async for job in self.iter_jobs_async():
+            try:
+                self.run_job(job)
+            except Exception as exc:
+                self.on_job_error(job, exc)
+        await self.wait_jobs_async()
+
+    async def iter_jobs_async(self):
+        for job in self.iter_jobs():
+            yield job
+
+    def spawn_job(self, job):
+        task = self.loop.create_task(self.run_job_inner(job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def run_job_inner(self, job):
+        while True:
+            try:
+                await job()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                self.on_job_error(job, exc)
+            if not self.restart_jobs:
+                break
+            await asyncio.sleep(self.restart_jobs_interval)
+
+    async def wait_jobs_async(self):
+        while self._tasks:
+            await asyncio.wait(set(self._tasks))
+
+    def wait_jobs(self):
+        self.loop.run_until_complete(self.wait_jobs_async())
+
+    def stop_jobs(self):
+        for task in self._tasks:
+            task.cancel()
+        while self._tasks:
+            self.loop.run_until_complete(asyncio.wait(set(self._tasks)))
+
+
+class AsyncioPipelineExecutor(AsyncioJobsExecutor, AsyncPipelineExecutor):
+
+    pass
+
+
+class AsyncioPollingExecutor(AsyncioJobsExecutor, AsyncPollingExecutor):
+    """Poll for jobs without blocking the event loop: poll_jobs() is a
+    coroutine returning a list of coroutine functions.
+    """
+
+    async def iter_jobs_async(self):
+        while True:
+            for job in await self.poll_jobs():
+                yield job
+            await asyncio.sleep(self.poll_interval)
+
+
 class AgentExecutorMixin:
 
     def __init__(self, agent, *args, **kwargs):
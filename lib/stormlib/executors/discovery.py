@@ -39,10 +39,21 @@ class DiscoveryProbe(metaclass=abc.ABCMeta):
 
 
 class DiscoveryExecutor(AgentExecutorMixin, PollingExecutor):
-
-    def __init__(self, delete_stored=False, *args, **kwargs):
+    """
+    Discover resources with probes, and keep them up-to-date on the API
+    server.
+
+    By default every change is a separate job, which makes one or two
+    requests. With bulk=True, all the changes found by a poll are applied by
+    a single job with a few bulk requests: one for all the deletions, and
+    one for every resource type (in the order of the probes, so that
+    resources can refer to resources of the types that come before).
+    """
+
+    def __init__(self, delete_stored=False, bulk=False, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.delete_stored = delete_stored
+        self.bulk = bulk
         self.snapshots = None
         self.probes = {
             probe.resource_type: probe
@@ -68,6 +79,11 @@ class DiscoveryExecutor(AgentExecutorMixin, PollingExecutor):
 
         changes = self.compare_snapshots(prev_snapshots, curr_snapshots)
 
+        if self.bulk:
+            if changes:
+                yield functools.partial(self.apply_changes, changes)
+            return
+
         for modification, resource_snapshot in changes:
             func = getattr(self, 'resource_{}'.format(modification))
             yield functools.partial(func, *resource_snapshot)
@@ -144,6 +160,74 @@ class DiscoveryExecutor(AgentExecutorMixin, PollingExecutor):
     def save_resource(self, obj):
         obj.save()
 
+    def apply_changes(self, changes):
+        deleted = [
+            resource_snapshot for modification, resource_snapshot in changes
+            if modification == 'deleted']
+
+        if deleted:
+            operations = [
+                ('delete', Resource(id=resource_id))
+                for resource_type, resource_id, resource_data in deleted]
+            results = Resource.bulk(operations)
+
+            for resource_snapshot, result in zip(deleted, results):
+                # Resources may have been deleted already, together with
+                # their parent
+                if result.status >= 300 and result.status != 404:
+                    log.warning(
+                        'Could not delete resource %s %s: %s',
+                        resource_snapshot.type, resource_snapshot.internal_id,
+                        result.errors)
+                else:
+                    log.debug(
+                        'Resource deleted: %s %s',
+                        resource_snapshot.type, resource_snapshot.internal_id)
+
+        for resource_type in self.probes:
+            upserted = [
+                (modification, resource_snapshot)
+                for modification, resource_snapshot in changes
+                if modification != 'deleted' and
+                resource_snapshot.type == resource_type]
+
+            if upserted:
+                self.apply_upserts(upserted)
+
+    def apply_upserts(self, upserted):
+        operations = []
+
+        for modification, resource_snapshot in upserted:
+            obj = self.model_resource(*resource_snapshot)
+            # Upserts are keyed by the internal ID: this way resources are
+            # never duplicated, even for creations
+            if obj.id is None:
+                obj.id = resource_snapshot.internal_id
+            operations.append(('upsert', obj))
+
+        results = Resource.bulk(operations)
+
+        for (modification, resource_snapshot), result in zip(
+                upserted, results):
+            resource_type, resource_id, resource_data = resource_snapshot
+
+            if result.status >= 300:
+                # Let the probe deal with the error, like it does for
+                # single saves
+                probe = self.probes[resource_type]
+                try:
+                    probe.save_resource(result.resource)
+                except Exception:
+                    log.exception(
+                        'Could not save resource %s %s',
+                        resource_type, resource_id)
+                    continue
+
+            log.debug(
+                'Resource %s: %s %s',
+                'discovered' if modification == 'created' else 'updated',
+                resource_type, resource_id)
+
     def resource_deleted(self, resource_type, resource_id, resource_data):
         obj = Resource(id=resource_id)
         probe = self.probes[resource_type]
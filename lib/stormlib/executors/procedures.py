@@ -1,22 +1,40 @@
 import abc
 import logging
+import warnings
 
 from . import AgentExecutorMixin, PollingExecutor
 from .. import Job, events
+from ..models import JobHandler
 
 log = logging.getLogger(__name__)
 
 
 class ProcedureRunner:
+    """Run a job on behalf of an agent.
+
+    While run() is called, 'output' is a file-like object (a
+    JobOutputWriter) that streams to the output of the job: the output can
+    be followed while the job is running, and the result of the job does
+    not need to include it.
+    """
 
     def __init__(self, agent, job):
         self.agent = agent
         self.job = job
+        self.output = None
 
     def __call__(self):
-        with self.job.handle(self.agent.id):
+        if self.job.is_running() and self.job.owner == self.agent.id:
+            # The job was already claimed by the agent
+            handler = JobHandler(self.job)
+        else:
+            handler = self.job.handle(self.agent.id)
+
+        with handler:
             try:
-                result = self.run()
+                # The output is flushed before the job is complete
+                with self.job.open_output() as self.output:
+                    result = self.run()
             except Exception as exc:
                 if not self.job.is_complete():
                     self.exception(exc)
@@ -28,10 +46,17 @@ class ProcedureRunner:
     def run(self):
         raise NotImplementedError
 
+    def _flush_output(self):
+        # Output can only be appended while the job is running
+        if self.output is not None:
+            self.output.flush()
+
     def complete(self, result):
+        self._flush_output()
         self.job.complete(result)
 
     def fail(self, result):
+        self._flush_output()
         self.job.fail(result)
 
     def exception(self, exc):
@@ -46,28 +71,75 @@ class ProcedureExecutor(AgentExecutorMixin, PollingExecutor):
     def procedure_type(self):
         raise NotImplementedError
 
+    # Maximum number of jobs claimed at once
+    claim_count = 10
+
+    # How long the server waits for jobs when none is pending
+    claim_timeout = 30
+
+    def get_claim_params(self):
+        """Return the parameters of Job.claim() selecting the jobs that this
+        executor can run.
+        """
+        return {'type': self.procedure_type}
+
     def get_job_event_filter(self):
+        """Deprecated: jobs are claimed with get_claim_params().
+
+        Subclasses overriding this method or get_pending_jobs() make the
+        executor list pending jobs and handle them one by one, like older
+        versions did.
+        """
         return events.EventFilter([
             events.EventMask(event_type='created', entity_type='job'),
             events.EventMask(event_type='updated', entity_type='job'),
         ])
 
     def get_pending_jobs(self):
+        """Deprecated: jobs are claimed with get_claim_params()."""
         return Job.objects.filter(
             type=self.procedure_type,
             status='pending',
         )
 
-    def poll_jobs(self):
+    def _uses_pending_jobs(self):
+        cls = type(self)
+        return (
+            cls.get_pending_jobs is not ProcedureExecutor.get_pending_jobs or
+            cls.get_job_event_filter is not
+            ProcedureExecutor.get_job_event_filter)
+
+    def _poll_pending_jobs(self):
         event_filter = self.get_job_event_filter()
 
         with event_filter(events.stream()) as stream:
             while True:
                 pending_jobs = self.get_pending_jobs()
                 if pending_jobs:
-                    break
+                    return pending_jobs
                 next(stream)
 
+    def poll_jobs(self):
+        if self._uses_pending_jobs():
+            warnings.warn(
+                '{} overrides get_pending_jobs() or get_job_event_filter(), '
+                'which are deprecated: override get_claim_params() '
+                'instead'.format(type(self).__name__),
+                DeprecationWarning)
+            return [
+                self.get_procedure_runner(self.agent, job)
+                for job in self._poll_pending_jobs()
+            ]
+
+        while True:
+            pending_jobs = Job.claim(
+                self.agent.id,
+                count=self.claim_count,
+                timeout=self.claim_timeout,
+                **self.get_claim_params())
+            if pending_jobs:
+                break
+
         return [
             self.get_procedure_runner(self.agent, job)
             for job in pending_jobs
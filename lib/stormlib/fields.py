@@ -56,6 +56,14 @@ class StringField(Field):
                 'Field cannot be blank', field=self.name)
 
 
+class ReferenceField(StringField):
+    """A reference to another object.
+
+    References are returned by the API server as IDs, but queries can refer
+    to objects using any of their names too.
+    """
+
+
 class IntField(Field):
 
     def validate(self, value):
@@ -65,6 +73,15 @@ class IntField(Field):
                 'Expected an integer, got {!r}'.format(value), field=self.name)
 
 
+class BooleanField(Field):
+
+    def validate(self, value):
+        super().validate(value)
+        if value is not None and not isinstance(value, bool):
+            raise StormValidationError(
+                'Expected a boolean, got {!r}'.format(value), field=self.name)
+
+
 class ListField(Field):
 
     def __init__(self, subfield, **kwargs):
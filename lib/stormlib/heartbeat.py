@@ -64,3 +64,44 @@ class Heartbeat:
     def __call__(self):
         self._post_heartbeat()
         return HeartbeatContextManager(self)
+
+
+class BatchHeartbeat:
+    """Periodically send the heartbeats of many agents with one request.
+
+    This is meant for processes hosting many agents: instead of running one
+    Heartbeat thread per agent, agents are added to a BatchHeartbeat.
+    """
+
+    def __init__(self, agents=(), session=None):
+        self.agents = list(agents)
+        self.session = session
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, agent):
+        with self._lock:
+            self.agents.append(agent)
+
+    def remove(self, agent):
+        with self._lock:
+            self.agents.remove(agent)
+
+    def _post_heartbeats(self):
+        from .models import Agent
+
+        with self._lock:
+            agents = list(self.agents)
+        Agent.send_heartbeats(agents, session=self.session)
+
+    def start(self, interval=None):
+        if self._thread is None:
+            if interval is None:
+                interval = DEFAULT_INTERVAL
+            self._thread = _PeriodicTask(self._post_heartbeats, interval)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._thread.stop()
+            self._thread = None
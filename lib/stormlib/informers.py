@@ -0,0 +1,460 @@
+"""
+Local replicas of collections, kept up to date from the event stream.
+
+An Informer lists a collection once, then applies the changes received from
+the event stream to a LocalStore. Reads from the store do not make any
+request to the API server:
+
+    informer = Informer(Resource, {'owner': agent.id})
+    informer.add_listener(print)
+    informer.start()
+
+    informer.store.get('res-XXX')
+    informer.store.filter(type='swarm-service', status='running')
+"""
+
+import collections
+import logging
+import queue
+import threading
+import time
+
+from . import events
+from .base import Collection
+from .exceptions import (
+    StormException, StormObjectNotFound, StormResyncRequired)
+from .query import UnsupportedQuery
+from .session import current_session
+
+
+__all__ = [
+    'Change',
+    'Informer',
+    'LocalStore',
+]
+
+log = logging.getLogger(__name__)
+
+_RETRIEVE = object()
+
+
+Change = collections.namedtuple('Change', 'old new')
+Change.__doc__ = """\
+A change to an object of a LocalStore. 'old' is None for objects that were
+added, 'new' is None for objects that were removed.
+"""
+
+
+class LocalStore:
+    """An in-memory collection of objects, indexed by field.
+
+    Indexed fields are looked up with by(). Fields holding lists (such as
+    the names of resources) are indexed by each of their items. The store
+    is thread-safe.
+    """
+
+    INDEXES = ('name', 'names', 'owner', 'type', 'parent')
+
+    def __init__(self, model, indexes=None):
+        if indexes is None:
+            indexes = [name for name in self.INDEXES if name in model._fields]
+        self.model = model
+        self.indexes = tuple(indexes)
+        self._objects = {}
+        self._index_maps = {name: {} for name in self.indexes}
+        self._lock = threading.RLock()
+
+    def _index_keys(self, obj, name):
+        value = obj._data.get(name)
+        if value is None:
+            return ()
+        if isinstance(value, (list, tuple)):
+            return value
+        return (value,)
+
+    def _add(self, obj):
+        self._objects[obj.id] = obj
+        for name, index_map in self._index_maps.items():
+            for key in self._index_keys(obj, name):
+                index_map.setdefault(key, {})[obj.id] = obj
+
+    def _discard(self, obj_id):
+        obj = self._objects.pop(obj_id, None)
+        if obj is None:
+            return None
+        for name, index_map in self._index_maps.items():
+            for key in self._index_keys(obj, name):
+                bucket = index_map.get(key)
+                if bucket is not None:
+                    bucket.pop(obj_id, None)
+                    if not bucket:
+                        del index_map[key]
+        return obj
+
+    def put(self, obj):
+        """Add or replace an object. Return the Change."""
+        with self._lock:
+            old = self._discard(obj.id)
+            self._add(obj)
+        return Change(old, obj)
+
+    def remove(self, obj_id):
+        """Remove an object, if present. Return the Change, or None if the
+        object was not in the store.
+        """
+        with self._lock:
+            old = self._discard(obj_id)
+        if old is None:
+            return None
+        return Change(old, None)
+
+    def replace(self, objs):
+        """Replace all the objects of the store. Return the list of
+        Changes.
+        """
+        changes = []
+        with self._lock:
+            new_ids = set()
+            for obj in objs:
+                new_ids.add(obj.id)
+                changes.append(self.put(obj))
+            for obj_id in list(self._objects):
+                if obj_id not in new_ids:
+                    changes.append(self.remove(obj_id))
+        return changes
+
+    def get(self, obj_id, default=None):
+        with self._lock:
+            return self._objects.get(obj_id, default)
+
+    def lookup(self, value):
+        """Return the object with the given ID or name, or None."""
+        with self._lock:
+            obj = self._objects.get(value)
+            if obj is not None:
+                return obj
+            for name in ('name', 'names'):
+                if name in self._index_maps:
+                    matches = self._index_maps[name].get(value)
+                    if matches:
+                        return next(iter(matches.values()))
+        return None
+
+    def by(self, field, value):
+        """Return the list of objects whose indexed field has the given
+        value (or contains it, for lists).
+        """
+        with self._lock:
+            try:
+                index_map = self._index_maps[field]
+            except KeyError:
+                raise ValueError('Field is not indexed: {!r}'.format(field))
+            return list(index_map.get(value, {}).values())
+
+    def filter(self, **query):
+        """Return the list of objects matching the query, evaluated locally.
+
+        Equality tests on indexed fields (including reference fields, by
+        ID) use the indexes. Other conditions are evaluated with
+        Model.query_predicate(), which raises UnsupportedQuery for queries
+        that cannot be evaluated locally.
+        """
+        indexed = {
+            key: value for key, value in query.items()
+            if key in self._index_maps and isinstance(value, str)
+        }
+        remaining = {
+            key: value for key, value in query.items()
+            if key not in indexed
+        }
+
+        predicate = None
+        if remaining:
+            predicate = self.model.query_predicate(remaining)
+
+        with self._lock:
+            if indexed:
+                candidates = None
+                for key, value in indexed.items():
+                    matches = self._index_maps[key].get(value, {})
+                    if candidates is None:
+                        candidates = dict(matches)
+                    else:
+                        candidates = {
+                            obj_id: obj for obj_id, obj in candidates.items()
+                            if obj_id in matches}
+                objs = list(candidates.values())
+            else:
+                objs = list(self._objects.values())
+
+        if predicate is not None:
+            objs = [obj for obj in objs if predicate(obj)]
+        return objs
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._objects.values()))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._objects)
+
+    def __contains__(self, obj_id):
+        with self._lock:
+            return obj_id in self._objects
+
+
+class Informer:
+    """Keep a LocalStore in sync with a collection of the API server.
+
+    The collection, optionally restricted by a query, is listed once; then
+    events are streamed starting from the cursor returned with the list (see
+    Collection.snapshot()). Objects that were created or updated are
+    retrieved again, in batches. If events are lost, the collection is
+    listed again.
+
+    Only the events about the model are streamed. If the query can be
+    evaluated locally, the API server sends the objects along with the
+    events, and they are not retrieved again.
+
+    Listeners are called from the informer thread with the list of Changes
+    made to the store. Events received within 'batch_interval' seconds are
+    processed together, and the changes are coalesced: listeners get at
+    most one Change for every object.
+    """
+
+    # How long events are collected before being processed together
+    BATCH_INTERVAL = .1
+
+    # Maximum number of events processed together
+    MAX_BATCH_SIZE = 500
+
+    # Time to wait before reconnecting after an error
+    RETRY_INTERVAL = 1
+
+    def __init__(self, model, query=None, store=None, session=None,
+                 batch_interval=None):
+        if query is None:
+            query = {}
+        if store is None:
+            store = LocalStore(model)
+        if session is None:
+            session = current_session()
+        if batch_interval is None:
+            batch_interval = self.BATCH_INTERVAL
+        self.model = model
+        self.query = query
+        self.store = store
+        self.batch_interval = batch_interval
+        self._session = session
+        self._entity_type = model.__name__.lower()
+        try:
+            self._predicate = model.query_predicate(query)
+        except UnsupportedQuery:
+            # Objects sent with events could not be matched against the
+            # query: they have to be retrieved again
+            self._predicate = None
+        self._listeners = []
+        self._queue = queue.Queue()
+        self._stream = None
+        # The last event received from the stream, and the last event
+        # applied to the store
+        self._received_event_id = None
+        self._last_event_id = None
+        self._stop_event = threading.Event()
+        self._synced = threading.Event()
+        self._threads = []
+
+    @property
+    def collection(self):
+        return Collection(
+            model=self.model, query=self.query, session=self._session)
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self._listeners.remove(callback)
+
+    def start(self):
+        """List the collection and start following the changes. When this
+        method returns, the store is populated.
+        """
+        self._stop_event.clear()
+        self._resync()
+        self._threads = [
+            threading.Thread(target=self._read_events, daemon=True),
+            threading.Thread(target=self._process_events, daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._close_stream()
+        self._queue.put(None)
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join()
+        self._threads = []
+
+    def wait_synced(self, timeout=None):
+        """Wait until the store has been populated. Return whether it has."""
+        return self._synced.wait(timeout)
+
+    def _close_stream(self):
+        stream = self._stream
+        if stream is not None:
+            stream.close()
+
+    def _resync(self):
+        objs, last_event_id = self.collection.snapshot()
+        changes = self.store.replace(objs)
+        self._received_event_id = self._last_event_id = last_event_id
+        self._stream = self._open_stream(last_event_id + 1)
+        self._synced.set()
+        return changes
+
+    def _read_events(self):
+        while not self._stop_event.is_set():
+            try:
+                for event in self._stream:
+                    self._received_event_id = event.index
+                    self._queue.put(event)
+            except StormResyncRequired as exc:
+                log.warning('%s: listing %s again', exc, self._entity_type)
+                self._queue.put(exc)
+                return
+            except Exception:
+                if self._stop_event.is_set():
+                    return
+                log.exception('Error while streaming events')
+                self._stop_event.wait(self.RETRY_INTERVAL)
+
+            # The connection was closed: resume from the last event received
+            try:
+                self._reconnect()
+            except Exception:
+                log.exception('Error while reconnecting to the event stream')
+                self._stop_event.wait(self.RETRY_INTERVAL)
+
+    def _reconnect(self):
+        if self._stop_event.is_set():
+            return
+        self._close_stream()
+        self._stream = self._open_stream(self._received_event_id + 1)
+
+    def _open_stream(self, start):
+        return events.stream(
+            start=start, session=self._session,
+            include_entity=self._predicate is not None,
+            entity_type=self._entity_type)
+
+    def _next_batch(self):
+        item = self._queue.get()
+        if item is None or isinstance(item, StormResyncRequired):
+            return item
+
+        batch = [item]
+        deadline = time.monotonic() + self.batch_interval
+
+        while len(batch) < self.MAX_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None or isinstance(item, StormResyncRequired):
+                # Handled with the next batch
+                self._queue.put(item)
+                break
+            batch.append(item)
+
+        return batch
+
+    def _process_events(self):
+        while not self._stop_event.is_set():
+            batch = self._next_batch()
+            if batch is None:
+                return
+
+            try:
+                if isinstance(batch, StormResyncRequired):
+                    changes = self._resync_after_loss()
+                else:
+                    changes = self._apply(batch)
+            except StormException:
+                log.exception('Error while updating %s', self._entity_type)
+                continue
+
+            changes = [change for change in changes if change is not None]
+            if changes:
+                self._notify(changes)
+
+    def _resync_after_loss(self):
+        self._close_stream()
+        changes = self._resync()
+        reader = threading.Thread(target=self._read_events, daemon=True)
+        self._threads.append(reader)
+        reader.start()
+        return changes
+
+    def _apply(self, batch):
+        # Latest state of the objects in the batch: None for objects that
+        # were deleted or that no longer match the query, _RETRIEVE for
+        # objects that have to be retrieved
+        latest = {}
+
+        for event in batch:
+            if event.entity.type != self._entity_type:
+                continue
+            if event.type == 'deleted':
+                latest[event.entity.id] = None
+            elif event.entity.retrieved:
+                try:
+                    obj = event.entity.retrieve()
+                except StormObjectNotFound:
+                    obj = None
+                if obj is not None and not self._predicate(obj):
+                    obj = None
+                latest[event.entity.id] = obj
+            else:
+                latest[event.entity.id] = _RETRIEVE
+
+        retrieve_ids = [
+            obj_id for obj_id, obj in latest.items() if obj is _RETRIEVE]
+        if retrieve_ids:
+            # Objects that are not returned were deleted in the meantime,
+            # or no longer match the query
+            for obj_id in retrieve_ids:
+                latest[obj_id] = None
+            for obj in self.collection.filter(id={'$in': retrieve_ids}):
+                latest[obj.id] = obj
+
+        changes = []
+
+        for obj_id, obj in latest.items():
+            if obj is None:
+                changes.append(self.store.remove(obj_id))
+            else:
+                changes.append(self.store.put(obj))
+
+        self._last_event_id = max(event.index for event in batch)
+
+        return changes
+
+    def _notify(self, changes):
+        for callback in list(self._listeners):
+            try:
+                callback(changes)
+            except Exception:
+                log.exception('Error in informer listener %r', callback)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.stop()
@@ -1,9 +1,17 @@
+import collections
+import contextlib
+import time
 import traceback
 
 from .base import Model, Collection
-from .exceptions import StormJobError
-from .fields import StringField, ListField, DictField
+from .exceptions import (
+    StormJobError, StormNotFoundError, StormObjectNotFound)
+from .query import UnsupportedQuery
+from .fields import (
+    BooleanField, IntField, StringField, ReferenceField, ListField,
+    DictField)
 from .heartbeat import Heartbeat
+from .session import current_session
 
 
 __all__ = [
@@ -14,6 +22,7 @@ __all__ = [
     'Procedure',
     'Resource',
     'Subscription',
+    'wait_all',
 ]
 
 
@@ -30,6 +39,27 @@ class Agent(Model):
         super().__init__(*args, **kwargs)
         self.heartbeat = Heartbeat(self)
 
+    @classmethod
+    def send_heartbeats(cls, agents, session=None):
+        """
+        Send the heartbeats of many agents with a single request.
+
+        Return the list of agents that were not found by the server.
+        """
+        if session is None:
+            session = current_session()
+
+        agents = list(agents)
+        if not agents:
+            return []
+
+        response_data = session.post(
+            session.api_root / cls._path / 'heartbeats',
+            json={'agents': [agent.id for agent in agents]})
+
+        not_found = set(response_data['not_found'])
+        return [agent for agent in agents if agent.id in not_found]
+
 
 class Resource(Model):
 
@@ -37,11 +67,11 @@ class Resource(Model):
 
     type = StringField()
     names = ListField(StringField())
-    owner = StringField()
+    owner = ReferenceField()
 
-    parent = StringField(null=True)
-    cluster = StringField(null=True)
-    host = StringField(null=True)
+    parent = ReferenceField(null=True)
+    cluster = ReferenceField(null=True)
+    host = ReferenceField(null=True)
     image = StringField(null=True)
 
     status = StringField(default='unknown')
@@ -49,6 +79,58 @@ class Resource(Model):
 
     snapshot = DictField(null=True)
 
+    # Maximum number of operations sent with a single bulk request
+    BULK_SIZE = 500
+
+    BulkResult = collections.namedtuple(
+        'BulkResult', 'op resource status errors')
+
+    @classmethod
+    def bulk(cls, operations, session=None):
+        """
+        Create, update and delete many resources with a few requests.
+
+        Operations are ('upsert', resource) or ('delete', resource) tuples,
+        applied in order. Upserts update the resource if it exists, or
+        create it otherwise; created resources get their ID assigned.
+
+        Return a list of BulkResult tuples, one for each operation. The
+        status is the HTTP status code for the operation (200 for updates,
+        201 for creations, 204 for deletions, 4xx for errors).
+        """
+        if session is None:
+            session = current_session()
+
+        operations = list(operations)
+        results = []
+
+        for op, resource in operations:
+            if op == 'upsert':
+                resource.validate()
+            elif op != 'delete':
+                raise ValueError('Unknown operation: {!r}'.format(op))
+
+        for start in range(0, len(operations), cls.BULK_SIZE):
+            chunk = operations[start:start + cls.BULK_SIZE]
+            items = []
+
+            for op, resource in chunk:
+                item = {'op': op, 'id': resource.id}
+                if op == 'upsert':
+                    item['data'] = resource._data
+                items.append(item)
+
+            response_data = session.post(
+                session.api_root / cls._path / 'bulk', json=items)
+
+            for (op, resource), result in zip(chunk, response_data):
+                if op == 'upsert' and result['status'] < 300:
+                    resource.id = result['id']
+                results.append(cls.BulkResult(
+                    op, resource, result['status'], result.get('errors')))
+
+        return results
+
 
 class GroupMembersCollection(Collection):
 
@@ -90,6 +172,25 @@ class Group(Model):
         return GroupMembersCollection(
             group=self, model=Resource, query=query, session=self._session)
 
+    def has_member(self, resource):
+        """Return whether the given resource is a member of this group.
+
+        Membership is evaluated locally, using the data of this group and of
+        the resource. The API server is asked only if the query of the group
+        cannot be evaluated locally.
+        """
+        if resource.id in self.exclude:
+            return False
+        if resource.id in self.include:
+            return True
+        if not self.query:
+            return False
+
+        try:
+            return resource.matches(self.query)
+        except UnsupportedQuery:
+            return len(self.members(id=resource.id)) > 0
+
 
 class Application(Model):
 
@@ -113,7 +214,14 @@ class Procedure(Model):
     options = DictField()
     params = DictField()
 
-    def exec(self, target, options=None, params=None, wait=True):
+    def exec(self, target, options=None, params=None, wait=True,
+             priority=None, queue=None):
+        """Create a job for this procedure.
+
+        Jobs with a higher priority are handed out to agents first. Jobs
+        with the same priority are shared fairly among queues (by default,
+        each procedure has its own queue).
+        """
         if options is None:
             options = {}
         if params is None:
@@ -126,6 +234,10 @@ class Procedure(Model):
             'options': options,
             'params': params,
         }
+        if priority is not None:
+            data['priority'] = priority
+        if queue is not None:
+            data['queue'] = queue
 
         data = self._session.post(url, json=data)
         job = Job(data, session=self._session)
@@ -134,7 +246,8 @@ class Procedure(Model):
             job.wait()
         return job
 
-    def attach(self, group, target, options=None, params=None):
+    def attach(self, group, target, options=None, params=None,
+               priority=None, queue=None):
         if options is None:
             options = {}
         if params is None:
@@ -148,6 +261,10 @@ class Procedure(Model):
             'options': options,
             'params': params,
         }
+        if priority is not None:
+            data['priority'] = priority
+        if queue is not None:
+            data['queue'] = queue
 
         data = self._session.post(url, json=data)
         return Subscription(data, session=self._session)
@@ -171,24 +288,103 @@ class JobHandler:
             self.job.exception(exc_value)
 
 
+class JobOutputWriter:
+    """A file-like object that appends to the output of a running job.
+
+    Writes are buffered. The buffer is sent when it holds more than
+    'buffer_size' characters, on the first write 'flush_interval' seconds
+    after the last time it was sent, and when the writer is flushed or
+    closed.
+    """
+
+    BUFFER_SIZE = 64 * 1024
+    FLUSH_INTERVAL = 1
+
+    def __init__(self, job, buffer_size=None, flush_interval=None):
+        if buffer_size is None:
+            buffer_size = self.BUFFER_SIZE
+        if flush_interval is None:
+            flush_interval = self.FLUSH_INTERVAL
+        self.job = job
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._buffered = 0
+        self._last_flush = time.monotonic()
+
+    def write(self, data):
+        if not data:
+            return 0
+
+        self._buffer.append(data)
+        self._buffered += len(data)
+
+        if (self._buffered >= self.buffer_size or
+                time.monotonic() - self._last_flush >= self.flush_interval):
+            self.flush()
+
+        return len(data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        if not self._buffer:
+            return
+
+        data = ''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+
+        size = Job.MAX_OUTPUT_APPEND_SIZE
+        for start in range(0, len(data), size):
+            self.job.append_output(data[start:start + size])
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+
 class Job(Model):
 
     _path = 'v1/jobs'
 
     type = StringField()
-    owner = StringField(null=True, read_only=True)
+    owner = ReferenceField(null=True, read_only=True)
 
-    target = StringField(null=True)
-    procedure = StringField(null=True)
+    target = ReferenceField(null=True)
+    procedure = ReferenceField(null=True)
 
     content = StringField()
     options = DictField()
     params = DictField()
 
+    priority = IntField(null=True)
+    queue = StringField(null=True)
+
     status = StringField(read_only=True)
     result = DictField()
+    result_pruned = BooleanField(null=True, read_only=True)
+    output_size = IntField(null=True, read_only=True)
 
     created = StringField(null=True)
+    started = StringField(null=True, read_only=True)
+    completed = StringField(null=True, read_only=True)
+
+    # How long the server waits for jobs to complete with a single request.
+    # Requests are repeated until jobs are complete.
+    WAIT_TIMEOUT = 30
+
+    # Maximum number of characters appended to the output with a single
+    # request
+    MAX_OUTPUT_APPEND_SIZE = 256 * 1024
 
     def is_pending(self):
         return self.status == 'pending'
@@ -217,6 +413,31 @@ class Job(Model):
         self.reload()
         return JobHandler(self)
 
+    @classmethod
+    def claim(cls, owner, type=None, target=None, count=1, timeout=0,
+              session=None):
+        """
+        Atomically assign up to 'count' pending jobs to the given agent.
+
+        Jobs can be restricted to a type and to targets matching a query.
+        If no job is pending, the server waits up to 'timeout' seconds for
+        new jobs. Return the list of claimed jobs, already in 'running'
+        status: use JobHandler to complete them.
+        """
+        if session is None:
+            session = current_session()
+
+        data = {'owner': owner, 'count': count, 'timeout': timeout}
+        if type is not None:
+            data['type'] = type
+        if target is not None:
+            data['target'] = target
+
+        response_data = session.post(
+            session.api_root / cls._path / 'claim', json=data)
+
+        return [cls(item, session=session) for item in response_data]
+
     def complete(self, result=None):
         if result is None:
             result = {}
@@ -231,6 +452,41 @@ class Job(Model):
         self._session.post(url, json={'result': result})
         self.reload()
 
+    def append_output(self, data):
+        """Append data to the output of the job, which must be running.
+        Return the offset of the data in the output.
+        """
+        url = self.url / 'output'
+        response_data = self._session.post(url, json={'data': data})
+        return response_data['offset']
+
+    def open_output(self, **kwargs):
+        """Return a JobOutputWriter for this job."""
+        return JobOutputWriter(self, **kwargs)
+
+    def read_output(self, offset=0):
+        """Read the output of the job, starting from the given offset.
+        Return the output and the offset to read the rest of it later.
+        """
+        url = (self.url / 'output').params(offset=offset)
+        response = self._session.get(url, decode_json=False)
+        response.encoding = 'utf-8'
+        return response.text, int(response.headers['X-Output-Offset'])
+
+    def follow_output(self, offset=0):
+        """Iterate over the output of the job as it is appended, starting
+        from the given offset, until the job is complete.
+        """
+        url = (self.url / 'output').params(offset=offset, follow='true')
+        response = self._session.get(url, stream=True, decode_json=False)
+        response.encoding = 'utf-8'
+
+        with contextlib.closing(response):
+            for data in response.iter_content(
+                    chunk_size=None, decode_unicode=True):
+                if data:
+                    yield data
+
     def exception(self, exc):
         self.fail({
             'error': ''.join(traceback.format_exception(
@@ -238,21 +494,13 @@ class Job(Model):
         })
 
     def wait(self, delete=True, raise_on_error=True):
-        from . import events
-
-        event_filter = events.EventFilter([
-            events.EventMask(
-                event_type='updated', entity_type='job', entity_id=self.id),
-            events.EventMask(
-                event_type='deleted', entity_type='job', entity_id=self.id),
-        ])
-
-        with event_filter(events.stream()) as stream:
-            while True:
-                self.reload()
-                if self.is_complete():
-                    break
-                next(stream)
+        url = (self.url / 'wait').params(timeout=self.WAIT_TIMEOUT)
+
+        while not self.is_complete():
+            try:
+                self._data = self._session.get(url)
+            except StormNotFoundError:
+                raise StormObjectNotFound(self.id)
 
         if delete:
             self.delete()
@@ -260,18 +508,81 @@ class Job(Model):
         if raise_on_error:
             self.raise_on_error()
 
+    async def async_wait(self, delete=True, raise_on_error=True):
+        """Coroutine version of wait(), for jobs bound to an
+        AsyncSession."""
+        url = (self.url / 'wait').params(timeout=self.WAIT_TIMEOUT)
+
+        while not self.is_complete():
+            try:
+                self._data = await self._session.get(url)
+            except StormNotFoundError:
+                raise StormObjectNotFound(self.id)
+
+        if delete:
+            await self.async_delete()
+
+        if raise_on_error:
+            self.raise_on_error()
+
     def raise_on_error(self):
         if self.status == 'error':
             raise StormJobError(self.id, job=self, details=self.result)
 
 
+def wait_all(jobs, delete=True, raise_on_error=True, session=None):
+    """Wait for all the given jobs to complete, with a single request at a
+    time.
+
+    Jobs are updated with their final state. If raise_on_error is true, and
+    some jobs failed, StormJobError is raised for the first failed job.
+    """
+    jobs = list(jobs)
+
+    if session is None:
+        session = current_session()
+
+    url = session.api_root / Job._path / 'wait'
+    pending = {job.id: job for job in jobs if not job.is_complete()}
+
+    while pending:
+        response_data = session.post(url, json={
+            'jobs': list(pending),
+            'mode': 'all',
+            'timeout': Job.WAIT_TIMEOUT,
+        })
+
+        found_ids = set()
+        for item in response_data:
+            job = pending[item['id']]
+            job._data = item
+            found_ids.add(job.id)
+
+        for job_id in list(pending):
+            if job_id not in found_ids:
+                raise StormObjectNotFound(job_id)
+            if pending[job_id].is_complete():
+                del pending[job_id]
+
+    if delete:
+        for job in jobs:
+            job.delete()
+
+    if raise_on_error:
+        for job in jobs:
+            job.raise_on_error()
+
+
 class Subscription(Model):
 
     _path = 'v1/subscriptions'
 
-    group = StringField(null=True)
-    procedure = StringField(null=True)
+    group = ReferenceField(null=True)
+    procedure = ReferenceField(null=True)
 
-    target = StringField(null=True)
+    target = ReferenceField(null=True)
     options = DictField()
     params = DictField()
+
+    priority = IntField(null=True)
+    queue = StringField(null=True)
@@ -0,0 +1,368 @@
+"""
+Evaluation of Storm queries in Python.
+
+Storm queries are MongoDB queries. This module compiles the subset of the
+MongoDB query language supported by Perfect Storm into Python predicates, so
+that documents can be tested against queries without asking the API server
+(or the database). Both the API server and clients use this module, so that
+they agree on the semantics of queries.
+"""
+
+import datetime
+import functools
+import json
+import numbers
+import re
+
+
+__all__ = [
+    'UnsupportedQuery',
+    'candidates',
+    'compile_query',
+    'match',
+    'resolve',
+]
+
+
+class UnsupportedQuery(ValueError):
+    """Raised when a query uses features not supported by compile_query()."""
+
+
+def _type_class(value):
+    # MongoDB compares values only if they belong to the same type class
+    # (e.g. 1 matches 1.0, but not True or '1')
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, numbers.Number):
+        return 'number'
+    if isinstance(value, str):
+        return 'string'
+    if isinstance(value, dict):
+        return 'object'
+    if isinstance(value, (list, tuple)):
+        return 'array'
+    if isinstance(value, datetime.datetime):
+        return 'date'
+    return type(value).__name__
+
+
+def _equal(a, b):
+    type_class = _type_class(a)
+    if type_class != _type_class(b):
+        return False
+    if type_class == 'object':
+        # Embedded documents are equal only if they have the same fields,
+        # in the same order
+        return (
+            list(a) == list(b) and
+            all(_equal(a[key], b[key]) for key in a))
+    if type_class == 'array':
+        return (
+            len(a) == len(b) and
+            all(_equal(x, y) for x, y in zip(a, b)))
+    return a == b
+
+
+def resolve(value, path):
+    """Return all the values found at the given dotted path.
+
+    Like MongoDB does, arrays are traversed: {'a': [{'b': 1}, {'b': 2}]}
+    has the values [1, 2] at the path 'a.b'.
+    """
+    if isinstance(path, str):
+        path = path.split('.')
+
+    if not path:
+        return [value]
+
+    key, rest = path[0], path[1:]
+
+    if isinstance(value, dict):
+        if key in value:
+            return resolve(value[key], rest)
+        return []
+
+    if isinstance(value, list):
+        result = []
+        if key.isdigit() and int(key) < len(value):
+            result.extend(resolve(value[int(key)], rest))
+        for item in value:
+            if isinstance(item, dict):
+                result.extend(resolve(item, path))
+        return result
+
+    return []
+
+
+def candidates(values):
+    """Expand the values returned by resolve() with the elements of arrays.
+
+    A condition on a field holding an array matches if it matches either the
+    array itself or any of its elements.
+    """
+    for value in values:
+        yield value
+        if isinstance(value, list):
+            yield from value
+
+
+def _compile_equal(expected):
+    if isinstance(expected, dict) and any(
+            key.startswith('$') for key in expected):
+        raise UnsupportedQuery('Unexpected operator in value')
+
+    if expected is None:
+        def match(values):
+            # {'x': None} matches documents where 'x' is null or missing
+            return not values or any(
+                item is None for item in candidates(values))
+    else:
+        def match(values):
+            return any(
+                _equal(item, expected) for item in candidates(values))
+    return match
+
+
+def _compile_in(expected_list):
+    if not isinstance(expected_list, list):
+        raise UnsupportedQuery('$in/$nin require an array')
+    matchers = [_compile_equal(expected) for expected in expected_list]
+
+    def match(values):
+        return any(matcher(values) for matcher in matchers)
+    return match
+
+
+def _compile_compare(op, expected):
+    compare = {
+        '$gt': lambda a, b: a > b,
+        '$gte': lambda a, b: a >= b,
+        '$lt': lambda a, b: a < b,
+        '$lte': lambda a, b: a <= b,
+    }[op]
+
+    type_class = _type_class(expected)
+    if type_class not in ('number', 'string', 'date'):
+        raise UnsupportedQuery('Unsupported operand for {}: {!r}'.format(
+            op, expected))
+
+    def match(values):
+        return any(
+            _type_class(item) == type_class and compare(item, expected)
+            for item in candidates(values))
+    return match
+
+
+def _compile_regex(pattern, options=''):
+    if not isinstance(pattern, str):
+        raise UnsupportedQuery('$regex requires a string')
+
+    flags = 0
+    for char in options:
+        try:
+            flags |= {
+                'i': re.IGNORECASE,
+                'm': re.MULTILINE,
+                's': re.DOTALL,
+                'x': re.VERBOSE,
+            }[char]
+        except KeyError:
+            raise UnsupportedQuery('Unknown $options: {!r}'.format(char))
+
+    try:
+        regex = re.compile(pattern, flags)
+    except re.error as exc:
+        raise UnsupportedQuery('Invalid $regex: {}'.format(exc))
+
+    def match(values):
+        return any(
+            isinstance(item, str) and regex.search(item) is not None
+            for item in candidates(values))
+    return match
+
+
+def _compile_size(size):
+    if not isinstance(size, int) or isinstance(size, bool):
+        raise UnsupportedQuery('$size requires an integer')
+
+    def match(values):
+        return any(
+            isinstance(item, list) and len(item) == size
+            for item in values)
+    return match
+
+
+def _compile_all(expected_list):
+    if not isinstance(expected_list, list):
+        raise UnsupportedQuery('$all requires an array')
+    matchers = [_compile_equal(expected) for expected in expected_list]
+
+    def match(values):
+        return bool(matchers) and all(
+            matcher(values) for matcher in matchers)
+    return match
+
+
+def _compile_elem_match(query):
+    if not isinstance(query, dict):
+        raise UnsupportedQuery('$elemMatch requires an object')
+
+    if all(key.startswith('$') and key not in ('$and', '$or', '$nor')
+           for key in query):
+        # {'$elemMatch': {'$gt': 1, '$lt': 5}}: conditions apply to the
+        # elements themselves
+        matchers = _compile_operators(query)
+
+        def match_element(element):
+            return all(matcher([element]) for matcher in matchers)
+    else:
+        # {'$elemMatch': {'a': 1, 'b': 2}}: elements are documents
+        predicate = _compile(query)
+
+        def match_element(element):
+            return isinstance(element, dict) and predicate(element)
+
+    def match(values):
+        return any(
+            isinstance(item, list) and any(
+                match_element(element) for element in item)
+            for item in values)
+    return match
+
+
+def _compile_not(query):
+    if not isinstance(query, dict) or not query:
+        raise UnsupportedQuery('$not requires an object')
+    matchers = _compile_operators(query)
+
+    def match(values):
+        return not all(matcher(values) for matcher in matchers)
+    return match
+
+
+def _compile_operators(operators):
+    matchers = []
+
+    for op, arg in operators.items():
+        if op == '$eq':
+            matchers.append(_compile_equal(arg))
+        elif op == '$ne':
+            matcher = _compile_equal(arg)
+            matchers.append(lambda values, m=matcher: not m(values))
+        elif op == '$in':
+            matchers.append(_compile_in(arg))
+        elif op == '$nin':
+            matcher = _compile_in(arg)
+            matchers.append(lambda values, m=matcher: not m(values))
+        elif op in ('$gt', '$gte', '$lt', '$lte'):
+            matchers.append(_compile_compare(op, arg))
+        elif op == '$exists':
+            expected = bool(arg)
+            matchers.append(
+                lambda values, e=expected: bool(values) == e)
+        elif op == '$regex':
+            matchers.append(
+                _compile_regex(arg, operators.get('$options', '')))
+        elif op == '$options':
+            if '$regex' not in operators:
+                raise UnsupportedQuery('$options without $regex')
+        elif op == '$size':
+            matchers.append(_compile_size(arg))
+        elif op == '$all':
+            matchers.append(_compile_all(arg))
+        elif op == '$elemMatch':
+            matchers.append(_compile_elem_match(arg))
+        elif op == '$not':
+            matchers.append(_compile_not(arg))
+        else:
+            raise UnsupportedQuery('Unsupported operator: {}'.format(op))
+
+    return matchers
+
+
+def _compile_field(key, condition):
+    path = key.split('.')
+
+    if isinstance(condition, dict) and any(
+            item.startswith('$') for item in condition):
+        matchers = _compile_operators(condition)
+    else:
+        matchers = [_compile_equal(condition)]
+
+    def predicate(document):
+        values = resolve(document, path)
+        return all(matcher(values) for matcher in matchers)
+    return predicate
+
+
+def _compile_logical(op, queries):
+    if not isinstance(queries, list) or not queries:
+        raise UnsupportedQuery('{} requires a nonempty array'.format(op))
+
+    predicates = [_compile(item) for item in queries]
+
+    if op == '$and':
+        return lambda document: all(
+            predicate(document) for predicate in predicates)
+    elif op == '$or':
+        return lambda document: any(
+            predicate(document) for predicate in predicates)
+    else:
+        return lambda document: not any(
+            predicate(document) for predicate in predicates)
+
+
+def _compile(query):
+    if not isinstance(query, dict):
+        raise UnsupportedQuery('Query must be a dictionary')
+
+    predicates = []
+
+    for key, condition in query.items():
+        if key in ('$and', '$or', '$nor'):
+            predicates.append(_compile_logical(key, condition))
+        elif key.startswith('$'):
+            raise UnsupportedQuery('Unsupported operator: {}'.format(key))
+        else:
+            predicates.append(_compile_field(key, condition))
+
+    if not predicates:
+        return lambda document: True
+    if len(predicates) == 1:
+        return predicates[0]
+
+    return lambda document: all(
+        predicate(document) for predicate in predicates)
+
+
+@functools.lru_cache(maxsize=1024)
+def _compile_cached(query_json):
+    return _compile(json.loads(query_json))
+
+
+def compile_query(query):
+    """Compile a query into a Python predicate.
+
+    The predicate accepts a document (a dictionary) and returns whether the
+    query matches it. Documents must use the same representation that the
+    query expects: on the API server, queries are evaluated against the
+    MongoDB representation of documents; on clients, against the data
+    returned by the API.
+
+    Compiled queries are cached. UnsupportedQuery is raised if the query uses
+    operators that are not implemented.
+    """
+    try:
+        # Key order is relevant for the semantics of queries
+        query_json = json.dumps(query)
+    except (TypeError, ValueError):
+        # Not JSON-serializable (e.g. it contains dates): do not cache
+        return _compile(query)
+    return _compile_cached(query_json)
+
+
+def match(query, document):
+    """Return whether the query matches the given document."""
+    return compile_query(query)(document)
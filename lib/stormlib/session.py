@@ -1,9 +1,12 @@
 import logging
 import threading
+import time
 import urllib.parse
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
+from urllib3.util.retry import Retry
 
 from .exceptions import (
     StormAPIError,
@@ -24,6 +27,13 @@ _local_sessions = threading.local()
 DEFAULT_HOST = '127.0.0.1'
 DEFAULT_PORT = 28482
 
+# Requests that can be sent again if the response was not received. DELETE
+# is idempotent, but retrying it would turn a success into a 404.
+RETRY_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT'])
+
+# Responses sent by proxies when the API server is unavailable
+RETRY_STATUSES = frozenset([502, 503, 504])
+
 
 def _get_current_session():
     try:
@@ -44,9 +54,9 @@ def current_session():
     return CurrentSessionProxy()
 
 
-def connect(host=None, port=None):
+def connect(host=None, port=None, **kwargs):
     global _global_session
-    session = Session(host, port)
+    session = Session(host, port, **kwargs)
     with _lock:
         _global_session = session
     return session
@@ -98,15 +108,128 @@ class UrlPath:
         return '<{}: {}>'.format(self.__class__.__name__, str(self))
 
 
-class Session:
+def _make_retry(max_retries, backoff):
+    kwargs = {
+        'total': max_retries,
+        'connect': max_retries,
+        'read': max_retries,
+        'status': max_retries,
+        'status_forcelist': RETRY_STATUSES,
+        'backoff_factor': backoff,
+        'raise_on_status': False,
+    }
+    try:
+        return Retry(allowed_methods=RETRY_METHODS, **kwargs)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=RETRY_METHODS, **kwargs)
 
-    def __init__(self, host=None, port=None):
+
+class Session:
+    """A connection to the API server.
+
+    Connections are pooled and kept alive between requests; a Session can
+    be shared by any number of threads. Requests that fail because the API
+    server could not be reached are retried, with an exponential backoff.
+    Requests that may have been processed by the API server are retried
+    only if they are idempotent (see RETRY_METHODS).
+    """
+
+    # Maximum number of idle connections kept open. More connections are
+    # opened if needed, but they are closed after use.
+    POOL_SIZE = 10
+
+    # Timeouts, in seconds, to connect to the API server and between two
+    # reads from the socket. Streams and long polls (Job.claim(),
+    # Job.wait()) can be silent for a long time: by default, reads never
+    # time out.
+    CONNECT_TIMEOUT = 10
+    READ_TIMEOUT = None
+
+    MAX_RETRIES = 3
+    RETRY_BACKOFF = .2
+
+    def __init__(self, host=None, port=None, pool_size=None,
+                 connect_timeout=None, read_timeout=None, max_retries=None,
+                 retry_backoff=None, keep_alive=True):
         if host is None:
             host = DEFAULT_HOST
         if port is None:
             port = DEFAULT_PORT
+        if pool_size is None:
+            pool_size = self.POOL_SIZE
+        if connect_timeout is None:
+            connect_timeout = self.CONNECT_TIMEOUT
+        if read_timeout is None:
+            read_timeout = self.READ_TIMEOUT
+        if max_retries is None:
+            max_retries = self.MAX_RETRIES
+        if retry_backoff is None:
+            retry_backoff = self.RETRY_BACKOFF
         self.api_root = UrlPath('http://{}:{}/'.format(
             urllib.parse.quote(host), int(port)))
+        self.timeout = (connect_timeout, read_timeout)
+
+        self._adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=_make_retry(max_retries, retry_backoff))
+        self._http = requests.Session()
+        self._http.mount('http://', self._adapter)
+        self._http.mount('https://', self._adapter)
+        if not keep_alive:
+            self._http.headers['Connection'] = 'close'
+
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'requests': 0,
+            'errors': 0,
+            'total_time': 0.,
+            'max_time': 0.,
+        }
+
+    def close(self):
+        """Close the connections of the pool."""
+        self._http.close()
+
+    def get_stats(self):
+        """Return counters about the requests made with this Session.
+
+        'requests' counts the API calls, 'connections' the connections
+        opened (including failed attempts) and 'reused' the requests sent
+        over a connection that was already open. Times are in seconds, and
+        they include retries; for streams, they stop when the response
+        headers are received.
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+
+        # Pools cannot be iterated over directly: that is not thread-safe
+        pools = self._adapter.poolmanager.pools
+        connections = pool_requests = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                pool_requests += pool.num_requests
+
+        stats['connections'] = connections
+        stats['reused'] = max(pool_requests - connections, 0)
+        if stats['requests']:
+            stats['avg_time'] = stats['total_time'] / stats['requests']
+        else:
+            stats['avg_time'] = 0.
+        return stats
+
+    def _record(self, elapsed, error):
+        with self._stats_lock:
+            stats = self._stats
+            stats['requests'] += 1
+            stats['total_time'] += elapsed
+            if elapsed > stats['max_time']:
+                stats['max_time'] = elapsed
+            if error:
+                stats['errors'] += 1
 
     def _check_url(self, url):
         root = str(self.api_root) + '/'
@@ -117,16 +240,20 @@ class Session:
         method = method.upper()
         url = self.api_root / path
         self._check_url(url)
+        kwargs.setdefault('timeout', self.timeout)
 
+        start_time = time.monotonic()
         try:
             try:
-                response = requests.request(method, url, **kwargs)
+                response = self._http.request(method, str(url), **kwargs)
                 response.raise_for_status()
             except requests.exceptions.RequestException as exc:
                 raise self.wrap_exception(exc)
         except Exception as exc:
+            self._record(time.monotonic() - start_time, error=True)
             log.debug('%s %s -> %s', method, url, type(exc).__name__)
             raise
+        self._record(time.monotonic() - start_time, error=False)
 
         log.debug(
             '%s %s -> %s %s',
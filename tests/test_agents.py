@@ -1,6 +1,7 @@
-from stormlib import Agent
+from stormlib import Agent, events
 
 from .create import BaseTestCreate
+from .samples import delete_on_exit
 from .stubs import ANY, IDENTIFIER, PLACEHOLDER, random_name
 
 
@@ -80,3 +81,44 @@ class TestCreate(BaseTestCreate):
             },
         ),
     ]
+
+
+def agent_events(agent):
+    return [
+        ev for ev in events.latest()
+        if ev.entity.type == 'agent' and ev.entity.id == agent.id]
+
+
+class TestHeartbeat:
+
+    def test_transition(self):
+        with delete_on_exit(Agent(type='test')) as agent:
+            agent.save()
+            assert agent.status == 'offline'
+            count = len(agent_events(agent))
+
+            agent.heartbeat()
+            agent.reload()
+            assert agent.status == 'online'
+
+            # Only the transition from offline to online is recorded
+            assert len(agent_events(agent)) == count + 1
+            agent.heartbeat()
+            agent.heartbeat()
+            assert len(agent_events(agent)) == count + 1
+
+    def test_batch(self):
+        first = Agent(type='test')
+        second = Agent(type='test')
+        first.save()
+        second.save()
+
+        with delete_on_exit(first), delete_on_exit(second):
+            missing = Agent(id='agt-missing', type='test')
+            not_found = Agent.send_heartbeats([first, second, missing])
+            assert not_found == [missing]
+
+            first.reload()
+            second.reload()
+            assert first.status == 'online'
+            assert second.status == 'online'
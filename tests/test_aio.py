@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+
+from stormlib import Resource
+from stormlib.exceptions import StormObjectNotFound
+from stormlib.executors.base import AsyncioPipelineExecutor
+
+from . import samples
+
+aio = pytest.importorskip('stormlib.aio')
+
+
+@pytest.fixture()
+def run(request):
+    host = request.config.getoption('--api-server-host')
+    port = request.config.getoption('--api-server-port')
+    loop = asyncio.new_event_loop()
+
+    def run(func):
+        async def main():
+            async with aio.AsyncSession(host, port) as session:
+                return await func(session)
+        return loop.run_until_complete(main())
+
+    yield run
+    loop.close()
+
+
+def test_collection(run, random_resources):
+    owner = random_resources[0].owner
+    expected_ids = sorted(res.id for res in random_resources)
+
+    async def main(session):
+        resources = session.objects(Resource).filter(owner=owner)
+        ids = [res.id async for res in resources]
+        count = await resources.count()
+        first = await resources.get(id=expected_ids[0])
+        return ids, count, first
+
+    ids, count, first = run(main)
+
+    assert ids == expected_ids
+    assert count == len(expected_ids)
+    assert first.id == expected_ids[0]
+
+
+def test_save_reload_delete(run, agent):
+    resource = samples.create_resource(owner=agent.id)
+
+    async def main(session):
+        res = await session.objects(Resource).get(resource.id)
+        res.image = 'scrambled_egg'
+        await res.async_save()
+
+        copy = Resource(id=res.id, session=session)
+        await copy.async_reload()
+        assert copy.image == 'scrambled_egg'
+
+        await res.async_delete()
+        with pytest.raises(StormObjectNotFound):
+            await copy.async_reload()
+
+    run(main)
+
+
+def test_stream(run, agent):
+    async def main(session):
+        async with aio.stream(session, ['created:resource']) as stream:
+            loop = asyncio.get_event_loop()
+            resource = await loop.run_in_executor(
+                None, lambda: samples.create_resource(owner=agent.id))
+            async for event in stream:
+                if event.entity.id == resource.id:
+                    return event
+
+    event = run(main)
+
+    assert event.type == 'created'
+
+
+def test_executor_loop():
+    loops = []
+
+    async def job():
+        loops.append(asyncio.get_event_loop())
+
+    # Every run gets a new event loop, closed once the jobs are complete
+    executor = AsyncioPipelineExecutor(jobs=[job], on_error='raise')
+    executor()
+    executor()
+
+    assert len(loops) == 2
+    assert loops[0] is not loops[1]
+    assert all(loop.is_closed() for loop in loops)
+
+    # A loop given to the executor is used, and left open
+    loop = asyncio.new_event_loop()
+    executor = AsyncioPipelineExecutor(
+        jobs=[job], loop=loop, on_error='raise')
+    executor()
+
+    assert loops[-1] is loop
+    assert not loop.is_closed()
+    loop.close()
@@ -5,8 +5,9 @@ import time
 
 import pytest
 
-from stormlib import events
+from stormlib import Resource, events
 from stormlib.events import Event, Entity
+from stormlib.exceptions import StormObjectNotFound
 
 from . import samples
 from .stubs import ANY
@@ -138,3 +139,128 @@ def test_stream_start(agent):
 
     with collect_realtime_events(start=start) as realtime_events:
         assert_event_in(event, realtime_events, wait=True)
+
+
+def test_stream_many_clients(agent):
+    # All the clients connected to the same API server share the same event
+    # source: check that every one of them receives the events
+    with contextlib.ExitStack() as stack:
+        queues = [
+            stack.enter_context(collect_realtime_events())
+            for i in range(16)
+        ]
+
+        res = samples.create_resource(owner=agent.id)
+        entity = Entity('resource', res.id, res.names)
+
+        for events_queue in queues:
+            assert_event_in(
+                Event(ANY, 'created', entity), events_queue, wait=True)
+
+
+def test_dispatcher_metrics(api_session, agent):
+    samples.create_resource(owner=agent.id)
+
+    # The new event should be dispatched shortly
+    timeout = time.time() + 5
+
+    while True:
+        metrics = api_session.get(api_session.api_root / 'v1/metrics')
+        dispatcher = metrics['dispatcher']
+        if dispatcher['lag_events'] == 0 or time.time() > timeout:
+            break
+        time.sleep(.2)
+
+    assert dispatcher['lag_events'] == 0
+    assert dispatcher['checkpoint'] == dispatcher['last_event_id']
+
+
+def test_resume_from_oldest(api_session, agent):
+    samples.create_resource(owner=agent.id)
+
+    url = (api_session.api_root / 'v1/events').params(count=1)
+    response = api_session.get(url, decode_json=False)
+    oldest_event_id = int(response.headers['X-Oldest-Event-Id'])
+
+    # Resuming from the oldest event retained does not require a resync
+    with events.stream(start=oldest_event_id) as stream:
+        assert next(stream).index == oldest_event_id
+
+
+def test_list_then_watch(agent):
+    existing = samples.create_resource(owner=agent.id)
+
+    resources, last_event_id = Resource.objects.filter(
+        owner=agent.id).snapshot()
+    assert existing.id in [res.id for res in resources]
+
+    new = samples.create_resource(owner=agent.id)
+
+    # The changes reflected in the list are not streamed again, and no
+    # later change is missed
+    with events.stream(start=last_event_id + 1) as stream:
+        for event in stream:
+            assert event.index > last_event_id
+            if event.entity.id == new.id:
+                break
+
+    assert event.type == 'created'
+
+
+def test_stream_include_entity(agent):
+    res = samples.create_resource(owner=agent.id)
+    start = events.latest(count=1)[-1].index + 1
+
+    res.image = 'scrambled_egg'
+    res.save()
+    res.delete()
+
+    received = {}
+    with events.stream(start=start, include_entity=True) as stream:
+        for event in stream:
+            if event.entity.id == res.id:
+                received[event.type] = event
+                if event.type == 'deleted':
+                    break
+
+    # Updated entities are sent in their current state (here, they no
+    # longer exist); deleted entities in their last state
+    assert received['updated'].entity.retrieved
+    with pytest.raises(StormObjectNotFound):
+        received['updated'].entity.retrieve()
+
+    deleted = received['deleted'].entity.retrieve()
+    assert deleted.id == res.id
+    assert deleted.image == 'scrambled_egg'
+
+
+def test_latest_entity_fields(agent):
+    res = samples.create_resource(owner=agent.id)
+
+    latest_events = events.latest(
+        count=10, include_entity=True, entity_fields=['image'])
+    event = [ev for ev in latest_events if ev.entity.id == res.id][-1]
+
+    obj = event.entity.retrieve()
+    assert obj._data == {'id': res.id, 'image': res.image}
+    assert obj._partial
+
+
+def test_stream_entity_type(agent):
+    with collect_realtime_events(entity_type='group') as events_queue:
+        res = samples.create_resource(owner=agent.id)
+        group = samples.create_group()
+
+        # Events are delivered in order: the event of the resource would
+        # come before the one of the group
+        received = []
+        timeout = time.time() + 5
+        while group.id not in [ev.entity.id for ev in received]:
+            assert time.time() < timeout
+            if events_queue:
+                received.append(events_queue.popleft())
+            else:
+                time.sleep(.2)
+
+    assert res.id not in [ev.entity.id for ev in received]
+    assert {ev.entity.type for ev in received} == {'group'}
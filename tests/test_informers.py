@@ -0,0 +1,88 @@
+import queue
+import time
+
+import pytest
+
+from stormlib import Resource
+from stormlib.informers import Informer, LocalStore
+
+from . import samples
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            pytest.fail('Timed out waiting for the informer')
+        time.sleep(.1)
+
+
+@pytest.fixture()
+def informer(agent):
+    informer = Informer(Resource, {'owner': agent.id})
+    yield informer
+    informer.stop()
+
+
+def test_initial_list(agent, informer):
+    resources = [samples.create_resource(owner=agent.id) for i in range(5)]
+
+    informer.start()
+
+    assert informer.wait_synced(0)
+    assert sorted(res.id for res in informer.store) == sorted(
+        res.id for res in resources)
+    assert informer.store.get(resources[0].id).names == resources[0].names
+    assert len(informer.store.by('owner', agent.id)) == 5
+
+    expected_ids = sorted(
+        res.id for res in resources if res.type == resources[0].type)
+    assert sorted(
+        res.id for res in informer.store.filter(type=resources[0].type)
+    ) == expected_ids
+
+
+def test_changes(agent, informer):
+    changes = queue.Queue()
+    informer.add_listener(changes.put)
+    informer.start()
+
+    assert len(informer.store) == 0
+
+    res = samples.create_resource(owner=agent.id)
+    wait_for(lambda: res.id in informer.store)
+
+    change, = changes.get(timeout=5)
+    assert change.old is None
+    assert change.new.id == res.id
+
+    res.image = 'scrambled_egg'
+    res.save()
+    wait_for(lambda: informer.store.get(res.id).image == 'scrambled_egg')
+
+    res.delete()
+    wait_for(lambda: res.id not in informer.store)
+
+    assert informer.store.filter(image='scrambled_egg') == []
+
+
+def test_local_store():
+    store = LocalStore(Resource)
+    res = Resource(
+        id='res-1', type='alpha', names=['one', 'uno'], owner='agt-1')
+
+    change = store.put(res)
+    assert change.old is None and change.new is res
+
+    assert store.lookup('uno') is res
+    assert store.by('owner', 'agt-1') == [res]
+    assert store.filter(type='alpha', names='one') == [res]
+    assert store.filter(type='beta') == []
+
+    with pytest.raises(ValueError):
+        store.by('image', 'scrambled_egg')
+
+    changes = store.replace([])
+    assert [(change.old, change.new) for change in changes] == [(res, None)]
+    assert store.by('owner', 'agt-1') == []
+    assert store.remove('res-1') is None
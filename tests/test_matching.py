@@ -0,0 +1,180 @@
+import pytest
+
+from stormlib import Resource
+from stormlib.query import UnsupportedQuery, compile_query
+
+from .samples import create_agent, create_group, create_resource
+
+
+SNAPSHOTS = [
+    None,
+    {},
+    {'Name': 'web', 'Replicas': 3, 'Ports': [80, 443]},
+    {'Name': 'db', 'Replicas': 1, 'Ports': [27017]},
+    {'Name': 'cache', 'Replicas': 0.5, 'Ports': []},
+    {'Name': 'Web', 'Replicas': '3', 'Ports': [[80, 443]]},
+    {'Replicas': None, 'Ports': None},
+    {'Spec': {'Labels': {'storm-grouped': 'yes', 'tier': 'frontend'}}},
+    {'Spec': {'Labels': {'tier': 'backend'}}},
+    {'Spec': {'Labels': {}}},
+    {'Tasks': [{'State': 'running', 'Slot': 1},
+               {'State': 'failed', 'Slot': 2}]},
+    {'Tasks': [{'State': 'running', 'Slot': 3}]},
+    {'Tasks': [{'State': 'failed'}, {'Slot': 1}]},
+    {'Tasks': []},
+    {'Env': {'A': 1, 'B': 2}},
+    {'Env': {'B': 2, 'A': 1}},
+    {'Flag': True},
+    {'Flag': 1},
+    {'Flag': False},
+]
+
+
+@pytest.fixture(scope='module')
+def resources():
+    agent = create_agent()
+
+    try:
+        for snapshot in SNAPSHOTS:
+            create_resource(owner=agent.id, snapshot=snapshot)
+        yield Resource.objects.filter(owner=agent.id)
+    finally:
+        agent.delete()
+
+
+QUERIES = [
+    {},
+    {'type': 'alpha'},
+    {'type': {'$eq': 'alpha'}},
+    {'type': {'$ne': 'alpha'}},
+    {'type': {'$in': ['alpha', 'beta']}},
+    {'type': {'$nin': ['alpha', 'beta']}},
+    {'type': {'$regex': '^(alpha|gamma)$'}},
+    {'type': {'$regex': '^ALPHA$', '$options': 'i'}},
+    {'type': {'$not': {'$in': ['alpha', 'beta']}}},
+    {'type': {'$gt': 'beta'}},
+    {'type': 'alpha', 'image': {'$exists': True}},
+    {'image': None},
+    {'image': {'$ne': None}},
+    {'image': {'$exists': False}},
+    {'image': {'$regex': 'nginx:1\\.1[23]'}},
+    {'$or': [{'type': 'alpha'}, {'image': None}]},
+    {'$and': [{'type': {'$ne': 'alpha'}}, {'type': {'$ne': 'beta'}}]},
+    {'$nor': [{'type': 'alpha'}, {'type': 'beta'}]},
+
+    # List fields
+    {'names': {'$size': 0}},
+    {'names': {'$size': 2}},
+    {'names': []},
+    {'names': {'$exists': True}},
+    {'names.0': {'$exists': True}},
+    {'names.1': {'$exists': False}},
+    {'names': {'$regex': '^[a-m]'}},
+    {'names': {'$all': []}},
+    {'names': {'$elemMatch': {'$regex': '^[n-z]'}}},
+
+    # Dotted snapshot paths
+    {'snapshot': None},
+    {'snapshot': {}},
+    {'snapshot.Name': 'web'},
+    {'snapshot.Name': {'$in': ['web', 'db']}},
+    {'snapshot.Name': {'$regex': '^w', '$options': 'i'}},
+    {'snapshot.Replicas': 3},
+    {'snapshot.Replicas': {'$gt': 0}},
+    {'snapshot.Replicas': {'$gte': 1}},
+    {'snapshot.Replicas': {'$lt': 1}},
+    {'snapshot.Replicas': {'$lte': 1}},
+    {'snapshot.Replicas': {'$gt': '2'}},
+    {'snapshot.Replicas': None},
+    {'snapshot.Replicas': {'$exists': True}},
+    {'snapshot.Replicas': {'$not': {'$gt': 1}}},
+    {'snapshot.Ports': 80},
+    {'snapshot.Ports': [80, 443]},
+    {'snapshot.Ports': [443, 80]},
+    {'snapshot.Ports': {'$all': [80, 443]}},
+    {'snapshot.Ports': {'$in': [443, 27017]}},
+    {'snapshot.Ports': {'$nin': [80]}},
+    {'snapshot.Ports': {'$size': 2}},
+    {'snapshot.Ports': {'$size': 0}},
+    {'snapshot.Ports': {'$gt': 1000}},
+    {'snapshot.Ports': {'$elemMatch': {'$gt': 100, '$lt': 500}}},
+    {'snapshot.Ports.0': 80},
+    {'snapshot.Ports.0': [80, 443]},
+    {'snapshot.Spec.Labels.storm-grouped': {'$exists': True}},
+    {'snapshot.Spec.Labels.storm-grouped': {'$exists': False}},
+    {'snapshot.Spec.Labels.tier': {'$in': ['frontend', 'backend']}},
+    {'snapshot.Spec.Labels': {}},
+    {'snapshot.Tasks.State': 'running'},
+    {'snapshot.Tasks.State': {'$ne': 'running'}},
+    {'snapshot.Tasks.Slot': {'$gte': 2}},
+    {'snapshot.Tasks.Slot': {'$exists': False}},
+    {'snapshot.Tasks.1.State': 'failed'},
+    {'snapshot.Tasks': {'$elemMatch': {'State': 'running', 'Slot': 3}}},
+    {'snapshot.Tasks': {'$elemMatch': {'State': 'failed', 'Slot': 2}}},
+    {'snapshot.Tasks': {'$size': 0}},
+    {'snapshot.Tasks': {'State': 'failed'}},
+    {'snapshot.Env': {'A': 1, 'B': 2}},
+    {'snapshot.Env.A': 1},
+    {'snapshot.Flag': True},
+    {'snapshot.Flag': 1},
+    {'snapshot.Flag': {'$ne': False}},
+    {'snapshot.Missing': None},
+    {'snapshot.Missing': {'$exists': True}},
+]
+
+
+@pytest.mark.parametrize('query', QUERIES)
+def test_conformance(resources, query):
+    # Compare the results of MongoDB with the results of local evaluation
+    all_resources = list(resources)
+    server_ids = {res.id for res in resources.all().filter(**query)}
+    local_ids = {res.id for res in all_resources if res.matches(query)}
+
+    assert local_ids == server_ids
+
+
+@pytest.mark.parametrize('query', [
+    {'$where': 'true'},
+    {'type': {'$type': 'string'}},
+    {'type': {'$regex': '('}},
+    {'type': {'$regex': 'a', '$options': 'q'}},
+    {'snapshot.Replicas': {'$gt': {}}},
+    {'$or': []},
+    {'$and': {}},
+])
+def test_unsupported(query):
+    with pytest.raises(UnsupportedQuery):
+        compile_query(query)
+
+
+@pytest.mark.parametrize('query', [
+    {'owner': 'agent'},
+    {'$or': [{'parent': 'parent'}, {'type': 'alpha'}]},
+    {'a$b': 'c'},
+])
+def test_unsupported_locally(query):
+    with pytest.raises(UnsupportedQuery):
+        Resource.query_predicate(query)
+
+
+@pytest.mark.parametrize('query', [
+    {},
+    {'type': 'alpha'},
+    {'snapshot.Tasks.State': 'running'},
+    {'owner': {'$exists': True}},
+])
+def test_has_member(resources, query):
+    all_resources = list(resources)
+    include = [res.id for res in all_resources[:3]]
+    exclude = [res.id for res in all_resources[-3:]]
+
+    group = create_group(query=query, include=include, exclude=exclude)
+
+    try:
+        all_ids = {res.id for res in all_resources}
+        member_ids = {res.id for res in group.members()} & all_ids
+        local_ids = {
+            res.id for res in all_resources if group.has_member(res)}
+        assert local_ids == member_ids
+    finally:
+        group.delete()
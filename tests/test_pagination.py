@@ -0,0 +1,110 @@
+import time
+
+import pytest
+
+from stormlib import Job, Resource
+from stormlib.base import Collection
+from stormlib.exceptions import StormBadRequestError
+
+
+@pytest.fixture()
+def resources(random_resources):
+    owner = random_resources[0].owner
+    return Resource.objects.filter(owner=owner)
+
+
+@pytest.fixture()
+def small_pages(monkeypatch):
+    monkeypatch.setattr(Collection, 'PAGE_SIZE', 7)
+
+
+def test_pages(api_session, resources):
+    url = resources.url.params(limit=10)
+    seen_ids = []
+
+    while True:
+        response = api_session.get(url, decode_json=False)
+        page = response.json()
+
+        assert len(page) <= 10
+        seen_ids.extend(doc['id'] for doc in page)
+
+        if 'next' not in response.links:
+            break
+
+        assert len(page) == 10
+        url = resources.url.params(limit=10, after=page[-1]['id'])
+
+    assert seen_ids == sorted(seen_ids)
+    assert seen_ids == sorted(res.id for res in resources.all())
+
+
+def test_job_pages(api_session, procedure, resource):
+    expected_ids = []
+    for i in range(5):
+        expected_ids.append(procedure.exec(target=resource.id, wait=False).id)
+        # Make sure that creation dates are distinct
+        time.sleep(.01)
+
+    collection = Job.objects.filter(procedure=procedure.id)
+    url = collection.url.params(limit=2)
+    seen_ids = []
+
+    while True:
+        response = api_session.get(url, decode_json=False)
+        page = response.json()
+        seen_ids.extend(doc['id'] for doc in page)
+
+        if 'next' not in response.links:
+            break
+
+        url = collection.url.params(limit=2, after=page[-1]['id'])
+
+    # Jobs are paginated in the order of creation, like unpaginated lists
+    assert seen_ids == expected_ids
+    assert [job['id'] for job in api_session.get(collection.url)] == \
+        expected_ids
+
+
+def test_count(api_session, resources):
+    expected_count = len(list(resources.all()))
+
+    response = api_session.get(
+        resources.url.params(limit=0, count='true'), decode_json=False)
+
+    assert response.json() == []
+    assert int(response.headers['X-Total-Count']) == expected_count
+
+
+@pytest.mark.parametrize('params', [
+    {'limit': -1},
+    {'limit': 'x'},
+    {'offset': -1},
+])
+def test_invalid_params(api_session, resources, params):
+    with pytest.raises(StormBadRequestError):
+        api_session.get(resources.url.params(params))
+
+
+def test_lazy_iteration(small_pages, random_resources, resources):
+    expected_ids = sorted(res.id for res in random_resources)
+
+    assert [res.id for res in resources] == expected_ids
+
+    # The collection spans more than one page: nothing is cached
+    assert resources._elems is None
+
+
+def test_len_and_index(small_pages, random_resources, resources):
+    expected_ids = sorted(res.id for res in random_resources)
+
+    assert len(resources) == len(expected_ids)
+    assert resources[0].id == expected_ids[0]
+    assert resources[10].id == expected_ids[10]
+    assert resources[-1].id == expected_ids[-1]
+    assert [res.id for res in resources[5:20]] == expected_ids[5:20]
+    assert [res.id for res in resources[5:20:3]] == expected_ids[5:20:3]
+    assert [res.id for res in resources[60:]] == expected_ids[60:]
+
+    with pytest.raises(IndexError):
+        resources[len(expected_ids)]
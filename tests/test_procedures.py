@@ -1,15 +1,17 @@
+import json
 import textwrap
 import time
 from multiprocessing import Process, Barrier, Queue
 
 import pytest
 
-from stormlib import Procedure, Job
-from stormlib.exceptions import StormConflictError
+from stormlib import Procedure, Job, wait_all
+from stormlib.exceptions import StormBadRequestError, StormConflictError
 
 from .create import BaseTestCreateWithAgent
-from .samples import create_agent, create_procedure, delete_on_exit
-from .stubs import IDENTIFIER, PLACEHOLDER
+from .samples import (
+    create_agent, create_procedure, create_resource, delete_on_exit)
+from .stubs import IDENTIFIER, PLACEHOLDER, random_name
 
 
 class TestCreate(BaseTestCreateWithAgent):
@@ -64,6 +66,15 @@ class TestCreate(BaseTestCreateWithAgent):
         ),
     ]
 
+    invalid_server_only_data = [
+        (
+            {'type': 'test', 'content': '{% if %}'},
+            {'content': [
+                "Line 1: Expected an expression, "
+                "got 'end of statement block'"]},
+        ),
+    ]
+
 
 class TestJobs:
 
@@ -81,6 +92,7 @@ class TestJobs:
         assert not job.is_pending()
         assert job.is_running()
         assert not job.is_complete()
+        assert job.completed is None
 
         job.complete()
 
@@ -88,6 +100,8 @@ class TestJobs:
         assert not job.is_pending()
         assert not job.is_running()
         assert job.is_complete()
+        assert job.completed is not None
+        assert not job.result_pruned
 
     def test_concurrency(self, procedure, resource):
         # In this test we are going to start several processes trying to
@@ -173,10 +187,222 @@ class TestJobs:
 
         assert job.is_complete()
 
+    def test_wait_all(self, agent, procedure, resource):
+        jobs = [
+            procedure.exec(target=resource.id, wait=False)
+            for i in range(3)]
+
+        def handle_jobs():
+            for job in jobs:
+                with job.handle(owner=agent.id):
+                    time.sleep(.5)
+
+        process = Process(target=handle_jobs)
+        process.start()
+
+        try:
+            wait_all(jobs, delete=False)
+        finally:
+            process.join()
+
+        assert all(job.status == 'done' for job in jobs)
+
+    def test_wait_timeout(self, api_session, procedure, resource):
+        job = procedure.exec(target=resource.id, wait=False)
+
+        start = time.time()
+        data = api_session.get((job.url / 'wait').params(timeout=1))
+
+        assert 1 <= time.time() - start < 5
+        assert data['id'] == job.id
+        assert data['status'] == 'pending'
+
+    def test_claim(self, agent, procedure, resource):
+        jobs = [
+            procedure.exec(target=resource.id, wait=False)
+            for i in range(3)]
+        claim_filter = {'type': 'test', 'target': {'id': resource.id}}
+
+        claimed = Job.claim(agent.id, count=2, **claim_filter)
+        claimed += Job.claim(agent.id, count=2, **claim_filter)
+
+        assert sorted(job.id for job in claimed) == sorted(
+            job.id for job in jobs)
+        for job in claimed:
+            assert job.status == 'running'
+            assert job.owner == agent.id
+
+        assert Job.claim(agent.id, **claim_filter) == []
+
+    def test_claim_wait(self, agent, procedure, resource):
+        results = Queue()
+
+        def claim():
+            jobs = Job.claim(
+                agent.id, type='test', target={'id': resource.id},
+                timeout=10)
+            results.put([job.id for job in jobs])
+
+        process = Process(target=claim)
+        process.start()
+
+        try:
+            time.sleep(1)
+            job = procedure.exec(target=resource.id, wait=False)
+            assert results.get(timeout=10) == [job.id]
+        finally:
+            process.join()
+
+    def test_claim_wait_for_slot(self, agent, procedure, resource):
+        agent.options = {'maxConcurrentJobs': 1}
+        agent.save()
+
+        procedure.exec(target=resource.id, wait=False)
+        running_job, = Job.claim(agent.id, target={'id': resource.id})
+        pending_job = procedure.exec(target=resource.id, wait=False)
+        results = Queue()
+
+        def claim():
+            jobs = Job.claim(
+                agent.id, target={'id': resource.id}, timeout=10)
+            results.put([job.id for job in jobs])
+
+        process = Process(target=claim)
+        process.start()
+
+        try:
+            time.sleep(1)
+            running_job.complete()
+            # The request wakes up as soon as the running job completes,
+            # without waiting for the periodic checks
+            assert results.get(timeout=3) == [pending_job.id]
+        finally:
+            process.join()
+
+    def test_claim_priority(self, agent, procedure, resource):
+        procedure.exec(target=resource.id, wait=False)
+        urgent_job = procedure.exec(
+            target=resource.id, wait=False, priority=10)
+
+        claimed = Job.claim(agent.id, target={'id': resource.id})
+        assert [job.id for job in claimed] == [urgent_job.id]
+        assert claimed[0].priority == 10
+        assert claimed[0].started is not None
+
+    def test_fair_queueing(self, api_session, agent, procedure, resource):
+        busy_queue = 'test:' + random_name()
+        quiet_queue = 'test:' + random_name()
+
+        for i in range(4):
+            procedure.exec(target=resource.id, wait=False, queue=busy_queue)
+        for i in range(2):
+            procedure.exec(target=resource.id, wait=False, queue=quiet_queue)
+
+        claimed = Job.claim(agent.id, count=4, target={'id': resource.id})
+        queues = [job.queue for job in claimed]
+
+        # Jobs from the busy queue do not prevent the quiet queue from
+        # running, even though they were created first
+        assert queues.count(busy_queue) == 2
+        assert queues.count(quiet_queue) == 2
+
+        metrics = api_session.get(api_session.api_root / 'v1/metrics')
+        busy_metrics = metrics['job_queues'][busy_queue]
+        assert busy_metrics['pending'] == 2
+        assert busy_metrics['running'] == 2
+        assert busy_metrics['wait_seconds'] > 0
+
+    def test_max_concurrent_jobs(self, agent, procedure, resource):
+        agent.options = {'maxConcurrentJobs': 1}
+        agent.save()
+
+        first_job = procedure.exec(target=resource.id, wait=False)
+        second_job = procedure.exec(target=resource.id, wait=False)
+
+        claimed = Job.claim(agent.id, count=2, target={'id': resource.id})
+        assert [job.id for job in claimed] == [first_job.id]
+
+        with pytest.raises(StormConflictError):
+            second_job.handle(owner=agent.id)
+
+        claimed[0].complete()
+        second_job.handle(owner=agent.id)
+
+    def test_output(self, agent, procedure, resource):
+        job = procedure.exec(target=resource.id, wait=False)
+
+        with pytest.raises(StormConflictError):
+            job.append_output('not running\n')
+
+        job.handle(owner=agent.id)
+
+        with job.open_output(buffer_size=20, flush_interval=60) as output:
+            output.write('first line\n')
+            assert job.read_output() == ('', 0)
+            output.write('second line\n')
+            assert job.read_output() == ('first line\nsecond line\n', 23)
+
+        assert job.append_output('third line\n') == 23
+
+        text, offset = job.read_output(offset=6)
+        assert text == 'line\nsecond line\nthird line\n'
+        assert offset == 34
+
+        job.complete()
+        job.reload()
+        assert job.output_size == 34
+
+        assert ''.join(job.follow_output(offset=offset)) == ''
+
+    def test_follow_output(self, agent, procedure, resource):
+        job = procedure.exec(target=resource.id, wait=False)
+
+        def run_job():
+            with job.handle(owner=agent.id):
+                for i in range(3):
+                    job.append_output('line {}\n'.format(i))
+                    time.sleep(.5)
+
+        process = Process(target=run_job)
+        process.start()
+
+        try:
+            output = ''.join(job.follow_output())
+        finally:
+            process.join()
+
+        assert output == 'line 0\nline 1\nline 2\n'
+
     def test_content_rendering(self, agent, procedure, resource):
         job = procedure.exec(target=resource.id, wait=False)
         assert job.content == '1 + 2 = 3'
 
+    def test_deferred_fields(self, agent, resource):
+        resource.snapshot = {'a': [1, 2]}
+        resource.save()
+
+        content = textwrap.dedent("""\
+            {% for res in resources({'id': target.id}) %}
+            {{ res.snapshot.a | length }} {{ res | tojson }}
+            {% endfor %}""")
+
+        with delete_on_exit(create_procedure(content=content)) as procedure:
+            job = procedure.exec(target=resource.id, wait=False)
+
+        length, data = job.content.split(' ', 1)
+        assert length == '2'
+        assert json.loads(data)['snapshot'] == {'a': [1, 2]}
+
+    def test_query_budget(self, agent, resource):
+        content = textwrap.dedent("""\
+            {% for i in range(1000) %}
+            {{ resources[i:i + 1] | length }}
+            {% endfor %}""")
+
+        with delete_on_exit(create_procedure(content=content)) as procedure:
+            with pytest.raises(StormBadRequestError):
+                procedure.exec(target=resource.id, wait=False)
+
 
 class TestSubscriptions:
 
@@ -226,3 +452,16 @@ class TestSubscriptions:
             '''.format(resource.id, resource.names))
 
         assert job.content == expected_content.strip()
+
+    def test_subscriptions_non_members(self, procedure, agent, alpha_group):
+        resource = create_resource(type='beta', owner=agent.id)
+
+        with delete_on_exit(resource):
+            procedure.attach(group=alpha_group.id, target=resource.id)
+
+            # Resources outside the group must not trigger the subscription
+            resource.image = 'scrambled_egg'
+            resource.save()
+
+            time.sleep(2)
+            assert not Job.objects.filter(procedure=procedure.id)
@@ -1,7 +1,7 @@
 import pytest
 
-from stormlib import Resource
-from stormlib.exceptions import StormObjectNotFound
+from stormlib import Resource, events
+from stormlib.exceptions import StormBadRequestError, StormObjectNotFound
 
 from .create import BaseTestCreateWithAgent
 from .samples import create_agent, delete_on_exit
@@ -313,3 +313,190 @@ class TestFiltering:
         matched_resources = Resource.objects.filter(**query)
         expected_resources = list(filter(filterfunc, random_resources))
         assert_resources_equal(matched_resources, expected_resources)
+
+
+class TestProjection:
+
+    @pytest.fixture()
+    def resource(self, agent):
+        resource = Resource(
+            type='test', names=[random_name()], owner=agent.id,
+            snapshot={'a': 1})
+        resource.save()
+        return resource
+
+    @pytest.mark.parametrize('fields, expected_fields', [
+        ('type', {'id', 'type'}),
+        ('id,type,names', {'id', 'type', 'names'}),
+        (None, {
+            'id', 'type', 'names', 'owner', 'parent', 'cluster', 'host',
+            'image', 'status', 'health', 'snapshot'}),
+    ])
+    def test_fields(self, api_session, resource, fields, expected_fields):
+        params = {'fields': fields} if fields else {}
+
+        detail = api_session.get(resource.url.params(params))
+        assert set(detail) == expected_fields
+
+        collection = Resource.objects.filter(id=resource.id)
+        listing = api_session.get(collection.url.params(params))
+        assert [set(item) for item in listing] == [expected_fields]
+
+    def test_exclude(self, api_session, resource):
+        detail = api_session.get(resource.url.params(exclude='snapshot,id'))
+        assert 'snapshot' not in detail
+        assert detail['id'] == resource.id
+        assert detail['type'] == 'test'
+
+    @pytest.mark.parametrize('params', [
+        {'fields': 'type,unknown'},
+        {'exclude': 'unknown'},
+    ])
+    def test_unknown_fields(self, api_session, resource, params):
+        with pytest.raises(StormBadRequestError):
+            api_session.get(resource.url.params(params))
+
+    def test_only(self, resource):
+        obj = Resource.objects.only('id', 'type').get(id=resource.id)
+
+        assert obj.id == resource.id
+        assert obj.type == 'test'
+        assert 'snapshot' not in obj._data
+
+        with pytest.raises(RuntimeError):
+            obj.save()
+
+        obj.reload()
+        assert obj.snapshot == {'a': 1}
+        obj.save()
+
+
+class TestBulk:
+
+    def create_resource(self, agent, **kwargs):
+        return Resource(
+            type='test', names=[random_name()], owner=agent.id, **kwargs)
+
+    def test_upsert_and_delete(self, agent):
+        existing = self.create_resource(agent, status='created')
+        existing.save()
+
+        new = self.create_resource(agent)
+        updated = self.create_resource(agent, status='running')
+        updated.id = existing.names[0]
+        deleted = Resource(id=existing.id)
+
+        results = Resource.bulk([
+            ('upsert', new),
+            ('upsert', updated),
+            ('delete', Resource(id=random_name())),
+        ])
+
+        assert [result.status for result in results] == [201, 200, 404]
+        assert new.id.startswith('res-')
+        assert updated.id == existing.id
+
+        existing.reload()
+        assert existing.status == 'running'
+        assert Resource.objects.get(new.id).names == new.names
+
+        results = Resource.bulk([('delete', deleted), ('upsert', new)])
+        assert [result.status for result in results] == [204, 200]
+
+        with pytest.raises(StormObjectNotFound):
+            existing.reload()
+
+    def test_upsert_new_key(self, agent):
+        key = random_name()
+
+        for i in range(2):
+            resource = self.create_resource(agent)
+            resource.id = key
+            Resource.bulk([('upsert', resource)])
+
+        # The key is kept as a name, and the ID is allocated by the server
+        resources = list(Resource.objects.filter(owner=agent.id))
+        assert len(resources) == 1
+        assert resources[0].id.startswith('res-')
+        assert resources[0].names == resource.names + [key]
+
+    def test_upsert_missing_id(self, agent):
+        resource = self.create_resource(agent)
+        resource.id = 'res-' + random_name()
+
+        results = Resource.bulk([('upsert', resource)])
+
+        assert results[0].status == 404
+        assert not list(Resource.objects.filter(owner=agent.id))
+
+    def test_delete_aliases(self, agent):
+        existing = self.create_resource(agent)
+        existing.save()
+
+        recreated = self.create_resource(agent)
+        recreated.names = existing.names
+        recreated.id = existing.names[0]
+
+        # The second item must not update the resource deleted by the
+        # first one, even if it refers to it by name
+        results = Resource.bulk([
+            ('delete', Resource(id=existing.id)),
+            ('upsert', recreated),
+        ])
+
+        assert [result.status for result in results] == [204, 201]
+        assert recreated.id != existing.id
+        assert Resource.objects.get(recreated.id).names == existing.names
+
+    def test_errors(self, agent):
+        results = Resource.bulk([
+            ('upsert', self.create_resource(agent, parent=random_name())),
+            ('upsert', self.create_resource(agent)),
+        ])
+
+        assert [result.status for result in results] == [400, 201]
+        assert 'parent' in results[0].errors
+
+    def test_events(self, agent):
+        resource = self.create_resource(agent)
+
+        with events.stream(['created:resource']) as stream:
+            Resource.bulk([('upsert', resource)])
+            for event in stream:
+                if event.entity.id == resource.id:
+                    break
+
+        assert event.entity.names == resource.names
+
+    @pytest.mark.parametrize('data', [
+        {},
+        [{'op': 'unknown'}],
+        [{'op': 'delete'}],
+    ])
+    def test_malformed(self, api_session, data):
+        with pytest.raises(StormBadRequestError):
+            api_session.post(Resource.objects.url / 'bulk', json=data)
+
+
+class TestReferences:
+
+    def test_list_references(self, agent):
+        parent = Resource(type='test', names=[random_name()], owner=agent.id)
+        parent.save()
+
+        children = []
+        for i in range(5):
+            child = Resource(
+                type='test', names=[random_name()], owner=agent.id,
+                parent=parent.names[0], cluster=parent.id)
+            child.save()
+            children.append(child)
+
+        listed = {
+            res.id: res for res in Resource.objects.filter(owner=agent.id)}
+
+        assert listed[parent.id].parent is None
+        for child in children:
+            assert listed[child.id].owner == agent.id
+            assert listed[child.id].parent == parent.id
+            assert listed[child.id].cluster == parent.id
@@ -0,0 +1,49 @@
+import pytest
+
+from stormlib import Resource
+from stormlib.exceptions import StormConnectionError, StormNotFoundError
+from stormlib.session import Session
+
+
+@pytest.fixture()
+def session(request):
+    host = request.config.getoption('--api-server-host')
+    port = request.config.getoption('--api-server-port')
+    session = Session(host, port)
+    yield session
+    session.close()
+
+
+def test_connection_reuse(session):
+    for i in range(10):
+        session.get('v1/resources', params={'limit': 1})
+
+    stats = session.get_stats()
+    assert stats['requests'] == 10
+    assert stats['errors'] == 0
+    assert stats['connections'] == 1
+    assert stats['reused'] == 9
+    assert 0 < stats['avg_time'] <= stats['max_time']
+
+
+def test_errors(session, resource):
+    with session:
+        Resource.objects.get(id=resource.id)
+        with pytest.raises(StormNotFoundError):
+            session.get('v1/resources/res-does-not-exist')
+
+    stats = session.get_stats()
+    assert stats['requests'] == 2
+    assert stats['errors'] == 1
+
+
+def test_connection_error():
+    # Nothing listens on port 1
+    session = Session('127.0.0.1', 1, max_retries=2, retry_backoff=0)
+
+    with pytest.raises(StormConnectionError):
+        session.get('v1/resources')
+
+    stats = session.get_stats()
+    assert stats['requests'] == 1
+    assert stats['errors'] == 1